@@ -0,0 +1,95 @@
+"""
+客户端合并调用
+同一方法的多次小调用在max_wait秒内或凑满max_items条后合并成一个请求发送, 结果按顺序分发给各调用方
+每条结果与服务端批量返回的单条一致, 为Result的字典形式, 发送失败时也是字典
+"""
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+from PyPark.cons import StatusCode
+from PyPark.park_exception import ServiceException
+from PyPark.result import Result
+
+
+class Batcher:
+    """
+    :param send: 发送一批数据的函数, 参数为数据列表, 返回等长的结果列表
+    :param max_items: 每批最大条数
+    :param max_wait: 第一条数据最多等待的秒数
+    :param executor: 发送请求的线程池, 为空时在刷新线程中发送
+    """
+
+    def __init__(self, send, max_items=100, max_wait=0.005, executor=None, name="batcher"):
+        self.send = send
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self.executor = executor
+        self.items = []
+        self.futures = []
+        self.first_time = None
+        self.cond = threading.Condition()
+        self.stats = {"calls": 0, "batches": 0}
+        self.closed = False
+        self.th = threading.Thread(target=self.__flush_daemon, name=name)
+        self.th.daemon = True
+        self.th.start()
+
+    def submit(self, data) -> Future:
+        future = Future()
+        with self.cond:
+            if self.closed:
+                raise ServiceException(f"{self.th.name} 已关闭")
+            if not self.items:
+                self.first_time = time.monotonic()
+            self.items.append(data)
+            self.futures.append(future)
+            self.stats["calls"] += 1
+            # 第一条开始计时, 凑满立即发送
+            if len(self.items) == 1 or len(self.items) >= self.max_items:
+                self.cond.notify()
+        return future
+
+    def call(self, data, timeout=None):
+        return self.submit(data).result(timeout=timeout)
+
+    def close(self, timeout=None):
+        """停止刷新线程, 已提交的数据立即发送后退出"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.th.join(timeout)
+
+    def __flush_daemon(self):
+        while True:
+            with self.cond:
+                while not self.items and not self.closed:
+                    self.cond.wait()
+                if not self.items:
+                    return
+                while len(self.items) < self.max_items and not self.closed:
+                    remaining = self.first_time + self.max_wait - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                items, futures = self.items[:self.max_items], self.futures[:self.max_items]
+                del self.items[:self.max_items]
+                del self.futures[:self.max_items]
+                if self.items:
+                    self.first_time = time.monotonic()
+                self.stats["batches"] += 1
+            if self.executor is None or self.closed:
+                # 关闭时线程池可能已关闭, 在刷新线程中发送
+                self.__send(items, futures)
+            else:
+                self.executor.submit(self.__send, items, futures)
+
+    def __send(self, items, futures):
+        try:
+            results = self.send(items)
+        except Exception as e:
+            logging.exception(e)
+            results = [Result.error(code=StatusCode.SYSTEM_ERROR, msg=str(e)).__dict__ for _ in items]
+        for future, result in zip(futures, results):
+            future.set_result(result)
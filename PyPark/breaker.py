@@ -0,0 +1,167 @@
+"""
+客户端主机熔断
+按主机统计连续失败次数和最近的错误率, 超过阈值后在退避时间内不再选择该主机,
+退避到期后放行一个探测请求(半开), 成功则恢复, 失败则加倍退避
+"""
+import collections
+import threading
+import time
+
+
+class BreakerState:
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+
+class HostHealth:
+
+    def __init__(self, host, table):
+        self.host = host
+        self.table = table
+        self.state = BreakerState.CLOSED
+        self.consecutive_failures = 0
+        self.window = collections.deque(maxlen=table.window_size)
+        self.backoff = table.backoff
+        self.open_until = 0.0
+        self.probe_time = 0.0
+        self.ejections = 0
+
+    def error_rate(self):
+        if not self.window:
+            return 0.0
+        return self.window.count(False) / len(self.window)
+
+    def available(self, now):
+        if self.state == BreakerState.CLOSED:
+            return True
+        if self.state == BreakerState.OPEN:
+            return now >= self.open_until
+        # 半开时只放行一个探测请求, 探测超时后允许再次探测
+        return now - self.probe_time >= self.backoff
+
+    def on_request(self, now):
+        if self.state != BreakerState.CLOSED and self.available(now):
+            self.state = BreakerState.HALF_OPEN
+            self.probe_time = now
+
+    def on_success(self):
+        self.window.append(True)
+        self.consecutive_failures = 0
+        if self.state != BreakerState.CLOSED:
+            self.state = BreakerState.CLOSED
+            self.backoff = self.table.backoff
+            self.window.clear()
+
+    def on_failure(self, now):
+        self.window.append(False)
+        self.consecutive_failures += 1
+        if self.state == BreakerState.HALF_OPEN:
+            self.backoff = min(self.backoff * 2, self.table.max_backoff)
+            self.__open(now)
+        elif self.state == BreakerState.CLOSED and (
+                self.consecutive_failures >= self.table.max_failures or
+                (len(self.window) >= self.table.min_requests and self.error_rate() >= self.table.error_rate)):
+            self.__open(now)
+
+    def __open(self, now):
+        self.state = BreakerState.OPEN
+        self.open_until = now + self.backoff
+        self.ejections += 1
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "error_rate": round(self.error_rate(), 4),
+            "backoff": self.backoff,
+            "open_until": self.open_until,
+            "ejections": self.ejections,
+        }
+
+
+class HealthTable:
+    """
+    :param max_failures: 连续失败次数阈值
+    :param error_rate: 最近window_size次请求的错误率阈值
+    :param min_requests: 计算错误率的最少请求数
+    :param backoff: 首次熔断秒数, 半开探测失败后加倍, 最大max_backoff
+    """
+
+    def __init__(self, max_failures=5, error_rate=0.5, window_size=20, min_requests=10, backoff=1.0,
+                 max_backoff=60.0):
+        self.max_failures = max_failures
+        self.error_rate = error_rate
+        self.window_size = window_size
+        self.min_requests = min_requests
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def configure(self, **kwargs):
+        with self.lock:
+            for k, v in kwargs.items():
+                if v is not None and hasattr(self, k):
+                    setattr(self, k, v)
+
+    def __health(self, host) -> HostHealth:
+        health = self.hosts.get(host, None)
+        if health is None:
+            health = self.hosts.setdefault(host, HostHealth(host, self))
+        return health
+
+    def filter(self, hosts):
+        """剔除熔断中的主机, 全部熔断时返回原列表"""
+        if not self.hosts:
+            return hosts
+        now = time.monotonic()
+        with self.lock:
+            available = [h for h in hosts if h not in self.hosts or self.hosts[h].available(now)]
+        return available or hosts
+
+    def on_request(self, host):
+        if host not in self.hosts:
+            return
+        with self.lock:
+            self.__health(host).on_request(time.monotonic())
+
+    def on_success(self, host):
+        health = self.hosts.get(host, None)
+        if health is None or (health.state == BreakerState.CLOSED and health.consecutive_failures == 0
+                              and len(health.window) == 0):
+            return
+        with self.lock:
+            health.on_success()
+
+    def on_failure(self, host):
+        with self.lock:
+            self.__health(host).on_failure(time.monotonic())
+
+    def on_response(self, host, status_code, headers=None):
+        """按响应状态更新主机状态, 单个服务限流说明主机正常但该服务繁忙, 不计入成功或失败"""
+        if is_host_failure(status_code, headers):
+            self.on_failure(host)
+        elif not is_limited(status_code, headers):
+            self.on_success(host)
+
+    def snapshot(self):
+        with self.lock:
+            return {h: health.snapshot() for h, health in self.hosts.items()}
+
+
+# 进程内共享
+health_table = HealthTable()
+
+# 服务端因单个服务的并发限制拒绝请求时带上该响应头, 主机本身正常
+LIMITED_HEADER = "X-Park-Limited"
+
+
+def is_limited(status_code, headers=None):
+    """单个服务的并发限制拒绝(带LIMITED_HEADER的503)"""
+    return status_code == 503 and headers is not None and bool(headers.get(LIMITED_HEADER, None))
+
+
+def is_host_failure(status_code, headers=None):
+    """5xx视为主机故障, 业务错误和单个服务的限流不计入"""
+    return status_code >= 500 and not is_limited(status_code, headers)
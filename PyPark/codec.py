@@ -0,0 +1,148 @@
+"""
+RPC数据编解码
+通过Content-Type/Accept协商, 未安装的编解码器不会注册, 旧版本节点默认使用JSON
+"""
+import datetime
+import json
+from decimal import Decimal
+
+from PyPark.cons import CONTENT_TYPE
+from PyPark.util.json_to import JsonTo
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# key:name value:codec
+CODECS = {}
+# key:Content-Type(不含参数) value:codec, 用于解码
+CONTENT_TYPE_CODECS = {}
+
+
+def to_basic(obj):
+    """与JsonTo一致的类型转换, 供orjson/msgpack的default使用"""
+    if isinstance(obj, datetime.datetime):
+        return obj.strftime('%Y-%m-%d %H:%M:%S')
+    elif isinstance(obj, datetime.date):
+        return obj.strftime('%Y-%m-%d')
+    elif isinstance(obj, Decimal):
+        return float(obj)
+    elif hasattr(obj, "__dict__"):
+        return obj.__dict__
+    raise TypeError(f"Object of type {type(obj).__name__} is not serializable")
+
+
+def mime_type(content_type):
+    """application/json;charset=utf-8 --> application/json"""
+    return content_type.split(";")[0].strip().lower()
+
+
+class JsonCodec:
+    name = "json"
+    content_type = CONTENT_TYPE.JSON
+
+    def __init__(self, json_cls=JsonTo):
+        self.json_cls = json_cls
+
+    def dumps(self, obj) -> bytes:
+        return json.dumps(obj, cls=self.json_cls).encode("utf-8")
+
+    def loads(self, data):
+        if len(data) == 0:
+            return None
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    orjson编解码, 需要按名称指定(codec="orjson"), 不作为application/json的默认解码器
+    orjson与json的差异: 编码时NaN/Infinity输出为null, 超过64位的整数回退到json编码;
+    解码含NaN/Infinity的数据时回退到json, 超过64位的整数会被解码为float
+    """
+    name = "orjson"
+
+    def __init__(self):
+        super().__init__()
+        self.option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj) -> bytes:
+        try:
+            return orjson.dumps(obj, default=to_basic, option=self.option)
+        except orjson.JSONEncodeError:
+            return super().dumps(obj)
+
+    def loads(self, data):
+        if len(data) == 0:
+            return None
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    content_type = CONTENT_TYPE.MSGPACK
+
+    def dumps(self, obj) -> bytes:
+        return msgpack.packb(obj, default=to_basic, use_bin_type=True, datetime=False)
+
+    def loads(self, data):
+        if len(data) == 0:
+            return None
+        return msgpack.unpackb(data, raw=False)
+
+
+def register_codec(codec, decode=True):
+    """
+    注册编解码器
+    :param codec: 需要name, content_type, dumps, loads
+    :param decode: 是否作为该Content-Type的默认解码器
+    """
+    CODECS[codec.name] = codec
+    if decode:
+        CONTENT_TYPE_CODECS[mime_type(codec.content_type)] = codec
+
+
+def get_codec(codec, json_cls=None):
+    """按名称获取编解码器, 传入编解码器对象则直接返回, 为空返回JSON编解码器"""
+    if codec is None:
+        return JsonCodec(json_cls or JsonTo)
+    if isinstance(codec, str):
+        c = CODECS.get(codec, None)
+        if c is None:
+            raise ValueError(f"不支持的编解码器-{codec}")
+        return c
+    return codec
+
+
+def codec_for_content_type(content_type):
+    """按Content-Type获取解码器, 不支持返回None"""
+    if not content_type:
+        return None
+    return CONTENT_TYPE_CODECS.get(mime_type(content_type), None)
+
+
+def codec_for_accept(accept):
+    """按Accept获取第一个支持的编解码器, 不支持返回None"""
+    if not accept:
+        return None
+    for a in accept.split(","):
+        c = CONTENT_TYPE_CODECS.get(mime_type(a), None)
+        if c is not None:
+            return c
+    return None
+
+
+register_codec(JsonCodec())
+if orjson is not None:
+    # json.dumps输出的NaN/Infinity与大整数orjson无法无损解码, 默认解码器保持json
+    register_codec(OrjsonCodec(), decode=False)
+if msgpack is not None:
+    register_codec(MsgpackCodec())
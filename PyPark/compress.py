@@ -0,0 +1,143 @@
+"""
+RPC数据压缩
+通过Accept-Encoding/Content-Encoding协商, 未安装的压缩算法不会注册, 小于阈值的数据不压缩
+"""
+import gzip
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# 默认压缩阈值(字节), 小数据压缩收益不抵CPU开销
+COMPRESS_MIN_SIZE = 1024
+
+# key:Content-Encoding value:compressor, 按优先级排列
+COMPRESSORS = {}
+
+
+class GzipCompressor:
+    name = "gzip"
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data) -> bytes:
+        return gzip.compress(data, compresslevel=self.level)
+
+    def decompress(self, data) -> bytes:
+        return gzip.decompress(data)
+
+
+class ZstdCompressor:
+    name = "zstd"
+
+    def __init__(self, level=3):
+        self.level = level
+        # ZstdCompressor对象不是线程安全的, 每个线程一个
+        self.local = threading.local()
+
+    def compress(self, data) -> bytes:
+        c = getattr(self.local, "c", None)
+        if c is None:
+            c = self.local.c = zstandard.ZstdCompressor(level=self.level)
+        return c.compress(data)
+
+    def decompress(self, data) -> bytes:
+        d = getattr(self.local, "d", None)
+        if d is None:
+            d = self.local.d = zstandard.ZstdDecompressor()
+        # 流式压缩的帧中可能没有原始长度
+        return d.decompressobj().decompress(data)
+
+
+class Lz4Compressor:
+    name = "lz4"
+
+    def compress(self, data) -> bytes:
+        return lz4.frame.compress(data)
+
+    def decompress(self, data) -> bytes:
+        return lz4.frame.decompress(data)
+
+
+def register_compressor(compressor):
+    """注册压缩算法, 先注册的优先"""
+    COMPRESSORS[compressor.name] = compressor
+
+
+def accept_encoding() -> str:
+    """客户端的Accept-Encoding"""
+    return ", ".join(COMPRESSORS.keys())
+
+
+def choose_encoding(accept):
+    """按本地优先级选择对方支持的压缩算法, 不支持返回None"""
+    if not accept:
+        return None
+    names = set()
+    for a in accept.split(","):
+        name, _, q = a.strip().lower().partition(";")
+        if q.strip() not in ("q=0", "q=0.0"):
+            names.add(name.strip())
+    for name in COMPRESSORS.keys():
+        if name in names:
+            return name
+    return None
+
+
+def compress(data, encoding, min_size=COMPRESS_MIN_SIZE):
+    """
+    :param min_size: 压缩阈值, None或小于0不压缩
+    :return: (数据, Content-Encoding), 未压缩时Content-Encoding为None
+    """
+    if encoding is None or min_size is None or min_size < 0 or len(data) < min_size:
+        return data, None
+    return COMPRESSORS[encoding].compress(data), encoding
+
+
+def decompress(data, encoding):
+    if not encoding or encoding == "identity":
+        return data
+    compressor = COMPRESSORS.get(encoding.strip().lower(), None)
+    if compressor is None:
+        raise ValueError(f"不支持的压缩算法-{encoding}")
+    return compressor.decompress(data)
+
+
+class CompressStats:
+    """每个端点的字节数, raw为压缩前, wire为实际传输"""
+
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, raw, wire, encoding=None):
+        with self.lock:
+            s = self.stats.get(endpoint, None)
+            if s is None:
+                s = self.stats[endpoint] = {"raw_bytes": 0, "wire_bytes": 0, "compressed": 0}
+            s["raw_bytes"] += raw
+            s["wire_bytes"] += wire
+            if encoding:
+                s["compressed"] += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {k: dict(v) for k, v in self.stats.items()}
+
+
+# 服务端端点为服务路径, 客户端端点为 host/method
+compress_stats = CompressStats()
+
+if zstandard is not None:
+    register_compressor(ZstdCompressor())
+if lz4 is not None:
+    register_compressor(Lz4Compressor())
+register_compressor(GzipCompressor())
@@ -13,8 +13,27 @@ class StatusCode:
 class Strategy:
     ROUND = "ROUND"
     RANDOM = "RANDOM"
+    HASH = "HASH"
+    HOST = "HOST"
+    DIY = "DIY"
+    LEAST = "LEAST"  # 最少进行中请求
+    P2C = "P2C"  # 随机两选一
+    EWMA = "EWMA"  # 峰值EWMA响应时间
 
 
 class CONTENT_TYPE:
     TEXT = "text/plain;charset=utf-8"
     JSON = "application/json;charset=utf-8"
+    MSGPACK = "application/msgpack"
+
+
+class StreamMode:
+    CHUNK = "chunk"
+    NDJSON = "ndjson"
+
+
+class FanOut:
+    ALL = "ALL"  # 等待全部
+    FIRST = "FIRST"  # 第一个成功(对冲请求)
+    QUORUM = "QUORUM"  # n个成功
+    ANY = "ANY"  # 最先完成的n个
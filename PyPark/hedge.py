@@ -0,0 +1,159 @@
+"""
+幂等服务的对冲请求
+主请求超过该方法的延迟分位数仍未返回时, 向另一个主机发送备份请求, 取先返回的成功结果
+备份请求受重试预算限制, 故障期间不会成倍放大负载
+"""
+import collections
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from PyPark.rest import is_success
+
+
+class LatencyWindow:
+    """最近size次成功调用的耗时(秒)"""
+
+    def __init__(self, size=200):
+        self.samples = collections.deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.cache = None
+        self.changes = 0
+
+    def add(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+            self.changes += 1
+
+    def percentile(self, p, min_samples=20):
+        """样本不足min_samples返回None; 每新增10个样本重新排序一次"""
+        with self.lock:
+            if len(self.samples) < min_samples:
+                return None
+            if self.cache is None or self.cache[0] != p or self.changes >= 10:
+                ordered = sorted(self.samples)
+                index = min(int(len(ordered) * p / 100.0), len(ordered) - 1)
+                self.cache = (p, ordered[index])
+                self.changes = 0
+            return self.cache[1]
+
+
+class RetryBudget:
+    """
+    令牌桶: 每个主请求存入ratio个令牌, 每个备份请求消耗1个
+    长期来看备份请求不超过主请求的ratio倍
+    """
+
+    def __init__(self, ratio=0.1, initial=10, max_tokens=100):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = initial
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.tokens + self.ratio, self.max_tokens)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class Hedger:
+    """
+    :param rest: PyPark.rest.Rest
+    :param percentile: 等待主请求的延迟分位数
+    :param budget_ratio: 备份请求占主请求的最大比例
+    :param min_delay: 最小等待秒数
+    :param pool_num: 对冲请求专用线程池大小, 不与Rest.threadPool共用
+    """
+
+    def __init__(self, rest, percentile=95, budget_ratio=0.1, min_delay=0.005, pool_num=100):
+        self.rest = rest
+        self.percentile = percentile
+        self.budget_ratio = budget_ratio
+        self.min_delay = min_delay
+        self.latencies = {}
+        self.budgets = {}
+        # key:method value:计数 calls 调用数, hedged 发出备份请求数, won 备份请求先返回数, denied 预算不足次数
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=pool_num, thread_name_prefix="hedge")
+
+    def __method(self, method):
+        window = self.latencies.get(method, None)
+        if window is None:
+            with self.lock:
+                window = self.latencies.setdefault(method, LatencyWindow())
+                self.budgets.setdefault(method, RetryBudget(self.budget_ratio))
+                self.stats.setdefault(method, {"calls": 0, "hedged": 0, "won": 0, "denied": 0})
+        return window, self.budgets[method], self.stats[method]
+
+    def __submit(self, host, method, data, codec):
+        return self.executor.submit(self.__timed, host, method, data, codec)
+
+    def __timed(self, host, method, data, codec):
+        # 从真正开始执行时计时, 排队时间不计入延迟分位数
+        start_time = time.monotonic()
+        result = self.rest.call(method=method, data=data, hosts=host, codec=codec)
+        return time.monotonic() - start_time, result
+
+    def call(self, method, data, hosts, codec=None):
+        window, budget, stats = self.__method(method)
+        stats["calls"] += 1
+        budget.deposit()
+        primary_host, backup_host = random.sample(hosts, 2)
+        delay = window.percentile(self.percentile)
+        if delay is None:
+            # 样本不足, 不对冲, 直接在调用线程中请求
+            latency, result = self.__timed(primary_host, method, data, codec)
+            if is_success(result):
+                window.add(latency)
+            return result
+        primary = self.__submit(primary_host, method, data, codec)
+        done, _ = wait([primary], timeout=max(delay, self.min_delay))
+        if done:
+            latency, result = primary.result()
+            if is_success(result):
+                window.add(latency)
+            return result
+        if not budget.withdraw():
+            stats["denied"] += 1
+            return primary.result()[1]
+
+        stats["hedged"] += 1
+        backup = self.__submit(backup_host, method, data, codec)
+        pending = {primary, backup}
+        result = None
+        answered = False
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                try:
+                    latency, f_result = f.result()
+                except Exception as e:
+                    # 一个请求异常时继续等待另一个
+                    error = e
+                    continue
+                result = f_result
+                answered = True
+                if is_success(result):
+                    window.add(latency)
+                    if f is backup:
+                        stats["won"] += 1
+                    for p in pending:
+                        p.cancel()
+                    return result
+        if not answered and error is not None:
+            # 都抛出异常
+            raise error
+        # 都失败, 返回最后一个错误
+        return result
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -19,7 +19,11 @@ def addNat(data):
         communicate_addr = ("0.0.0.0", data_port)
         customer_listen_addr = ("0.0.0.0", nat_port)
         secret_key = data["secret_key"]
-        process = Process(target=run_master, args=(communicate_addr, customer_listen_addr, secret_key))
+        bridge_shards = int(data.get("bridge_shards", 1))
+        bridge_splice = bool(data.get("splice", False))
+        mode = data.get("mode", "thread")
+        process = Process(target=run_master, args=(communicate_addr, customer_listen_addr, secret_key),
+                          kwargs={"bridge_shards": bridge_shards, "bridge_splice": bridge_splice, "mode": mode})
         process.start()
         NAT_PORT_MAP[nat_port] = {
             "process_pid": process.pid,
@@ -9,8 +9,12 @@ from PyPark.util.zk_util import path_join
 
 class Slaver(object):
 
-    def __init__(self, target_addr, nat_port, rest_base_url, get, log=None):
+    def __init__(self, target_addr, nat_port, rest_base_url, get, log=None, bridge_shards=1, splice=False,
+                 mode="thread"):
         self.log = log or logging.getLogger(__name__)
+        self.bridge_shards = bridge_shards
+        self.splice = splice
+        self.mode = mode
         self.rest_base_url = rest_base_url
         self.nat_port = nat_port
         self.target_addr = target_addr
@@ -27,7 +31,8 @@ class Slaver(object):
             secret_key = str(uuid.uuid4())
             result = self.get(path_join(self.rest_base_url, PART_API.ADD_NAT),
                               data={"nat_port": self.nat_port, "secret_key": secret_key,
-                                    "target_addr": self.target_addr})
+                                    "target_addr": self.target_addr, "bridge_shards": self.bridge_shards,
+                                    "splice": self.splice, "mode": self.mode})
             if result["is_success"]:
                 data_port = result['data']["data_port"]
                 secret_key = result['data']["secret_key"]
@@ -40,7 +45,8 @@ class Slaver(object):
                 f"communicate_addr:{communicate_addr}-target_addr:{self.target_addr}")
             run_slaver(communicate_addr=communicate_addr, target_addr=split_host(self.target_addr),
                        secret_key=secret_key,
-                       max_spare_count=2)
+                       max_spare_count=2, bridge_shards=self.bridge_shards,
+                       bridge_splice=self.splice, mode=self.mode)
             sleep_time = 1
 
         except Exception as e:
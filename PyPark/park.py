@@ -2,13 +2,21 @@ import atexit
 import logging
 import os
 import random
+import threading
 
+from PyPark.batch import Batcher
+from PyPark.breaker import health_table
+from PyPark.compress import COMPRESS_MIN_SIZE, compress_stats
 from PyPark.config import Config
+from PyPark.cons import StreamMode, FanOut
+from PyPark.hedge import Hedger
 from PyPark.lock import Lock
 from PyPark.nat.master import addNat
 from PyPark.nat.slaver import Slaver
+from PyPark.park_exception import NoServiceException
 from PyPark.park_zk import ParkZK
-from PyPark.rest import Rest
+from PyPark.rest import Rest, AsyncRest, is_success
+from PyPark.result_cache import ResultCache, make_key
 from PyPark.util.json_to import JsonTo
 from PyPark.util.net import get_random_port, get_pc_name_ip
 from PyPark.version import print_infos
@@ -61,9 +69,26 @@ class Park(object):
         :param rest_base_url:str                # service路径，默认为"/",对应zk多级目录
         :param nat_ip:str                       # nat_ip
         :param nat_port:int                     #
+        :param nat_bridge_shards:int            # 内网穿透转发线程数, Master与Slaver两端相同, 默认1
+        :param nat_splice:bool                  # 内网穿透用splice在内核中转发数据, 仅Linux, 默认False
+        :param nat_mode:str                     # 内网穿透Master/Slaver实现, "thread"或"asyncio", 默认"thread"
+        :param rpc_port:int                     # 二进制RPC端口, 开启后登记到ZK, 默认不开启
+        :param prefer_rpc:bool                  # 服务节点开启RPC时优先使用RPC调用, 默认True
+        :param compress_min_size:int            # 服务响应超过该字节数时压缩(gzip/zstd/lz4), None不压缩, 默认1024
         :param watch_config:bool                # 配置是否同步, 默认False
         :param watch_configs:bool            # 配置是否同步, 默认False
         :param rpc_timeout:int                  # rpc_timeout
+        :param async_max_clients:int            # 异步客户端最大并发请求数, 默认1000
+        :param service_pool_num:int             # 同步服务线程池大小, 默认20
+        :param hedge_percentile:int             # 幂等服务超过该延迟分位数时发送备份请求, 默认95
+        :param hedge_budget_ratio:float         # 备份请求占请求数的最大比例, 默认0.1
+        :param hedge_pool_num:int               # 对冲请求专用线程池大小, 默认100
+        :param breaker_failures:int             # 主机连续失败多少次后熔断, 默认5
+        :param breaker_error_rate:float         # 主机错误率超过多少后熔断, 默认0.5
+        :param breaker_backoff:float            # 首次熔断秒数, 探测失败后加倍, 默认1
+        :param breaker_max_backoff:float        # 最大熔断秒数, 默认60
+        :param batch_max_items:int              # batch_call 每批最大条数, 默认100
+        :param batch_max_wait:float             # batch_call 合并等待秒数, 默认0.005
         :param log:logging                      # 日志
         :param json_to_cls:JsonTo               # JSON转换器,默认为 PyPark.util.json_to.JsonTo
         :param debug:bool                      # J
@@ -81,6 +106,10 @@ class Park(object):
         self.rest_base_url = kwargs.get("rest_base_url", "/")
         self.nat_ip = kwargs.get("nat_ip", None)
         self.nat_port = kwargs.get("nat_port", None)
+        self.nat_bridge_shards = kwargs.get("nat_bridge_shards", 1)
+        self.nat_splice = kwargs.get("nat_splice", False)
+        self.nat_mode = kwargs.get("nat_mode", "thread")
+        self.rpc_port = kwargs.get("rpc_port", None)
         self.watch_config = kwargs.get("watch_config", True)
         self.watch_configs = kwargs.get("watch_configs", False)
         self.log = kwargs.get("log", logging.getLogger(__name__))
@@ -100,13 +129,33 @@ class Park(object):
                          port=self.port,
                          nat_port=self.nat_port,
                          log=self.log,
-                         reconnect=self.zk_reconnect
+                         reconnect=self.zk_reconnect,
+                         rpc_port=self.rpc_port
                          )
         self.zk.start()
 
+        health_table.configure(max_failures=kwargs.get("breaker_failures", None),
+                               error_rate=kwargs.get("breaker_error_rate", None),
+                               backoff=kwargs.get("breaker_backoff", None),
+                               max_backoff=kwargs.get("breaker_max_backoff", None))
+
         self.json_to_cls = JsonTo
-        self.rest = Rest(self.zk, max_pool_num=10, rest_base_url=self.rest_base_url)
+        self.rest = Rest(self.zk, max_pool_num=10, rest_base_url=self.rest_base_url,
+                         service_pool_num=kwargs.get("service_pool_num", 20))
+        self.rest.prefer_rpc = kwargs.get("prefer_rpc", True)
+        self.rest.compress_min_size = kwargs.get("compress_min_size", COMPRESS_MIN_SIZE)
+        self.hedger = Hedger(self.rest, percentile=kwargs.get("hedge_percentile", 95),
+                             budget_ratio=kwargs.get("hedge_budget_ratio", 0.1),
+                             pool_num=kwargs.get("hedge_pool_num", 100))
+        self.async_rest = AsyncRest(max_clients=kwargs.get("async_max_clients", 1000), json_cls=self.json_to_cls,
+                                    timeout=self.rpc_timeout)
         self.handlers = []
+        self.batch_max_items = kwargs.get("batch_max_items", 100)
+        self.batch_max_wait = kwargs.get("batch_max_wait", 0.005)
+        self.batchers = {}
+        # key:method value:ResultCache
+        self.caches = {}
+        self.batchers_lock = threading.Lock()
 
         # 配置中心
         self.config = Config(self.zk, self.watch_config, self.watch_configs)
@@ -117,7 +166,9 @@ class Park(object):
 
         if self.nat_port:
             self.slavers.append(Slaver(target_addr=f"{self.ip}:{self.port}", nat_port=self.nat_port,
-                                       get=self.call, rest_base_url=self.rest_base_url))
+                                       get=self.call, rest_base_url=self.rest_base_url,
+                                       bridge_shards=self.nat_bridge_shards, splice=self.nat_splice,
+                                       mode=self.nat_mode))
 
         if self.debug:
             try:
@@ -169,41 +220,153 @@ class Park(object):
 
         return decorate
 
-    def register(self, obj):
-        return self.rest.register(obj)
+    def register(self, obj=None, **kwargs):
+        return self.rest.register(obj, **kwargs)
 
     def zk_reconnect(self):
         self.config = Config(self.zk, self.watch_config, self.watch_configs)
-        self.zk.register_rest_service(self.rest.services)
+        self.zk.register_rest_service(self.rest.services, meta=self.rest.services_meta())
         self.log.warning("断线重连完成")
 
     def lock(self, key="lock", data="") -> Lock:
         return Lock(zk=self.zk, key=key, data=data)
 
     def call(self, method, data, hosts=None, **kwargs):
+        """
+        调用服务
+        :param kwargs: codec 编解码器; hedge 是否对冲, 默认按服务注册的幂等属性; cache 已开启缓存的方法是否使用缓存, 默认True
+        """
+        cache = self.caches.get(method, None)
+        if cache is not None and kwargs.pop("cache", True):
+            key = make_key(method, data, tuple(hosts) if isinstance(hosts, (list, tuple)) else hosts, kwargs.get("codec", None))
+            return cache.get_or_call(key, lambda: self.__call(method, data, hosts, **kwargs))
+        return self.__call(method, data, hosts, **kwargs)
+
+    def __call(self, method, data, hosts=None, **kwargs):
+        if hosts is None:
+            hosts = health_table.filter(self.zk.get_rest_nodes(method))
+        if isinstance(hosts, (list, tuple)):
+            hedge = kwargs.get("hedge", None)
+            if hedge is None and len(hosts) > 1:
+                # 幂等属性按节点登记, 只在登记为幂等的节点间对冲
+                hedge_hosts = self.zk.get_capable_hosts(method, hosts, "Idempotent")
+            else:
+                hedge_hosts = hosts if hedge else []
+            if len(hedge_hosts) > 1:
+                return self.hedger.call(method, data, hedge_hosts, codec=kwargs.get("codec", None))
+            hosts = random.choice(hosts)
+
+        return self.rest.call(method=method, data=data, hosts=hosts, codec=kwargs.get("codec", None))
+
+    def cache(self, method, ttl=60, max_size=1024) -> ResultCache:
+        """
+        开启只读服务的客户端结果缓存, 服务调用bump_cache_version后所有节点的缓存失效
+        :param ttl: 过期秒数
+        :param max_size: 最大缓存条数
+        """
+        cache = self.caches.get(method, None)
+        if cache is None:
+            cache = ResultCache(max_size=max_size, ttl=ttl, should_cache=is_success)
+            self.caches[method] = cache
+            self.zk.watch_cache_version(method, cache.invalidate)
+        return cache
+
+    def bump_cache_version(self, method):
+        """服务数据变化后调用, 通知所有客户端清空该方法的缓存"""
+        self.zk.bump_cache_version(method)
+
+    def batch_call(self, method, data, **kwargs):
+        """
+        合并调用, 短时间内对同一方法的多次调用合并为一个请求, 服务需以batch注册, 否则退化为call
+        合并发送时返回Result的字典形式, 发送失败时也是字典
+        :param kwargs: codec 编解码器
+        """
+        if not self.zk.get_capable_hosts(method, self.zk.get_rest_nodes(method), "Batch"):
+            # 没有登记了Batch的节点
+            return self.call(method, data, **kwargs)
+        return self.batcher(method, codec=kwargs.get("codec", None)).call(data)
+
+    def batcher(self, method, codec=None) -> Batcher:
+        key = (method, codec)
+        batcher = self.batchers.get(key, None)
+        if batcher is None:
+            with self.batchers_lock:
+                batcher = self.batchers.get(key, None)
+                if batcher is None:
+                    def send(items):
+                        # 发送时再选主机, 保证熔断和节点变化及时生效; 列表请求只发给登记了Batch的节点
+                        hosts = self.zk.get_capable_hosts(method, self.zk.get_rest_nodes(method), "Batch")
+                        if not hosts:
+                            raise NoServiceException(f"没有支持批量调用的服务节点-{method}")
+                        host = random.choice(health_table.filter(hosts))
+                        return self.rest.call_batch(method, items, host, codec=codec)
+
+                    batcher = Batcher(send, max_items=self.batch_max_items, max_wait=self.batch_max_wait,
+                                      executor=self.rest.threadPool, name=f"batcher-{method}")
+                    self.batchers[key] = batcher
+        return batcher
+
+    def call_all(self, method, data, hosts=None, codec=None, mode=FanOut.ALL, n=None, timeout=None):
+        """
+        调用多个主机
+        :param mode: FanOut.ALL 全部结果列表, FanOut.FIRST 第一个成功的结果(用于幂等查询对冲),
+                     FanOut.QUORUM n个成功结果列表, FanOut.ANY 最先完成的n个结果列表
+        :param n: QUORUM默认过半, ANY默认1
+        :param timeout: 总超时秒数
+        """
+        if hosts is None or len(hosts) == 0:
+            hosts = health_table.filter(self.zk.get_rest_nodes(method))
+        return self.rest.call(method=method, data=data, hosts=hosts, codec=codec, mode=mode, n=n, timeout=timeout)
+
+    def call_stream(self, method, data, hosts=None, stream=StreamMode.NDJSON, **kwargs):
+        """调用流式服务, data为分块或记录的迭代器, 返回响应迭代器"""
         if hosts is None:
-            hosts = self.zk.get_rest_nodes(method)
-        if isinstance(hosts, list):
+            hosts = health_table.filter(self.zk.get_rest_nodes(method))
+        if isinstance(hosts, (list, tuple)):
             hosts = random.choice(hosts)
 
-        return self.rest.call(method=method, data=data, hosts=hosts)
+        return self.rest.call_stream(method=method, data=data, host=hosts, stream=stream,
+                                     cut_start_end=kwargs.get("cut_start_end", None))
+
+    async def acall(self, method, data, hosts=None, **kwargs):
+        """异步调用, 需在ioloop中await"""
+        if hosts is None:
+            hosts = health_table.filter(self.zk.get_rest_nodes(method))
+        if isinstance(hosts, (list, tuple)):
+            hosts = random.choice(hosts)
 
-    def call_all(self, method, data, hosts=None) -> list:
+        return await self.async_rest.call(method=method, data=data, hosts=hosts, codec=kwargs.get("codec", None))
+
+    async def acall_all(self, method, data, hosts=None, codec=None, mode=FanOut.ALL, n=None, timeout=None):
         if hosts is None or len(hosts) == 0:
-            hosts = self.zk.get_rest_nodes(method)
-        return self.rest.call(method=method, data=data, hosts=hosts)
+            hosts = health_table.filter(self.zk.get_rest_nodes(method))
+        return await self.async_rest.call(method=method, data=data, hosts=hosts, codec=codec, mode=mode, n=n,
+                                          timeout=timeout)
+
+    @staticmethod
+    def host_health() -> dict:
+        """客户端主机熔断状态 key:host"""
+        return health_table.snapshot()
+
+    @staticmethod
+    def compress_stats() -> dict:
+        """每个端点压缩前后的字节数, 服务端key为服务路径, 客户端key为host/method"""
+        return compress_stats.snapshot()
 
-    def add_nat(self, nat_port, target_addr):
+    def add_nat(self, nat_port, target_addr, bridge_shards=None):
         self.slavers.append(Slaver(target_addr=target_addr, nat_port=nat_port,
-                                   get=self.call))
+                                   get=self.call, rest_base_url=self.rest_base_url,
+                                   bridge_shards=bridge_shards or self.nat_bridge_shards,
+                                   splice=self.nat_splice, mode=self.nat_mode))
 
     def run(self):
         atexit.register(self.close)
-        self.zk.register_rest_service(services=self.rest.services)
+        self.zk.register_rest_service(services=self.rest.services, meta=self.rest.services_meta())
         print_infos(self)
         try:
             self.rest.json_cls = self.json_to_cls
-            self.rest.run("0.0.0.0" if self.broadcast else self.ip, self.port, self.handlers)
+            self.rest.run("0.0.0.0" if self.broadcast else self.ip, self.port, self.handlers,
+                          rpc_port=self.rpc_port)
 
 
 
@@ -213,7 +376,12 @@ class Park(object):
 
     def close(self):
         try:
+            for batcher in list(self.batchers.values()):
+                batcher.close()
             self.zk.close()
+            self.rest.rpc_client.close()
             self.rest.close()
+            self.async_rest.close()
+            self.hedger.close()
         except Exception:
             pass
@@ -1,13 +1,28 @@
-import re
+import time
 
 import yaml
+from kazoo.protocol.states import EventType, KazooState
+from kazoo.recipe.watchers import ChildrenWatch, DataWatch
 
+from PyPark.compress import accept_encoding
 from PyPark.util.net import date_to_str
-from PyPark.util.zk_util import path_join
+from PyPark.util.zk_util import path_join, parse_rest_node, compile_pattern
 from PyPark.zk import ZK
 
 ZK_REST_PATH_NAME = "RestServices"
+ZK_CACHE_PATH_NAME = "CacheVersions"
 PARK_HOSTS = {}
+# 读取服务节点数据的超时秒数
+NODE_INFO_TIMEOUT = 10
+
+
+def parse_node_info(data) -> dict:
+    """服务节点数据(yaml), 无法解析时返回空字典"""
+    try:
+        info = yaml.safe_load(data or b"")
+    except yaml.YAMLError:
+        info = None
+    return info if isinstance(info, dict) else {}
 
 
 class ParkZK(ZK):
@@ -21,60 +36,235 @@ class ParkZK(ZK):
                  port,
                  nat_port,
                  log=None,
-                 reconnect=None):
+                 reconnect=None,
+                 rpc_port=None):
         super().__init__(zk_host, zk_name, rest_base_url, zk_auth_data, log, reconnect)
         self.group = group
         self.zk_name = zk_name
         self.ip = ip
         self.port = port
         self.nat_port = nat_port
+        self.rpc_port = rpc_port
+        # 本地服务发现缓存 key:method value:子节点列表, 由ChildrenWatch维护
+        self.rest_nodes = {}
+        # key:method value:tuple(RestNode), 节点变化时解析一次
+        self.rest_routes = {}
+        # key:method value:(rest_routes, {(group, host, ex_myself): 主机列表})
+        self.rest_filters = {}
+        # 会话丢失后递增, 旧的watch发现代数不一致时自动失效
+        self.rest_nodes_generation = 0
+        self.rest_nodes_stats = {"hits": 0, "misses": 0, "refreshes": 0, "invalidations": 0}
+        # 服务节点信息 key:method value:{host: dict(RPC端口/支持的压缩算法/服务属性)}
+        # 由ChildrenWatch在节点变化时加载, 节点数据由watch更新, 查询时不访问ZK
+        self.rest_node_info = {}
+
+    def connect_listener(self, state):
+        super().connect_listener(state)
+        if state in (KazooState.LOST, KazooState.CONNECTED):
+            self.invalidate_rest_nodes()
+
+    def invalidate_rest_nodes(self):
+        """清空服务发现缓存, 下次查询时重新建立watch"""
+        # 在kazoo连接线程中调用, 不能加锁等待
+        self.rest_nodes_generation += 1
+        self.rest_node_info = {}
+        if self.rest_nodes:
+            self.rest_nodes = {}
+            self.rest_routes = {}
+            self.rest_filters = {}
+            self.rest_nodes_stats["invalidations"] += 1
 
-    def register_rest_service(self, services):
+    def register_rest_service(self, services, meta=None):
+        """
+        :param services: key:url
+        :param meta: 服务属性 key:url value:dict, 与RPC端口等一起写入本节点的临时节点, 各节点可以不同
+        """
+        meta = meta or {}
         for key in list(services.keys()):
             path = path_join(ZK_REST_PATH_NAME, key)
             self.mkdir(path)
             temp_path = path_join("/", path, f"[{self.group}]{self.ip}:{self.port}")
             http_url = f"""http://{self.ip}:{self.port}/{path.lstrip("/" + ZK_REST_PATH_NAME)}"""
             nat_http_url = f"""http://nat_address:{self.nat_port}/{path.lstrip("/" + ZK_REST_PATH_NAME)}"""
-            self.setTemp(temp_path, yaml.dump({
+            info = dict(meta.get(key, {}))
+            info.update({
                 "PID": self.pid,
                 "IP": self.ip,
                 "Rest Port": self.port,
                 "NAT Rest Port": self.nat_port,
+                "RPC Port": self.rpc_port,
+                "Accept-Encoding": accept_encoding(),
                 "Rest URL": http_url,
                 "NAT Rest URL": nat_http_url
-            }), pass_error=True)
+            })
+            self.setTemp(temp_path, yaml.dump(info), pass_error=True)
 
         self.set(ZK_REST_PATH_NAME, date_to_str())
 
-    def get_rest_nodes(self, method, group=None, host=None, ex_myself=False):
-        nodes = self.get_nodes(path=path_join(ZK_REST_PATH_NAME, method))
-        r_nodes = []
-        for n in nodes:
-            n_group = re.search("\[.*?\]", n)[0][1:-1]
-            n_host = re.search(r'\].*$', n)[0][1:]
-            if group:
-                if re.match(group, n_group):
-                    r_nodes.append(n_host)
+    def get_rest_children(self, method):
+        """获取服务子节点, 命中缓存时不访问ZK"""
+        nodes = self.rest_nodes.get(method, None)
+        if nodes is not None:
+            self.rest_nodes_stats["hits"] += 1
+            return nodes
+        self.rest_nodes_stats["misses"] += 1
+        return self.__watch_rest_nodes(method)
+
+    def __watch_rest_nodes(self, method):
+        path = path_join(self.zk_name, ZK_REST_PATH_NAME, method)
+        with self.lock:
+            nodes = self.rest_nodes.get(method, None)
+            if nodes is not None:
+                return nodes
+            if not self.zk.exists(path):
+                # 服务还未注册, 不缓存
+                return []
+            generation = self.rest_nodes_generation
+
+            def refresh(children):
+                if generation != self.rest_nodes_generation:
+                    # 会话已失效, 停止该watch
+                    return False
+                routes = tuple(parse_rest_node(n) for n in children)
+                # 先加载节点信息再发布节点, 新节点不会短暂地被当作没有登记任何属性
+                self.rest_node_info[method] = self.__load_node_infos(method, routes, generation)
+                self.rest_routes[method] = routes
+                self.rest_nodes[method] = list(children)
+                self.rest_nodes_stats["refreshes"] += 1
+
+            ChildrenWatch(self.zk, path, refresh, allow_session_lost=False)
+            return self.rest_nodes.get(method, [])
+
+    def get_rest_routes(self, method):
+        """解析后的服务节点 tuple(RestNode)"""
+        routes = self.rest_routes.get(method, None)
+        if routes is not None:
+            self.rest_nodes_stats["hits"] += 1
+            return routes
+        self.get_rest_children(method)
+        return self.rest_routes.get(method, ())
+
+    def __load_node_infos(self, method, routes, generation) -> dict:
+        """已知节点沿用之前的信息, 新节点并行读取, 只影响该方法"""
+        known = self.rest_node_info.get(method, {})
+        infos = {}
+        pending = []
+        for node in routes:
+            info = known.get(node.host, None)
+            if info is not None:
+                infos[node.host] = info
             else:
-                r_nodes.append(n_host)
-
-        h_nodes = []
-        for n in r_nodes:
-            if host:
-                if re.match(host, n):
-                    if ex_myself:
-                        if n == f"{self.ip}:{self.port}":
-                            continue
-                        h_nodes.append(n)
-                    else:
-                        if ex_myself:
-                            if n == f"{self.ip}:{self.port}":
-                                continue
-                        h_nodes.append(n)
+                pending.append((node.host, self.__fetch_node_info(method, node, generation)))
+        for host, result in pending:
+            try:
+                infos[host] = parse_node_info(result.get(timeout=NODE_INFO_TIMEOUT)[0])
+            except Exception as e:
+                # 节点已删除或读取超时, 按未登记属性处理
+                self.log.debug(f"读取服务节点信息失败 {method} {host}: {e}")
+                infos[host] = {}
+        return infos
+
+    def __fetch_node_info(self, method, node, generation):
+        """异步读取节点数据, 并在数据变化时更新缓存"""
+        path = path_join(self.zk_name, ZK_REST_PATH_NAME, method, node.name)
+
+        def changed(event):
+            if generation != self.rest_nodes_generation or event.type not in (EventType.CHANGED, EventType.DELETED):
+                return
+            # 节点删除后可能已按相同名称重建(服务重启), 重新读取并继续监听
+            self.__fetch_node_info(method, node, generation).rawlink(stored)
+
+        def stored(result):
+            infos = self.rest_node_info.get(method, None)
+            if infos is None or node.host not in infos:
+                return
+            if result.successful():
+                infos[node.host] = parse_node_info(result.value[0])
             else:
-                if n == f"{self.ip}:{self.port}":
-                    continue
-                h_nodes.append(n)
+                # 节点已不存在, 重建时由ChildrenWatch重新读取
+                infos.pop(node.host, None)
+
+        return self.zk.get_async(path, watch=changed)
 
-        return h_nodes
+    def get_node_info(self, method, host) -> dict:
+        """服务节点登记的信息, 不是已发现的节点时返回空字典"""
+        infos = self.rest_node_info.get(method, None)
+        if infos is None:
+            # 还没有发现过该服务, 建立watch时一并加载
+            self.get_rest_children(method)
+            infos = self.rest_node_info.get(method, None)
+            if infos is None:
+                return {}
+        return infos.get(host, None) or {}
+
+    def get_capable_hosts(self, method, hosts, capability):
+        """hosts中登记了服务属性capability(如Idempotent/Batch)的节点, 旧版本节点视为不支持"""
+        return [h for h in hosts if self.get_node_info(method, h).get(capability, False)]
+
+    def is_idempotent(self, method, host):
+        return bool(self.get_node_info(method, host).get("Idempotent", False))
+
+    def is_batch(self, method, host):
+        return bool(self.get_node_info(method, host).get("Batch", False))
+
+    def get_rpc_port(self, method, host):
+        """服务节点登记的RPC端口, 未开启时返回None"""
+        return self.get_node_info(method, host).get("RPC Port", None)
+
+    def get_accept_encoding(self, method, host):
+        """服务节点支持的请求压缩算法, 旧版本节点返回None"""
+        return self.get_node_info(method, host).get("Accept-Encoding", None)
+
+    def get_compress_min_size(self, method, host):
+        """服务节点要求的请求压缩阈值, 未设置时返回None"""
+        return self.get_node_info(method, host).get("CompressMinSize", None)
+
+    def watch_cache_version(self, method, fn):
+        """
+        监听服务的缓存版本, 版本变化或会话重连时调用fn
+        节点不存在时同样监听, 服务首次发布版本后触发
+        """
+        path = path_join(self.zk_name, ZK_CACHE_PATH_NAME, method)
+
+        def changed(data, stat):
+            fn()
+
+        DataWatch(self.zk, path, changed)
+
+    def bump_cache_version(self, method):
+        self.set(path_join(ZK_CACHE_PATH_NAME, method), str(time.time()))
+
+    def get_rest_nodes(self, method, group=None, host=None, ex_myself=False):
+        """
+        按分组/主机正则过滤服务节点, 结果按过滤条件缓存到节点变化为止
+        返回共享的不可变tuple, 节点未变化时为同一对象
+        """
+        routes = self.get_rest_routes(method)
+        entry = self.rest_filters.get(method, None)
+        if entry is None or entry[0] is not routes:
+            # 节点已变化, 旧的过滤结果作废
+            entry = (routes, {})
+            self.rest_filters[method] = entry
+        key = (group, host, ex_myself)
+        nodes = entry[1].get(key, None)
+        if nodes is None:
+            nodes = entry[1][key] = self.__filter_rest_nodes(routes, group, host, ex_myself)
+        return nodes
+
+    def __filter_rest_nodes(self, routes, group, host, ex_myself):
+        myself = f"{self.ip}:{self.port}"
+        group_match = compile_pattern(group) if group else None
+        host_match = compile_pattern(host) if host else None
+        nodes = []
+        for node in routes:
+            if group_match is not None and not group_match(node.group):
+                continue
+            if host_match is not None:
+                if not host_match(node.host):
+                    continue
+                if ex_myself and node.host == myself:
+                    continue
+            elif node.host == myself:
+                continue
+            nodes.append(node.host)
+        return tuple(nodes)
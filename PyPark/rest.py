@@ -1,43 +1,72 @@
 """
 Park service
 """
+import asyncio
+import collections.abc
 import inspect
-import json
 import logging
+import weakref
 from abc import ABC
-from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 
 import requests
 import tornado.ioloop
+import tornado.locks
+import tornado.queues
 import tornado.web
 from requests.adapters import HTTPAdapter
-from tornado import gen
-from tornado.concurrent import run_on_executor
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
 
-from PyPark.cons import CONTENT_TYPE
+try:
+    # 有pycurl时使用curl客户端, 支持每个host的keep-alive连接复用
+    import pycurl
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    pycurl = None
+    CurlAsyncHTTPClient = None
+
+from PyPark.breaker import health_table, LIMITED_HEADER
+from PyPark.compress import COMPRESS_MIN_SIZE, accept_encoding, choose_encoding, compress, decompress, \
+    compress_stats
+from PyPark.codec import get_codec, codec_for_content_type, codec_for_accept, mime_type
+from PyPark.cons import CONTENT_TYPE, StreamMode, FanOut, StatusCode
 from PyPark.park_exception import ServiceException
 from PyPark.result import Result
+from PyPark.rpc import RpcClient, RpcConnectError, RpcServer
 from PyPark.util.zk_util import path_join
 
 
 class Rest:
-    def __init__(self, zk, rest_base_url, max_pool_num, json_cls=None, timeout=30):
+    def __init__(self, zk, rest_base_url, max_pool_num, json_cls=None, timeout=30, service_pool_num=20):
         self.zk = zk
         self.json_cls = json_cls
         self.services = {}
+        # key:url value:ServiceRoute, 注册时预编译的调用信息
+        self.routes = {}
+        self.service_executor = ThreadPoolExecutor(max_workers=service_pool_num)
         self.rest_base_url = rest_base_url
         self.threadPool = ThreadPoolExecutor(max_workers=max_pool_num)
         self.s_request = requests.Session()
         self.s_request.mount('http://',
                              HTTPAdapter(pool_connections=max_pool_num, pool_maxsize=max_pool_num, max_retries=3))
         self.timeout = timeout
+        # 服务端开启二进制RPC时优先使用
+        self.prefer_rpc = True
+        # 服务默认压缩阈值, None不压缩
+        self.compress_min_size = COMPRESS_MIN_SIZE
+        self.rpc_client = RpcClient(timeout=timeout)
 
     def __make(self, handlers):
         apps = []
         Handler.app = self
-        Handler.services = self.services
+        Handler.routes = self.routes
+        Handler.executor = self.service_executor
+        for route in self.routes.values():
+            # json_cls可能在register之后才设置
+            route.json_cls = self.json_cls
         for url in list(self.services.keys()):
-            apps.append((url, Handler))
+            apps.append((url, StreamHandler if self.routes[url].stream else Handler))
         apps += handlers
         return tornado.web.Application(apps)
 
@@ -48,12 +77,48 @@ class Rest:
         except Exception:
             pass
 
-    def run(self, ip, port, handlers):
+    def run(self, ip, port, handlers, rpc_port=None):
         app = self.__make(handlers)
         app.listen(address=ip, port=port)
+        if rpc_port:
+            RpcServer(self.__serve_rpc).listen(rpc_port, address=ip)
         tornado.ioloop.IOLoop.current().start()
 
-    def register(self, path=None):
+    async def __serve_rpc(self, request):
+        route = self.routes.get(request.path, None)
+        if route is None:
+            return 404, {"Content-Type": CONTENT_TYPE.TEXT}, f"{request.path} 服务不存在".encode("utf-8")
+        if route.stream:
+            return 400, {"Content-Type": CONTENT_TYPE.TEXT}, f"{request.path} 流式服务不支持RPC调用".encode("utf-8")
+        try:
+            status, result = await serve_route(route, request, self.service_executor)
+        except Exception as e:
+            logging.exception(e)
+            status, result = 200, Result.error(code=500, msg=str(e))
+        encoded = encode_result(route, result, request.headers.get("Accept", ""))
+        headers = {LIMITED_HEADER: "1"} if status == 503 else {}
+        if encoded is None:
+            return status, headers, b""
+        headers["Content-Type"] = encoded[0]
+        body, encoding = compress_response(route, encoded[1], request.headers.get("Accept-Encoding", None))
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return status, headers, body
+
+    def register(self, path=None, max_concurrency=None, queue_size=None, codec=None, stream=None,
+                 idempotent=False, batch=None, compress_min_size=None):
+        """
+        注册服务, 支持同步函数和async def
+        :param path: 服务路径, 默认为函数名
+        :param max_concurrency: 该服务最大并发数, 默认不限制
+        :param queue_size: 超过并发数后最多排队的请求数, 默认不限制, 超出返回503
+        :param codec: 客户端Accept未指定编解码器时的响应编码, 默认JSON
+        :param stream: 流式服务 StreamMode.CHUNK/StreamMode.NDJSON, 服务的body参数为分块(或记录)迭代器,
+                       同步服务为普通迭代器, async服务为异步迭代器; 返回迭代器时逐块响应
+        :param idempotent: 幂等服务, 注册到ZK后客户端可对慢请求发送备份请求
+        :param batch: 接收客户端合并的批量请求, True 逐条调用服务, 传入函数则整批调用(参数为列表, 返回等长列表)
+        :param compress_min_size: 响应超过该字节数时按客户端Accept-Encoding压缩, 小于0不压缩, 默认使用Rest.compress_min_size
+        """
         if callable(path):
             rest_path = path.__name__
         else:
@@ -61,10 +126,15 @@ class Rest:
 
         def decorate(fn):
             # 加上默认路径
-            a = '/' + path_join(self.rest_base_url, rest_path)
+            a = '/' + path_join(self.rest_base_url, rest_path or fn.__name__)
             if a.startswith("//"):
                 a = a[1:]
             if self.services.get(a, None) is None:
+                limiter = ServiceLimiter(max_concurrency, queue_size) if max_concurrency else None
+                min_size = self.compress_min_size if compress_min_size is None else compress_min_size
+                self.routes[a] = ServiceRoute(a, fn, json_cls=self.json_cls, limiter=limiter, codec=codec,
+                                              stream=stream, idempotent=idempotent, batch=batch,
+                                              compress_min_size=min_size)
                 self.services[a] = fn
             return fn
 
@@ -72,95 +142,693 @@ class Rest:
             decorate(path)
         return decorate
 
-    def __requests(self, host, method, data):
+    def services_meta(self):
+        """注册到ZK的服务属性 key:url"""
+        meta = {}
+        for url, route in self.routes.items():
+            m = {}
+            if route.idempotent:
+                m["Idempotent"] = True
+            if route.batch:
+                m["Batch"] = True
+            if route.compress_min_size is not None and route.compress_min_size >= 0:
+                # 客户端请求体超过该字节数时压缩
+                m["CompressMinSize"] = route.compress_min_size
+            if m:
+                meta[url] = m
+        return meta
+
+    def __post(self, host, method, data, headers):
+        """
+        发送请求, 服务节点开启RPC时走RPC, 否则走HTTP; 按双方支持的算法压缩请求和响应
+        :return: (状态码, Content-Type, 解压后的数据)
+        """
+        endpoint = f"{host}/{method}"
+        headers["Accept-Encoding"] = accept_encoding()
+        raw_size = len(data)
+        if self.zk is not None:
+            data, encoding = compress(data, choose_encoding(self.zk.get_accept_encoding(method, host)),
+                                      self.zk.get_compress_min_size(method, host))
+            if encoding:
+                headers["Content-Encoding"] = encoding
+            compress_stats.add(endpoint, raw_size, len(data), encoding)
+        rpc_host = self.rpc_host(host, method)
+        health_table.on_request(host)
+        try:
+            if rpc_host is not None:
+                try:
+                    status_code, r_headers, content = self.rpc_client.request(rpc_host, f"/{method}", headers, data)
+                except RpcConnectError as e:
+                    # RPC端口连不上时请求还未发出, 改走HTTP
+                    logging.debug(f"{e}, 改用HTTP")
+                    rpc_host = None
+            if rpc_host is None:
+                r = self.s_request.post(f"http://{host}/{method}", data=data, headers=headers, timeout=self.timeout,
+                                        stream=True)
+                # 自行解压, 以统计传输字节数并支持requests不支持的算法
+                status_code, r_headers, content = r.status_code, r.headers, r.raw.read(decode_content=False)
+            content_type, encoding = r_headers.get("Content-Type", ""), r_headers.get("Content-Encoding", None)
+            wire_size = len(content)
+            content = decompress(content, encoding)
+        except Exception:
+            health_table.on_failure(host)
+            raise
+        compress_stats.add(endpoint, len(content), wire_size, encoding)
+        health_table.on_response(host, status_code, r_headers)
+        return status_code, content_type, content
+
+    def __requests(self, host, method, data, codec=None):
+        codec = get_codec(codec, self.json_cls)
+        content_type, data = encode_data(data, codec)
+        headers = {"Content-Type": content_type, "Accept": codec.content_type}
+        status_code, content_type, content = self.__post(host, method, data, headers)
+        if status_code == 200:
+            return decode_response(content_type, content)
+        else:
+            text = content.decode("utf-8", "replace")
+            return Result.error(code=str(status_code), msg=f"call {host}/{method} error: {text}", data=text)
+
+    def rpc_host(self, host, method):
+        """服务节点在ZK中登记了RPC端口时返回RPC地址, 否则返回None走HTTP"""
+        if not self.prefer_rpc or self.zk is None:
+            return None
+        rpc_port = self.zk.get_rpc_port(method, host)
+        if not rpc_port:
+            return None
+        return f"{host.rsplit(':', 1)[0]}:{rpc_port}"
+
+    def call(self, method, data, hosts=None, codec=None, mode=FanOut.ALL, n=None, timeout=None):
+        """
+        :param mode: 多主机调用模式, 见FanOut
+        :param n: QUORUM/ANY模式需要的结果数
+        :param timeout: 多主机调用的总超时秒数, 到期按已完成的结果返回
+        """
+        if isinstance(hosts, str):
+            return self.__requests(hosts, method, data, codec)
+        elif isinstance(hosts, (list, tuple)):
+            if len(hosts) == 1 and mode == FanOut.ALL:
+                return self.__requests(hosts[0], method, data, codec)
+            collector = FanOutCollector(hosts, mode, n)
+            all_task = {}
+            for index, h in enumerate(hosts):
+                all_task[self.threadPool.submit(self.__requests, h, method, data, codec)] = index
+            try:
+                for task in as_completed(all_task, timeout=timeout):
+                    if collector.add(all_task[task], task.exception() or task.result()):
+                        break
+            except FuturesTimeoutError:
+                pass
+            finally:
+                # 取消不再需要的请求, collector.add抛出异常时也要取消
+                for task in all_task:
+                    task.cancel()
+            return collector.result()
+
+    def call_batch(self, method, items, host, codec=None):
+        """批量调用, 服务需以batch注册, 返回与items等长的结果列表"""
+        codec = get_codec(codec, self.json_cls)
+        headers = {"Content-Type": codec.content_type, "Accept": codec.content_type, BATCH_HEADER: "1"}
+        status_code, content_type, content = self.__post(host, method, codec.dumps(items), headers)
+        if status_code != 200:
+            raise ServiceException(f"call {host}/{method} error: {content.decode('utf-8', 'replace')}")
+        result = decode_response(content_type, content)
+        if not isinstance(result, dict) or not result.get("is_success", False):
+            raise ServiceException(f"call {host}/{method} error: {result}")
+        if len(result["data"]) != len(items):
+            raise ServiceException(f"call {host}/{method} error: 批量结果数量不一致")
+        return result["data"]
+
+    def call_stream(self, method, data, host, stream=StreamMode.NDJSON, cut_start_end=None):
+        """
+        调用流式服务, 请求体以chunked方式发送, 返回响应的分块(或记录)迭代器
+        :param data: 可迭代的分块(bytes/str)或记录
+        """
+        url = f"http://{host}/{method}"
+        headers = {"Content-Type": STREAM_CONTENT_TYPE[stream]}
+        if cut_start_end is not None:
+            headers["__CUT_DATA_START_END"] = cut_start_end
+        body = encode_stream(data, stream, get_codec(None, self.json_cls))
+        r = self.s_request.post(url, data=body, headers=headers, timeout=self.timeout, stream=True)
+        with r:
+            if r.status_code != 200:
+                raise ServiceException(f"call {host}/{method} error: {r.text}")
+            content_type = mime_type(r.headers.get("Content-Type", ""))
+            if content_type == mime_type(STREAM_CONTENT_TYPE[StreamMode.NDJSON]):
+                codec = get_codec("json")
+                for line in r.iter_lines():
+                    if line:
+                        yield codec.loads(line)
+            elif content_type == mime_type(STREAM_CONTENT_TYPE[StreamMode.CHUNK]):
+                for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    yield chunk
+            else:
+                yield decode_response(content_type, r.content)
+
+
+class AsyncRest:
+    """
+    基于Tornado AsyncHTTPClient的异步客户端, 返回结果与Rest.call一致
+    在ioloop中调用, 并发请求不占用额外线程
+    安装了pycurl时使用CurlAsyncHTTPClient, 否则使用SimpleAsyncHTTPClient
+    """
+
+    def __init__(self, max_clients=100, json_cls=None, timeout=30):
+        self.max_clients = max_clients
+        self.json_cls = json_cls
+        self.timeout = timeout
+        # 每个ioloop一个私有客户端, 不修改AsyncHTTPClient的全局配置
+        self.__clients = weakref.WeakKeyDictionary()
+
+    @property
+    def client(self) -> AsyncHTTPClient:
+        io_loop = tornado.ioloop.IOLoop.current()
+        client = self.__clients.get(io_loop)
+        if client is None:
+            client_cls = CurlAsyncHTTPClient if pycurl is not None else SimpleAsyncHTTPClient
+            client = client_cls(force_instance=True, max_clients=self.max_clients)
+            self.__clients[io_loop] = client
+        return client
+
+    def close(self):
+        for client in list(self.__clients.values()):
+            client.close()
+        self.__clients.clear()
+
+    async def __requests(self, host, method, data, codec=None):
         url = f"http://{host}/{method}"
-        headers = self.s_request.headers
-        headers["Content-Type"] = CONTENT_TYPE.TEXT
-        if isinstance(data, int):
-            data = str(data)
-        if isinstance(data, str):
-            data = data.encode("utf-8")
+        codec = get_codec(codec, self.json_cls)
+        content_type, body = encode_data(data, codec)
+        headers = {"Content-Type": content_type, "Accept": codec.content_type, "Accept-Encoding": accept_encoding()}
+        request = HTTPRequest(url, method="POST", body=body, headers=headers, decompress_response=False,
+                              connect_timeout=self.timeout, request_timeout=self.timeout)
+        health_table.on_request(host)
+        r = await self.client.fetch(request, raise_error=False)
+        health_table.on_response(host, r.code, r.headers)
+        if r.code == 599:
+            # 连接失败/超时
+            raise r.error
+        encoding = r.headers.get("Content-Encoding", None)
+        content = decompress(r.body or b"", encoding)
+        compress_stats.add(f"{host}/{method}", len(content), len(r.body or b""), encoding)
+        if r.code == 200:
+            return decode_response(r.headers.get("Content-Type", ""), content)
+        text = str(content, encoding="utf-8")
+        return Result.error(code=str(r.code), msg=f"call {host}/{method} error: {text}", data=text)
+
+    async def call(self, method, data, hosts=None, codec=None, mode=FanOut.ALL, n=None, timeout=None):
+        if isinstance(hosts, str):
+            return await self.__requests(hosts, method, data, codec)
+        elif isinstance(hosts, (list, tuple)):
+            if mode == FanOut.ALL and timeout is None:
+                return list(await asyncio.gather(*[self.__requests(h, method, data, codec) for h in hosts]))
+            collector = FanOutCollector(hosts, mode, n)
+            pending = {asyncio.ensure_future(self.__requests(h, method, data, codec)): i for i, h in enumerate(hosts)}
+            loop = asyncio.get_running_loop()
+            deadline = None if timeout is None else loop.time() + timeout
+            try:
+                while pending:
+                    wait_time = None if deadline is None else max(deadline - loop.time(), 0)
+                    done, _ = await asyncio.wait(pending, timeout=wait_time, return_when=asyncio.FIRST_COMPLETED)
+                    if not done:
+                        break
+                    finished = False
+                    for task in done:
+                        index = pending.pop(task)
+                        finished = collector.add(index, task.exception() or task.result()) or finished
+                    if finished:
+                        break
+            finally:
+                for task in pending:
+                    task.cancel()
+            return collector.result()
+
+
+class FanOutCollector:
+    """
+    多主机调用的结果收集, add返回True时表示已经可以返回, 剩余请求可取消
+    ALL: 按主机顺序返回全部结果
+    FIRST: 返回第一个成功的结果, 全部失败返回最后一个错误
+    QUORUM: 返回最先成功的n个结果(默认过半), 无法达到时返回错误
+    ANY: 返回最先完成的n个结果(默认1个), 不区分成功失败
+    """
+
+    def __init__(self, hosts, mode=FanOut.ALL, n=None):
+        if mode not in (FanOut.ALL, FanOut.FIRST, FanOut.QUORUM, FanOut.ANY):
+            raise ServiceException(f"不支持的调用模式-{mode}")
+        self.hosts = hosts
+        self.mode = mode
+        if n is None:
+            n = len(hosts) // 2 + 1 if mode == FanOut.QUORUM else 1
+        self.n = min(n, len(hosts))
+        self.results = [None] * len(hosts)
+        self.completed = []
+        self.success = []
+        self.errors = []
+
+    def add(self, index, result):
+        if isinstance(result, Exception):
+            if self.mode == FanOut.ALL:
+                raise result
+            result = Result.error(code=StatusCode.SYSTEM_ERROR, msg=f"{self.hosts[index]}: {result}")
+        self.results[index] = result
+        self.completed.append(result)
+        if is_success(result):
+            self.success.append(result)
         else:
-            headers["Content-Type"] = CONTENT_TYPE.JSON
-            data = json.dumps(data, cls=self.json_cls)
-        r = self.s_request.post(url, data=data, headers=headers, timeout=self.timeout)
-        if r.status_code == 200:
-            if headers["Content-Type"] in CONTENT_TYPE.JSON:
-                return r.json()
+            self.errors.append(result)
+        if self.mode == FanOut.ALL:
+            return len(self.completed) == len(self.hosts)
+        if self.mode == FanOut.FIRST:
+            return len(self.success) > 0
+        if self.mode == FanOut.QUORUM:
+            # 已达到, 或剩余的主机全部成功也达不到
+            return len(self.success) >= self.n or len(self.hosts) - len(self.errors) < self.n
+        return len(self.completed) >= self.n
+
+    def result(self):
+        if self.mode == FanOut.ALL:
+            return self.results
+        if self.mode == FanOut.FIRST:
+            if self.success:
+                return self.success[0]
+            if self.errors:
+                return self.errors[-1]
+            return Result.error(code=StatusCode.SYSTEM_ERROR, msg="no result before timeout")
+        if self.mode == FanOut.QUORUM:
+            if len(self.success) >= self.n:
+                return self.success[:self.n]
+            msg = " | ".join(str(e.get("msg", "") if isinstance(e, dict) else e.msg) for e in self.errors)
+            return Result.error(msg=f"quorum {len(self.success)}/{self.n} {msg}", data=self.completed)
+        return self.completed[:self.n]
+
+
+def is_success(result):
+    """Result对象或其JSON字典判断是否成功, 其他类型(文本)视为成功"""
+    if isinstance(result, Result):
+        return result.is_success
+    if isinstance(result, dict):
+        return result.get("is_success", True)
+    return True
+
+
+def encode_data(data, codec):
+    """请求数据编码, 返回(Content-Type, body)"""
+    if isinstance(data, int):
+        data = str(data)
+    if isinstance(data, str):
+        return CONTENT_TYPE.TEXT, data.encode("utf-8")
+    return codec.content_type, codec.dumps(data)
+
+
+def decode_response(content_type, body):
+    """按响应Content-Type解码, 非编解码器类型按文本返回"""
+    codec = codec_for_content_type(content_type)
+    if codec is not None:
+        return codec.loads(body)
+    return str(body, encoding="utf-8")
+
+
+# 批量请求标记, body为请求数据列表
+BATCH_HEADER = "__BATCH"
+# ServiceRoute.args未传body时从请求中解码
+_BODY = object()
+
+STREAM_CONTENT_TYPE = {
+    StreamMode.CHUNK: "application/octet-stream",
+    StreamMode.NDJSON: "application/x-ndjson",
+}
+# 请求体排队的最大分块数, 超过后暂停读取socket
+STREAM_QUEUE_SIZE = 16
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_MAX_BODY_SIZE = 100 * 1024 ** 3
+
+
+def encode_stream(data, stream, codec):
+    """流式数据编码, NDJSON每条记录一行"""
+    for d in data:
+        if stream == StreamMode.NDJSON:
+            yield codec.dumps(d) + b"\n"
+        elif isinstance(d, str):
+            yield d.encode("utf-8")
         else:
-            return Result.error(code=str(r.status_code), msg=f"call {host}/{method} error: {r.text}", data=r.text)
+            yield d
 
-    def call(self, method, data, hosts=None):
-        if isinstance(hosts, str):
-            return self.__requests(hosts, method, data)
-        elif isinstance(hosts, list):
-            if len(hosts) == 1:
-                return self.__requests(hosts[0], method, data)
-            all_task = []
-            for h in hosts:
-                all_task.append(self.threadPool.submit(self.__requests, h, method, data))
-            wait(all_task, return_when=FIRST_COMPLETED)
-            results = []
-            for result in all_task:
-                results.append(result.result())
-            return results
+
+class LineBuffer:
+    """把分块拆成完整的行, 不完整的行留到下一块"""
+
+    def __init__(self):
+        self.rest = b""
+
+    def feed(self, chunk):
+        lines = (self.rest + chunk).split(b"\n")
+        self.rest = lines.pop()
+        return [line for line in lines if line.strip()]
+
+    def close(self):
+        rest, self.rest = self.rest, b""
+        return [rest] if rest.strip() else []
+
+
+class ServiceLimiter:
+    """
+    单个服务的并发限制, 超过max_concurrency的请求排队, 排队数超过queue_size直接拒绝
+    只在ioloop线程中使用
+    """
+
+    def __init__(self, max_concurrency, queue_size=None):
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.semaphore = tornado.locks.Semaphore(max_concurrency)
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def is_full(self):
+        return self.queue_size is not None and self.running >= self.max_concurrency \
+               and self.waiting >= self.queue_size
+
+    async def __aenter__(self):
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.running -= 1
+        self.semaphore.release()
+
+
+class ServiceRoute:
+    """
+    服务调用信息, 注册时解析一次函数签名, 处理请求时不再反射
+    参数个数: 0 无参数, 1 body, 2 body和切片(start, end), 3 body、切片和headers
+    """
+
+    def __init__(self, path, fn, json_cls=None, limiter=None, codec=None, stream=None, idempotent=False,
+                 batch=None, compress_min_size=None):
+        self.path = path
+        self.fn = fn
+        self.compress_min_size = compress_min_size
+        self.idempotent = idempotent
+        self.batch = batch
+        self.json_cls = json_cls
+        self.limiter = limiter
+        self.codec = get_codec(codec) if codec is not None else None
+        if stream is not None and stream not in STREAM_CONTENT_TYPE:
+            raise ServiceException(f"{fn.__name__} 不支持的流模式-{stream}")
+        self.stream = stream
+        self.num = len(inspect.getfullargspec(fn).args)
+        if self.num > 3:
+            raise ServiceException(f"{fn.__name__} 参数定义错误 ")
+        self.is_async = inspect.iscoroutinefunction(fn) or inspect.isasyncgenfunction(fn)
+        self.is_async_batch = callable(batch) and inspect.iscoroutinefunction(batch)
+
+    def args(self, request, body=_BODY):
+        if self.num == 0:
+            return ()
+        if body is _BODY:
+            body = decode_body(request)
+        if self.num == 1:
+            return (body,)
+        cut = parse_cut(request.headers)
+        if self.num == 2:
+            return body, cut
+        return body, cut, request.headers
+
+    def response_codec(self, accept):
+        """按Accept协商响应编码, 与服务默认编码同类型时使用服务默认编码(保留json_cls)"""
+        default = self.codec or get_codec(None, self.json_cls)
+        codec = codec_for_accept(accept)
+        if codec is None or mime_type(codec.content_type) == mime_type(default.content_type):
+            return default
+        return codec
+
+
+def decode_body(request):
+    content_type = request.headers.get("Content-Type", "")
+    # 未带Content-Type时与旧版本一致按JSON解析, 空请求体为None
+    codec = codec_for_content_type(content_type) if content_type else get_codec("json")
+    if codec is not None:
+        return codec.loads(request.body)
+    return str(request.body, encoding='utf-8')
+
+
+def parse_cut(headers):
+    cut_start, cut_end = headers.get("__CUT_DATA_START_END", '0-0').split("-")
+    return int(cut_start), int(cut_end)
+
+
+def batch_item(result):
+    """批量结果中的单条, 与单独调用时客户端得到的结果一致"""
+    if isinstance(result, Exception):
+        return Result.error(code=500, msg=str(result)).__dict__
+    if isinstance(result, Result):
+        return result.__dict__
+    return result
+
+
+async def serve_route(route, request, executor):
+    """
+    按服务的并发限制执行服务, HTTP与RPC传输共用
+    :return: (状态码, 结果), 503表示被该服务的并发限制拒绝
+    """
+    decompress_request(route, request)
+    limiter = route.limiter
+    if limiter is None:
+        return 200, await invoke_route(route, request, executor)
+    if limiter.is_full():
+        limiter.rejected += 1
+        return 503, Result.error(code=503, msg=f"{request.path} 服务繁忙")
+    async with limiter:
+        return 200, await invoke_route(route, request, executor)
+
+
+async def invoke_route(route, request, executor):
+    if route.batch and request.headers.get(BATCH_HEADER, None):
+        return await invoke_batch(route, request, executor)
+    if route.is_async:
+        # 异步服务直接在ioloop中执行
+        return await route.fn(*route.args(request))
+    return await tornado.ioloop.IOLoop.current().run_in_executor(executor, lambda: route.fn(*route.args(request)))
+
+
+async def invoke_batch(route, request, executor):
+    items = decode_body(request) or []
+    if callable(route.batch):
+        # 整批调用
+        if route.is_async_batch:
+            results = await route.batch(items)
+        else:
+            results = await tornado.ioloop.IOLoop.current().run_in_executor(executor, route.batch, items)
+        if len(results) != len(items):
+            raise ServiceException(f"{route.path} 批量结果数量不一致")
+    elif route.is_async:
+        results = await asyncio.gather(*[route.fn(*route.args(request, item)) for item in items],
+                                       return_exceptions=True)
+    else:
+        results = await tornado.ioloop.IOLoop.current().run_in_executor(executor, invoke_sync_batch, route, request,
+                                                                       items)
+    return Result.success([batch_item(r) for r in results])
+
+
+def invoke_sync_batch(route, request, items):
+    results = []
+    for item in items:
+        try:
+            results.append(route.fn(*route.args(request, item)))
+        except Exception as e:
+            logging.exception(e)
+            results.append(e)
+    return results
+
+
+def decompress_request(route, request):
+    encoding = request.headers.get("Content-Encoding", None)
+    if encoding:
+        wire_size = len(request.body)
+        request.body = decompress(request.body, encoding)
+        compress_stats.add(route.path, len(request.body), wire_size, encoding)
+
+
+def compress_response(route, body, accept_encodings):
+    """按客户端Accept-Encoding压缩响应, 返回(数据, Content-Encoding)"""
+    data, encoding = compress(body, choose_encoding(accept_encodings), route.compress_min_size)
+    compress_stats.add(route.path, len(body), len(data), encoding)
+    return data, encoding
+
+
+def encode_result(route, result, accept):
+    """服务结果编码, 返回(Content-Type, body), 无结果时返回None"""
+    if result is None:
+        return None
+    if isinstance(result, Result):
+        codec = route.response_codec(accept)
+        return codec.content_type, codec.dumps(result.__dict__)
+    return "text/html; charset=UTF-8", str(result).encode("utf-8")
 
 
 class Handler(tornado.web.RequestHandler, ABC):
-    executor = ThreadPoolExecutor(20)  # 起线程池，由当前RequestHandler持有
-    services = {}
+    executor = ThreadPoolExecutor(20)  # 同步服务线程池, 由Rest按service_pool_num替换
+    routes = {}
     app: Rest = None
 
-    @run_on_executor
-    def _do_request(self):
+    async def _do_request(self):
         try:
             # self.set_header("Access-Control-Allow-Origin", "*")
             # self.set_header("Access-Control-Allow-Headers", "x-requested-with")
             # self.set_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
-            method = Handler.services.get(self.request.path, None)
-            args = inspect.getfullargspec(method)
-            num = len(args.args)
-            contentType = self.request.headers.get("Content-Type", "").lower()
-            if contentType in CONTENT_TYPE.JSON:
-                if len(self.request.body) == 0:
-                    body = None
-                else:
-                    body = json.loads(str(self.request.body, encoding='utf-8'))
+            route = Handler.routes[self.request.path]
+            status, result = await serve_route(route, self.request, self.executor)
+            if status != 200:
+                self.set_status(status)
+                self.set_header(LIMITED_HEADER, "1")
+                self.write(result.__dict__)
+                return
+            self._write_result(route, result)
+        except Exception as e:
+            logging.exception(e)
+            self.write(Result.error(code=500, msg=str(e)).__dict__)
+
+    def _write_result(self, route, result):
+        encoded = encode_result(route, result, self.request.headers.get("Accept", ""))
+        if encoded is not None:
+            self.set_header("Content-Type", encoded[0])
+            body, encoding = compress_response(route, encoded[1], self.request.headers.get("Accept-Encoding", None))
+            if encoding:
+                self.set_header("Content-Encoding", encoding)
+                self.set_header("Vary", "Accept-Encoding")
+            self.write(body)
+
+    async def get(self):
+        await self._do_request()
+
+    async def post(self):
+        await self._do_request()
+
+
+@tornado.web.stream_request_body
+class StreamHandler(Handler):
+    """
+    流式服务, 请求体边接收边交给服务处理, 响应逐块flush, 内存占用与数据总量无关
+    服务在prepare中启动, 读取请求体的速度受服务消费速度限制
+    """
+
+    async def prepare(self):
+        self.route = Handler.routes[self.request.path]
+        self.request.connection.set_max_body_size(STREAM_MAX_BODY_SIZE)
+        self.chunks = tornado.queues.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.body_done = False
+        self.task = asyncio.ensure_future(self._serve())
+
+    async def data_received(self, chunk):
+        await self.chunks.put(chunk)
+
+    async def _do_request(self):
+        await self.chunks.put(None)
+        await self.task
+
+    async def _next_chunk(self):
+        if self.body_done:
+            return None
+        chunk = await self.chunks.get()
+        if chunk is None:
+            self.body_done = True
+        return chunk
+
+    async def _aiter_body(self):
+        lines = LineBuffer() if self.route.stream == StreamMode.NDJSON else None
+        while True:
+            chunk = await self._next_chunk()
+            if chunk is None:
+                break
+            if lines is None:
+                yield chunk
+            else:
+                for line in lines.feed(chunk):
+                    yield self._load_line(line)
+        if lines is not None:
+            for line in lines.close():
+                yield self._load_line(line)
+
+    def _iter_body(self, loop):
+        """在服务线程中使用, 从ioloop的队列中取分块"""
+        lines = LineBuffer() if self.route.stream == StreamMode.NDJSON else None
+        while True:
+            chunk = asyncio.run_coroutine_threadsafe(self._next_chunk(), loop).result()
+            if chunk is None:
+                break
+            if lines is None:
+                yield chunk
             else:
-                body = str(self.request.body, encoding='utf-8')
-            if num == 0:
-                result = method()
-            elif num == 1:
-                result = method(body)
-            elif num == 2:
-                cut_data = self.request.headers.get("__CUT_DATA_START_END", '0-0')
-                cut_start, cut_end = cut_data.split("-")
-                result = method(body, (int(cut_start), int(cut_end)))
-            elif num == 3:
-                cut_data = self.request.headers.get("__CUT_DATA_START_END", '0-0')
-                cut_start, cut_end = cut_data.split("-")
-                result = method(body, (int(cut_start), int(cut_end)), self.request.headers)
+                for line in lines.feed(chunk):
+                    yield self._load_line(line)
+        if lines is not None:
+            for line in lines.close():
+                yield self._load_line(line)
+
+    @staticmethod
+    def _load_line(line):
+        return get_codec("json").loads(line)
+
+    async def _serve(self):
+        route = self.route
+        try:
+            loop = asyncio.get_running_loop()
+            if route.limiter is not None and route.limiter.is_full():
+                route.limiter.rejected += 1
+                self.set_status(503)
+                self.set_header(LIMITED_HEADER, "1")
+                self.write(Result.error(code=503, msg=f"{self.request.path} 服务繁忙").__dict__)
+            elif route.limiter is None:
+                await self._serve_route(route, loop)
             else:
-                msg = f"{method.__name__} 参数定义错误 "
-                raise ServiceException(msg)
-            if result is not None:
-                if isinstance(result, Result):
-                    self.set_header("Content-Type", CONTENT_TYPE.JSON)
-                    self.write(
-                        json.dumps(result.__dict__, cls=Handler.app.json_cls))
-                else:
-                    self.write(str(result))
+                async with route.limiter:
+                    await self._serve_route(route, loop)
         except Exception as e:
             logging.exception(e)
-            self.write(Result.error(code=500, msg=str(e)).__dict__)
+            if self._headers_written:
+                # 已开始响应, 断开连接让客户端感知响应不完整
+                self.request.connection.close()
+            else:
+                self.clear()
+                self.write(Result.error(code=500, msg=str(e)).__dict__)
         finally:
-            # self.finish()
-            pass
+            # 丢弃服务未读取的请求体, 否则请求无法结束
+            while await self._next_chunk() is not None:
+                pass
 
-    @gen.coroutine
-    def get(self):
-        yield self._do_request()
+    async def _serve_route(self, route, loop):
+        if route.is_async:
+            result = route.fn(*route.args(self.request, self._aiter_body()))
+            if inspect.isawaitable(result):
+                result = await result
+        else:
+            result = await loop.run_in_executor(self.executor, lambda: route.fn(
+                *route.args(self.request, self._iter_body(loop))))
 
-    @gen.coroutine
-    def post(self):
-        yield self._do_request()
+        if isinstance(result, collections.abc.AsyncIterator):
+            self.set_header("Content-Type", STREAM_CONTENT_TYPE[route.stream])
+            async for item in result:
+                await self._write_item(item)
+        elif isinstance(result, collections.abc.Iterator):
+            self.set_header("Content-Type", STREAM_CONTENT_TYPE[route.stream])
+            end = object()
+            while True:
+                item = await loop.run_in_executor(self.executor, next, result, end)
+                if item is end:
+                    break
+                await self._write_item(item)
+        else:
+            self._write_result(route, result)
+
+    async def _write_item(self, item):
+        if self.route.stream == StreamMode.NDJSON:
+            self.write(get_codec(None, self.route.json_cls).dumps(item) + b"\n")
+        elif isinstance(item, str):
+            self.write(item.encode("utf-8"))
+        else:
+            self.write(item)
+        await self.flush()
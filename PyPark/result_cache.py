@@ -0,0 +1,94 @@
+"""
+客户端进程内结果缓存
+只用于只读服务, 按 方法+请求数据 缓存调用结果, LRU淘汰并带过期时间
+相同key的并发未命中只调用一次服务, 其余调用方等待同一个结果
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from PyPark.util.json_to import JsonTo
+
+
+def make_key(method, data, *extra):
+    """方法+序列化后的请求数据, dict按key排序, 保证相同数据得到相同的key"""
+    if isinstance(data, (str, int)):
+        body = str(data)
+    else:
+        body = json.dumps(data, cls=JsonTo, sort_keys=True, separators=(",", ":"))
+    return (method, body) + extra
+
+
+class ResultCache:
+    """
+    :param max_size: 最大缓存条数, 超出淘汰最久未使用的
+    :param ttl: 过期秒数
+    :param should_cache: should_cache(result) 为False的结果不缓存, 如调用失败
+    """
+
+    def __init__(self, max_size=1024, ttl=60, should_cache=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.should_cache = should_cache
+        # key --> (过期时间, 结果)
+        self.data = OrderedDict()
+        # key --> Future, 正在调用的请求
+        self.flights = {}
+        # 失效后递增, 失效前发出的请求结果不再写入
+        self.version = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "shared": 0, "evictions": 0, "invalidations": 0}
+
+    def get_or_call(self, key, fn):
+        now = time.monotonic()
+        leader = False
+        with self.lock:
+            item = self.data.get(key, None)
+            if item is not None:
+                if item[0] > now:
+                    self.data.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return item[1]
+                del self.data[key]
+            future = self.flights.get(key, None)
+            if future is not None:
+                self.stats["shared"] += 1
+            else:
+                self.stats["misses"] += 1
+                future = self.flights[key] = Future()
+                version = self.version
+                leader = True
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            with self.lock:
+                self.__done(key, future)
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.__done(key, future)
+            if version == self.version and (self.should_cache is None or self.should_cache(result)):
+                self.data[key] = (time.monotonic() + self.ttl, result)
+                self.data.move_to_end(key)
+                while len(self.data) > self.max_size:
+                    self.data.popitem(last=False)
+                    self.stats["evictions"] += 1
+        future.set_result(result)
+        return result
+
+    def __done(self, key, future):
+        if self.flights.get(key, None) is future:
+            del self.flights[key]
+
+    def invalidate(self, *args):
+        """清空缓存, 参数兼容ZK watch回调"""
+        with self.lock:
+            self.version += 1
+            self.data.clear()
+            # 正在进行的请求可能读到旧数据, 之后的调用不再等待它们
+            self.flights = {}
+            self.stats["invalidations"] += 1
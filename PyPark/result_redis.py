@@ -1,58 +1,213 @@
 import json
+import math
+import random
+import time
 from functools import wraps
 
 import redis
 
+from PyPark.codec import get_codec
+from PyPark.result_cache import ResultCache
+
+
+def cache_key(data, s_key=None, key_type=str):
+    """从请求数据中取缓存的key"""
+    key = None
+    if key_type == str and s_key is None:
+        key = data
+    elif key_type == dict:
+        if s_key is None:
+            key = json.loads(data)
+        else:
+            if isinstance(s_key, str):
+                key = data[s_key]
+            else:
+                key = ""
+                for s in s_key:
+                    key += "_" + data[s]
+    if key is None:
+        raise Exception("缓存结果的key不能为空")
+    return key
+
+
+def escape_pattern(key):
+    """转义SCAN MATCH的通配符"""
+    return "".join("\\" + c if c in "*?[]\\" else c for c in str(key))
+
 
 class ResultRedis:
-    def __init__(self, host, password, port=6379, db=0):
-        self.__redis_pool = redis.ConnectionPool(host=host, port=port, db=db, password=password)
+    """
+    Redis结果缓存, 每条结果一个key(服务key:结果key), 用SET EX单独过期, 过期的结果由Redis清理
+    过期时间与计算耗时也存在值里, 临近过期时按概率提前刷新(XFetch), 避免同时过期后大量请求击穿到服务
+    旧版本写入的服务hash仍会读取, 直到其自身过期
+    :param client: redis客户端, 传入时忽略连接参数, 测试时可传入fakeredis
+    :param serializer: 序列化器, 名称(json/orjson/msgpack)或有dumps/loads的对象, 默认json
+    :param l1_size: 进程内一级缓存条数, 0不开启; 一级缓存中相同key的并发未命中只访问一次Redis
+    :param l1_ttl: 一级缓存过期秒数
+    :param beta: 提前刷新系数, 越大越早刷新, 0不提前刷新
+    """
+
+    def __init__(self, host=None, password=None, port=6379, db=0, client=None, serializer=None, l1_size=0,
+                 l1_ttl=1, beta=1.0):
+        if client is None:
+            client = redis.Redis(connection_pool=redis.ConnectionPool(host=host, port=port, db=db,
+                                                                      password=password))
+        self.redis = client
+        self.serializer = get_codec(serializer)
+        self.l1 = ResultCache(max_size=l1_size, ttl=l1_ttl) if l1_size else None
+        self.beta = beta
 
     def cache(self, m_key=None, s_key=None, key_type=str, timeout=10):
         def decorator(func):
+            main_key = m_key or func.__name__
+
             @wraps(func)
             def wrapper(data):
-                key = None
-                if key_type == str and s_key is None:
-                    key = data
-                elif key_type == dict:
-                    if s_key is None:
-                        key = json.loads(data)
-                    else:
-                        if isinstance(s_key, str):
-                            key = data[s_key]
-                        else:
-                            key = ""
-                            for s in s_key:
-                                key += "_" + data[s]
-                if key is None:
-                    raise Exception("缓存结果的key不能为空")
-                main_key = m_key or func.__name__
-                r = redis.Redis(connection_pool=self.__redis_pool)
-                d = r.hget(main_key, key)
-                if d:
-                    res = json.loads(d)['result']
-                    return res
-                res = func(data)
-                d = json.dumps({'result': res})
-                r.hset(main_key, key, d)
-                print("set...")
-                r.expire(main_key, timeout)
-                return res
+                key = cache_key(data, s_key, key_type)
+                if self.l1 is None:
+                    return self.get_or_call(main_key, key, lambda: func(data), timeout)
+                return self.l1.get_or_call((main_key, key),
+                                           lambda: self.get_or_call(main_key, key, lambda: func(data), timeout))
+
+            def clear_cache():
+                self.clear_cache(main_key)
 
             setattr(func, "clear_cache", clear_cache)
+            setattr(wrapper, "clear_cache", clear_cache)
             return wrapper
 
-        def clear_cache():
-            print("清空", m_key, s_key)
-            self.clear_cache(m_key, s_key)
+        return decorator
+
+    def cache_many(self, m_key=None, timeout=10):
+        """
+        批量缓存, 被装饰的函数参数为key列表, 返回等长的结果列表
+        只对未命中的key调用一次函数, 返回结果与key顺序一致; 不经过一级缓存
+        """
+
+        def decorator(func):
+            main_key = m_key or func.__name__
+
+            @wraps(func)
+            def wrapper(keys):
+                return self.get_many_or_call(main_key, keys, func, timeout)
+
+            def clear_cache():
+                self.clear_cache(main_key)
+
+            setattr(func, "clear_cache", clear_cache)
+            setattr(wrapper, "clear_cache", clear_cache)
+            return wrapper
 
         return decorator
 
+    @staticmethod
+    def entry_key(m_key, key):
+        return f"{m_key}:{key}"
+
+    def read(self, m_key, keys) -> list:
+        """一次往返读取多条结果(MGET, 以及旧版本的服务hash), 返回解析后的值, 不存在的位置为None"""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.mget([self.entry_key(m_key, k) for k in keys])
+        pipe.hmget(m_key, keys)
+        values, legacy = pipe.execute(raise_on_error=False)
+        if isinstance(values, Exception):
+            raise values
+        if isinstance(legacy, Exception):
+            # m_key已被其他服务的结果key占用, 不是hash
+            legacy = [None] * len(keys)
+        return [self.loads(v) if v else self.loads(old) for v, old in zip(values, legacy)]
+
+    def get_many(self, m_key, keys) -> list:
+        """一次往返读取多条结果, 未命中(或需要提前刷新)的位置为None"""
+        keys = list(keys)
+        if not keys:
+            return []
+        now = time.time()
+        return [None if e is None or self.should_refresh(e, now) else e for e in self.read(m_key, keys)]
+
+    def get_many_or_call(self, m_key, keys, fn, timeout=10) -> list:
+        """
+        :param fn: fn(未命中的key列表) -> 等长的结果列表
+        """
+        keys = list(keys)
+        entries = self.get_many(m_key, keys)
+        results = [None if e is None else e["r"] for e in entries]
+        # 重复的key只计算一次
+        missing = list(dict.fromkeys(k for k, e in zip(keys, entries) if e is None))
+        if not missing:
+            return results
+        start = time.time()
+        values = fn(missing)
+        if len(values) != len(missing):
+            raise Exception("批量缓存函数返回的结果数量与key数量不一致")
+        delta = (time.time() - start) / len(missing)
+        computed = dict(zip(missing, values))
+        self.write(m_key, {k: self.dumps(v, delta, timeout) for k, v in computed.items()}, timeout)
+        for i, (k, e) in enumerate(zip(keys, entries)):
+            if e is None:
+                results[i] = computed[k]
+        return results
+
+    def get_or_call(self, m_key, key, fn, timeout=10):
+        """读取缓存, 未命中或需要提前刷新时调用fn并写入"""
+        entry = self.read(m_key, [key])[0]
+        if entry is not None and not self.should_refresh(entry, time.time()):
+            return entry["r"]
+        start = time.time()
+        result = fn()
+        self.write(m_key, {key: self.dumps(result, time.time() - start, timeout)}, timeout)
+        return result
+
+    def should_refresh(self, entry, now):
+        expire = entry.get("e", None)
+        if expire is None:
+            return False
+        # 计算越慢、越接近过期, 越可能提前刷新; 1-random()避免log(0)
+        return now - entry.get("d", 0) * self.beta * math.log(1.0 - random.random()) >= expire
+
+    def dumps(self, result, delta, timeout):
+        """r:结果 e:过期时间 d:计算耗时"""
+        return self.serializer.dumps({"r": result, "e": time.time() + timeout, "d": delta})
+
+    def loads(self, data):
+        """解析缓存值, 不存在或无法解析时返回None"""
+        if not data:
+            return None
+        try:
+            entry = self.serializer.loads(data)
+        except Exception:
+            return None
+        if not isinstance(entry, dict):
+            return None
+        if "r" not in entry:
+            # 旧版本格式 {"result": ...}, 由hash的过期时间控制
+            if "result" not in entry:
+                return None
+            return {"r": entry["result"]}
+        return entry
+
+    def write(self, m_key, mapping, timeout):
+        """一次往返写入多条结果, 每条结果单独SET EX, 互不影响过期时间"""
+        ex = max(int(math.ceil(timeout)), 1)
+        pipe = self.redis.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(self.entry_key(m_key, key), value, ex=ex)
+        pipe.execute()
+
     def clear_cache(self, m_key, s_key=None):
-        r = redis.Redis(connection_pool=self.__redis_pool)
         if s_key is None:
-            r.delete(m_key)
+            # 旧版本的服务hash与全部结果key
+            self.redis.delete(m_key)
+            keys = []
+            for key in self.redis.scan_iter(match=escape_pattern(m_key) + ":*", count=500):
+                keys.append(key)
+                if len(keys) >= 500:
+                    self.redis.delete(*keys)
+                    keys = []
+            if keys:
+                self.redis.delete(*keys)
         else:
-            r.hdel(m_key, s_key)
-        print("11清空", m_key, s_key)
+            self.redis.delete(self.entry_key(m_key, s_key))
+            self.redis.hdel(m_key, s_key)
+        if self.l1 is not None:
+            self.l1.invalidate()
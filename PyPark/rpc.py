@@ -0,0 +1,237 @@
+"""
+二进制RPC传输
+长连接上按长度前缀分帧, 每帧带请求ID, 一个连接上可以同时有多个请求在途, 响应可乱序返回
+帧格式: | 帧长度 4B | 请求ID 4B | 帧类型 1B | 头长度 2B | 头(JSON) | 数据 |
+帧长度不含自身的4个字节, 头与HTTP头含义相同, 请求头中":path"为服务路径, 响应头中":status"为状态码
+"""
+import itertools
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FuturesTimeoutError
+
+from tornado.httputil import HTTPHeaders
+from tornado.iostream import StreamClosedError
+from tornado.tcpserver import TCPServer
+
+FRAME_HEADER = struct.Struct("!IIBH")
+# 帧长度之后的固定部分: 请求ID + 帧类型 + 头长度
+FRAME_FIXED_SIZE = FRAME_HEADER.size - 4
+FRAME_REQUEST = 1
+FRAME_RESPONSE = 2
+RPC_MAX_FRAME_SIZE = 256 * 1024 ** 2
+# 连接失败后多少秒内不再重试, 期间直接抛出RpcConnectError
+RPC_CONNECT_RETRY_DELAY = 5
+
+
+class RpcConnectError(ConnectionError):
+    """建立RPC连接失败, 请求还未发出, 调用方可以改走HTTP"""
+
+
+def pack_frame(request_id, kind, headers: dict, body: bytes) -> bytes:
+    head = json.dumps(headers, separators=(",", ":")).encode("utf-8")
+    return FRAME_HEADER.pack(FRAME_FIXED_SIZE + len(head) + len(body), request_id, kind, len(head)) + head + body
+
+
+def unpack_payload(payload, head_size):
+    """帧头之后的部分拆成(头, 数据), 头不是JSON对象时抛出ValueError"""
+    headers = json.loads(bytes(payload[:head_size]))
+    if not isinstance(headers, dict):
+        raise ValueError("RPC帧头不是JSON对象")
+    return headers, bytes(payload[head_size:])
+
+
+class RpcRequest:
+    """服务端收到的请求, 提供与HTTP请求相同的path/headers/body供ServiceRoute使用"""
+
+    def __init__(self, headers: dict, body: bytes):
+        self.path = headers.pop(":path", "/")
+        self.headers = HTTPHeaders(headers)
+        self.body = body
+
+
+class RpcServer(TCPServer):
+    """
+    与HTTP服务共用ioloop
+    :param handle: async handle(request) -> (状态码, 响应头, 数据)
+    """
+
+    def __init__(self, handle, max_frame_size=RPC_MAX_FRAME_SIZE):
+        super().__init__(max_buffer_size=max_frame_size + FRAME_HEADER.size)
+        self.handle = handle
+        self.max_frame_size = max_frame_size
+
+    async def handle_stream(self, stream, address):
+        while True:
+            try:
+                length, request_id, kind, head_size = FRAME_HEADER.unpack(await stream.read_bytes(FRAME_HEADER.size))
+                if length > self.max_frame_size or length < FRAME_FIXED_SIZE + head_size or kind != FRAME_REQUEST:
+                    logging.warning(f"RPC {address} 非法帧, 关闭连接")
+                    stream.close()
+                    return
+                payload = await stream.read_bytes(length - FRAME_FIXED_SIZE)
+            except StreamClosedError:
+                return
+            try:
+                headers, body = unpack_payload(payload, head_size)
+            except ValueError:
+                # JSONDecodeError/UnicodeDecodeError都是ValueError
+                logging.warning(f"RPC {address} 非法帧头, 关闭连接")
+                stream.close()
+                return
+            # 每个请求独立执行, 不阻塞同一连接上的后续请求
+            stream.io_loop.spawn_callback(self.__serve, stream, request_id, RpcRequest(headers, body))
+
+    async def __serve(self, stream, request_id, request):
+        try:
+            status, headers, body = await self.handle(request)
+        except Exception as e:
+            logging.exception(e)
+            status, headers, body = 500, {"Content-Type": "text/plain; charset=UTF-8"}, str(e).encode("utf-8")
+        headers = dict(headers)
+        headers[":status"] = status
+        try:
+            await stream.write(pack_frame(request_id, FRAME_RESPONSE, headers, body or b""))
+        except StreamClosedError:
+            pass
+
+
+class RpcConnection:
+    """到一个主机的长连接, 多线程共用, 读线程按请求ID分发响应"""
+
+    def __init__(self, host, timeout=30):
+        ip, port = host.rsplit(":", 1)
+        self.host = host
+        self.sock = socket.create_connection((ip, int(port)), timeout=timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.closed = False
+        self.th = threading.Thread(target=self.__read_loop, name=f"rpc-{host}")
+        self.th.daemon = True
+        self.th.start()
+
+    def request(self, headers: dict, body: bytes, timeout=None):
+        """
+        :return: (状态码, 响应头, 数据)
+        """
+        request_id = next(self.ids) & 0xFFFFFFFF
+        future = Future()
+        self.pending[request_id] = future
+        if self.closed:
+            self.pending.pop(request_id, None)
+            raise ConnectionError(f"RPC {self.host} 连接已关闭")
+        frame = pack_frame(request_id, FRAME_REQUEST, headers, body)
+        try:
+            with self.send_lock:
+                self.sock.sendall(frame)
+        except OSError as e:
+            self.pending.pop(request_id, None)
+            self.close(e)
+            raise
+        try:
+            return future.result(timeout=timeout)
+        except FuturesTimeoutError:
+            self.pending.pop(request_id, None)
+            raise
+
+    def __recv_exactly(self, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        while size:
+            n = self.sock.recv_into(view[-size:], size)
+            if n == 0:
+                raise ConnectionError(f"RPC {self.host} 连接已关闭")
+            size -= n
+        return buf
+
+    def __read_loop(self):
+        try:
+            while True:
+                length, request_id, kind, head_size = FRAME_HEADER.unpack(self.__recv_exactly(FRAME_HEADER.size))
+                headers, body = unpack_payload(self.__recv_exactly(length - FRAME_FIXED_SIZE), head_size)
+                future = self.pending.pop(request_id, None)
+                if future is not None:
+                    future.set_result((headers.pop(":status", 500), headers, body))
+        except Exception as e:
+            self.close(e)
+
+    def close(self, error=None):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        if not isinstance(error, Exception):
+            error = ConnectionError(f"RPC {self.host} 连接已关闭")
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(error)
+
+
+class RpcClient:
+    """
+    每个主机一个长连接, 断开后下次请求时重连
+    建立连接不持有全局锁, 一个主机连接超时不影响其他主机; 同一主机的并发请求等待同一次连接
+    """
+
+    def __init__(self, timeout=30, retry_delay=RPC_CONNECT_RETRY_DELAY):
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.connections = {}
+        # key:host value:Future 正在建立的连接
+        self.connecting = {}
+        # key:host value:(失败时间, 异常)
+        self.failures = {}
+        self.lock = threading.Lock()
+
+    def connection(self, host) -> RpcConnection:
+        conn = self.connections.get(host, None)
+        if conn is not None and not conn.closed:
+            return conn
+        with self.lock:
+            conn = self.connections.get(host, None)
+            if conn is not None and not conn.closed:
+                return conn
+            failure = self.failures.get(host, None)
+            if failure is not None and time.monotonic() - failure[0] < self.retry_delay:
+                raise RpcConnectError(f"RPC {host} 连接失败: {failure[1]}")
+            future = self.connecting.get(host, None)
+            owner = future is None
+            if owner:
+                future = self.connecting[host] = Future()
+        if not owner:
+            return future.result()
+        try:
+            conn = RpcConnection(host, timeout=self.timeout)
+        except OSError as e:
+            error = RpcConnectError(f"RPC {host} 连接失败: {e}")
+            with self.lock:
+                self.failures[host] = (time.monotonic(), e)
+                self.connecting.pop(host, None)
+            future.set_exception(error)
+            raise error from e
+        with self.lock:
+            self.connections[host] = conn
+            self.failures.pop(host, None)
+            self.connecting.pop(host, None)
+        future.set_result(conn)
+        return conn
+
+    def request(self, host, path, headers: dict, body: bytes):
+        headers = dict(headers)
+        headers[":path"] = path
+        return self.connection(host).request(headers, body, timeout=self.timeout)
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, {}
+        for conn in connections.values():
+            conn.close()
@@ -0,0 +1,515 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+asyncio implementation of shootback master and slaver
+
+Speaks the same CtrlPkg protocol as master.py and slaver.py, so an asyncio
+master works with a threaded slaver and vice versa.
+Accepting, heartbeats and handshakes are coroutines in one event loop,
+every customer gets its own handshake task. Established pairs are handed
+to the SocketBridge as before, so neither spare nor working connections
+need a thread of their own.
+
+select it with:
+    run_master(..., mode="asyncio")     master.py --mode asyncio
+    run_slaver(..., mode="asyncio")     slaver.py --mode asyncio
+"""
+import asyncio
+import math
+
+from PyPark.shootback.common_func import *
+from PyPark.shootback.master import Master, try_bind_port, _listening_sockets
+from PyPark.shootback.slaver import Slaver
+
+
+async def sock_recv_exactly(loop, sock, size):
+    buff = bytearray()
+    while len(buff) < size:
+        data = await loop.sock_recv(sock, size - len(buff))
+        if not data:
+            raise RuntimeError("received zero bytes, socket was closed")
+        buff += data
+    return bytes(buff)
+
+
+async def recv_pkg(loop, sock, timeout=CtrlPkg.CTRL_PKG_TIMEOUT, expect_ptype=None):
+    """coroutine version of CtrlPkg.recv
+    :type sock: socket.socket
+    :rtype: CtrlPkg,bool
+    """
+    buff = await asyncio.wait_for(sock_recv_exactly(loop, sock, CtrlPkg.PACKAGE_SIZE), timeout)
+    return CtrlPkg.decode_verify(buff, pkg_type=expect_ptype)
+
+
+async def _wait_ready(loop, sock, writable):
+    fut = loop.create_future()
+
+    def ready():
+        if not fut.done():
+            fut.set_result(None)
+
+    fd = sock.fileno()
+    if writable:
+        loop.add_writer(fd, ready)
+    else:
+        loop.add_reader(fd, ready)
+    try:
+        await fut
+    finally:
+        if writable:
+            loop.remove_writer(fd)
+        else:
+            loop.remove_reader(fd)
+
+
+async def ssl_wrap(loop, ssl_context, sock, server_side, timeout=CtrlPkg.CTRL_PKG_TIMEOUT):
+    """ssl_context.wrap_socket() without blocking the event loop
+    :rtype: ssl.SSLSocket
+    """
+    ssl_sock = ssl_context.wrap_socket(sock, server_side=server_side, do_handshake_on_connect=False)
+
+    async def handshake():
+        while True:
+            try:
+                ssl_sock.do_handshake()
+                return
+            except ssl.SSLWantReadError:
+                await _wait_ready(loop, ssl_sock, False)
+            except ssl.SSLWantWriteError:
+                await _wait_ready(loop, ssl_sock, True)
+
+    try:
+        await asyncio.wait_for(handshake(), timeout)
+    except:
+        try_close(ssl_sock)
+        raise
+    return ssl_sock
+
+
+class AsyncMaster(Master):
+    """
+    the threads prepared by Master are never started,
+    their jobs are done by the coroutines below
+
+    :param spare_ttl: equals to the --ttl param
+    """
+
+    def __init__(self, customer_listen_addr, communicate_addr=None, slaver_pool=None, *args,
+                 spare_ttl=SPARE_SLAVER_TTL, **kwargs):
+        # Master never fills an external slaver_pool either, and the coroutines
+        #   below listen for slavers themselves, so refuse it before anything is set up
+        if slaver_pool:
+            raise ValueError("AsyncMaster listens for slavers itself, slaver_pool must not be given")
+        super(AsyncMaster, self).__init__(customer_listen_addr, communicate_addr, None, *args, **kwargs)
+        self.spare_ttl = spare_ttl
+        self.loop = None
+        self._slaver_arrived = None  # asyncio.Event, set when a slaver comes in
+        self._tasks = set()  # keep references of running tasks
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self._slaver_arrived = asyncio.Event()
+        self.thread_pool["socket_bridge"] = self.socket_bridge.start_as_daemon()
+
+        sock_slaver = self._bind_listen(self.communicate_addr, socket.SOMAXCONN)
+        log.info("Listening for slavers: {}".format(fmt_addr(self.communicate_addr)))
+        sock_customer = self._bind_listen(self.customer_listen_addr, 20)
+        log.info("Listening for customers: {}".format(fmt_addr(self.customer_listen_addr)))
+
+        await asyncio.gather(
+            self._listen_slaver(sock_slaver),
+            self._listen_customer(sock_customer),
+            self._heart_beat_daemon(),
+        )
+
+    @staticmethod
+    def _bind_listen(addr, backlog):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try_bind_port(sock, addr)
+        sock.listen(backlog)
+        sock.setblocking(False)
+        _listening_sockets.append(sock)
+        return sock
+
+    def _spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _listen_slaver(self, sock):
+        while True:
+            conn, addr = await self.loop.sock_accept(sock)
+            self.slaver_pool.append({
+                "addr_slaver": addr,
+                "conn_slaver": conn,
+            })
+            self._slaver_arrived.set()
+            log.info("Got slaver {} Total: {}".format(
+                fmt_addr(addr), len(self.slaver_pool)
+            ))
+
+    async def _listen_customer(self, sock):
+        while True:
+            conn_customer, addr_customer = await self.loop.sock_accept(sock)
+            log.info("Serving customer: {} Total customers: {}".format(
+                addr_customer, len(self._tasks) + 1
+            ))
+            # handshake in its own task, don't block this loop
+            self._spawn(self._assign_slaver(conn_customer, addr_customer))
+
+    async def _send_heartbeat(self, conn_slaver):
+        """send and verify heartbeat pkg"""
+        await self.loop.sock_sendall(conn_slaver, CtrlPkg.pbuild_heart_beat().raw)
+
+        pkg, verify = await recv_pkg(
+            self.loop, conn_slaver, expect_ptype=CtrlPkg.PTYPE_HEART_BEAT)  # type: CtrlPkg,bool
+
+        if not verify:
+            return False
+
+        if pkg.prgm_ver >= 0x000B:
+            # newer version use TCP-like 3-way heartbeat, see Master._send_heartbeat
+            await self.loop.sock_sendall(conn_slaver, CtrlPkg.pbuild_heart_beat().raw)
+
+        return verify
+
+    async def _heart_beat_daemon(self):
+        """
+        same schedule as Master._heart_beat_daemon, but each round heartbeats
+        enough slavers at once that the whole pool is done within half of the TTL,
+        so thousands of spare slavers can be kept alive
+        """
+        default_delay = 5 + self.spare_ttl // 12
+        delay = default_delay
+        log.info("heart beat daemon start, delay: {}s".format(delay))
+        while True:
+            await asyncio.sleep(delay)
+
+            slaver_count = len(self.slaver_pool)
+            if not slaver_count:
+                log.warning("heart_beat_daemon: sorry, no slaver available, keep sleeping")
+                delay = default_delay
+                continue
+            else:
+                delay = 1 + self.spare_ttl // max(slaver_count * 2 + 1, 12)
+
+            # pop the oldest slavers
+            #   heartbeat them and then put them to the end of queue
+            count = min(slaver_count, max(1, int(math.ceil(slaver_count * delay * 2.0 / self.spare_ttl))))
+            slavers = [self.slaver_pool.popleft() for _ in range(count)]
+            results = await asyncio.gather(*(self._heart_beat_slaver(slaver) for slaver in slavers))
+            if not all(results):
+                # start the next heartbeat immediately, see Master._heart_beat_daemon
+                delay = 0
+            log.debug("socket bridge: {}".format(self.socket_bridge.stats))
+
+    async def _heart_beat_slaver(self, slaver):
+        addr_slaver = slaver["addr_slaver"]
+        start_time = time.perf_counter()
+        try:
+            hb_result = await self._send_heartbeat(slaver["conn_slaver"])
+        except Exception as e:
+            log.warning("error during heartbeat to {}: {}".format(
+                fmt_addr(addr_slaver), repr(e)))
+            log.debug(traceback.format_exc())
+            hb_result = False
+        finally:
+            time_used = round((time.perf_counter() - start_time) * 1000.0, 2)
+
+        if not hb_result:
+            log.warning("heart beat failed: {}, time: {}ms".format(
+                fmt_addr(addr_slaver), time_used))
+            try_close(slaver["conn_slaver"])
+            del slaver["conn_slaver"]
+        else:
+            log.debug("heartbeat success: {}, time: {}ms".format(
+                fmt_addr(addr_slaver), time_used))
+            self.slaver_pool.append(slaver)
+        return hb_result
+
+    async def _handshake(self, conn_slaver):
+        """see Master._handshake
+        :rtype: socket.socket|ssl.SSLSocket|None
+        """
+        await self.loop.sock_sendall(conn_slaver, CtrlPkg.pbuild_hs_m2s(ssl_avail=self.ssl_avail).raw)
+
+        pkg, correct = await recv_pkg(self.loop, conn_slaver, 2, CtrlPkg.PTYPE_HS_S2M)  # type: CtrlPkg,bool
+
+        if not correct:
+            return None
+
+        if not self.ssl_avail or pkg.data[1] == CtrlPkg.SSL_FLAG_NONE:
+            if self.ssl_avail:
+                log.warning('client %s not enabled SSL, fallback to plain.', conn_slaver.getpeername())
+            return conn_slaver
+        else:
+            ssl_conn_slaver = await ssl_wrap(self.loop, self.ssl_context, conn_slaver, server_side=True)
+            log.debug('ssl established slaver: %s', ssl_conn_slaver.getpeername())
+            return ssl_conn_slaver
+
+    async def _get_an_active_slaver(self):
+        """get and activate an slaver for data transfer"""
+        try_count = 100
+        while try_count:
+            try:
+                dict_slaver = self.slaver_pool.popleft()
+            except IndexError:
+                # wait for a new slaver instead of polling
+                self._slaver_arrived.clear()
+                try:
+                    await asyncio.wait_for(self._slaver_arrived.wait(), 0.02)
+                except asyncio.TimeoutError:
+                    try_count -= 1
+                    if try_count % 10 == 0:
+                        log.error("!!NO SLAVER AVAILABLE!!  trying {}".format(try_count))
+                continue
+
+            conn_slaver = dict_slaver["conn_slaver"]
+
+            try:
+                # this returned conn may be ssl-socket or plain socket
+                actual_conn = await self._handshake(conn_slaver)
+            except Exception as e:
+                log.warning("Handshake failed. %s %s", dict_slaver["addr_slaver"], repr(e))
+                log.debug(traceback.format_exc())
+                actual_conn = None
+
+                try_count -= 1
+                if try_count % 10 == 0:
+                    log.error("!!NO SLAVER AVAILABLE!!  trying {}".format(try_count))
+
+            if actual_conn is not None:
+                return actual_conn
+            else:
+                log.warning("slaver handshake failed: %s", dict_slaver["addr_slaver"])
+                try_close(conn_slaver)
+        return None
+
+    async def _assign_slaver(self, conn_customer, addr_customer):
+        """assign slaver for one customer"""
+        try:
+            conn_slaver = await self._get_an_active_slaver()
+        except:
+            log.error('error in getting slaver', exc_info=True)
+            try_close(conn_customer)
+            return
+        if conn_slaver is None:
+            log.warning("Closing customer[%s] because no available slaver found", addr_customer)
+            try_close(conn_customer)
+            return
+        else:
+            log.debug("Using slaver: %s for %s", conn_slaver.getpeername(), addr_customer)
+
+        self.working_pool[addr_customer] = {
+            "addr_customer": addr_customer,
+            "conn_customer": conn_customer,
+            "conn_slaver": conn_slaver,
+        }
+
+        try:
+            self._serve_customer(conn_customer, conn_slaver)
+        except:
+            log.error('error adding to socket_bridge', exc_info=True)
+            self.working_pool.pop(addr_customer, None)
+            try_close(conn_customer)
+            try_close(conn_slaver)
+
+
+class AsyncSlaver(Slaver):
+    """
+    spare slavers wait for master's handshake in coroutines,
+    a new spare connection is made as soon as one leaves the spare pool
+
+    :param spare_ttl: equals to the --ttl param
+    """
+
+    def __init__(self, *args, spare_ttl=SPARE_SLAVER_TTL, **kwargs):
+        super(AsyncSlaver, self).__init__(*args, **kwargs)
+        self.spare_ttl = spare_ttl
+        self.loop = None
+        self._spare_left = None  # asyncio.Event, set when a slaver leaves spare_slaver_pool
+        self._tasks = set()  # keep references of running tasks
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self._spare_left = asyncio.Event()
+        self.socket_bridge.start_as_daemon()
+
+        # see Slaver.serve_forever
+        err_delay = 0
+        max_err_delay = 15
+
+        while True:
+            if len(self.spare_slaver_pool) >= self.max_spare_count:
+                self._spare_left.clear()
+                await self._spare_left.wait()
+                continue
+
+            try:
+                conn_slaver = await self._connect_master()
+            except Exception as e:
+                log.warning("unable to connect master {}".format(e), exc_info=True)
+                await asyncio.sleep(err_delay)
+                if err_delay < max_err_delay:
+                    err_delay += 1
+                else:
+                    raise Exception("Slaver连接不上Master,重新请求Nat")
+                continue
+
+            task = self.loop.create_task(self._slaver_working(conn_slaver))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+            log.info("connected to master[{}] at {} total: {}".format(
+                fmt_addr(conn_slaver.getpeername()),
+                fmt_addr(conn_slaver.getsockname()),
+                len(self.spare_slaver_pool),
+            ))
+
+            err_delay = 0
+
+    async def _connect(self, addr):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await self.loop.sock_connect(sock, addr)
+        except:
+            try_close(sock)
+            raise
+        return sock
+
+    async def _connect_master(self):
+        sock = await self._connect(self.communicate_addr)
+
+        self.spare_slaver_pool[sock.getsockname()] = {
+            "conn_slaver": sock,
+        }
+
+        return sock
+
+    async def _connect_target(self):
+        sock = await self._connect(self.target_addr)
+
+        log.debug("connected to target[{}] at: {}".format(
+            sock.getpeername(),
+            sock.getsockname(),
+        ))
+
+        return sock
+
+    async def _response_heartbeat(self, conn_slaver, hb_from_master):
+        """see Slaver._response_heartbeat"""
+        await self.loop.sock_sendall(conn_slaver, CtrlPkg.pbuild_heart_beat().raw)
+        if hb_from_master.prgm_ver < 0x000B:
+            return True
+
+        pkg, verify = await recv_pkg(
+            self.loop, conn_slaver,
+            expect_ptype=CtrlPkg.PTYPE_HEART_BEAT)  # type: CtrlPkg,bool
+        if verify:
+            log.debug("heartbeat success {}".format(
+                fmt_addr(conn_slaver.getsockname())))
+            return True
+        else:
+            log.warning(
+                "received a wrong pkg[{}] during heartbeat, {}".format(
+                    pkg, conn_slaver.getsockname()
+                ))
+            return False
+
+    async def _stage_ctrlpkg(self, conn_slaver):
+        """see Slaver._stage_ctrlpkg"""
+        while True:
+            # expire and re-connect if not receive pkg from master in spare_ttl seconds
+            pkg, correct = await recv_pkg(self.loop, conn_slaver, self.spare_ttl)  # type: CtrlPkg,bool
+
+            if not correct:
+                return None
+
+            log.debug("CtrlPkg from {}: {}".format(conn_slaver.getpeername(), pkg))
+
+            if pkg.pkg_type == CtrlPkg.PTYPE_HEART_BEAT:
+                if not await self._response_heartbeat(conn_slaver, pkg):
+                    return None
+
+            elif pkg.pkg_type == CtrlPkg.PTYPE_HS_M2S:
+                break
+
+        return await self._response_handshake(conn_slaver, pkg)
+
+    async def _response_handshake(self, conn_slaver, handshake_pkg):
+        """see Slaver._response_handshake"""
+        await self.loop.sock_sendall(conn_slaver, CtrlPkg.pbuild_hs_s2m(ssl_avail=self.ssl_avail).raw)
+
+        if not self.ssl_avail or handshake_pkg.data[1] == CtrlPkg.SSL_FLAG_NONE:
+            if self.ssl_avail:
+                log.warning('master %s does not enabled SSL, fallback to plain', conn_slaver.getpeername())
+            return conn_slaver
+        else:
+            ssl_conn_slaver = await ssl_wrap(self.loop, self.ssl_context, conn_slaver, server_side=False)
+            log.debug('ssl established slaver: %s', ssl_conn_slaver.getpeername())
+            return ssl_conn_slaver
+
+    async def _slaver_working(self, conn_slaver):
+        addr_slaver = conn_slaver.getsockname()
+        addr_master = conn_slaver.getpeername()
+
+        # --------- handling CtrlPkg until handshake -------------
+        try:
+            actual_conn = await self._stage_ctrlpkg(conn_slaver)
+        except Exception as e:
+            log.warning("slaver{} waiting handshake failed {}".format(
+                fmt_addr(addr_slaver), repr(e)))
+            log.debug(traceback.format_exc())
+            actual_conn = None
+        else:
+            if actual_conn is None:
+                log.warning("bad handshake or timeout between: {} and {}".format(
+                    fmt_addr(addr_master), fmt_addr(addr_slaver)))
+
+        if actual_conn is None:
+            del self.spare_slaver_pool[addr_slaver]
+            self._spare_left.set()
+            try_close(conn_slaver)
+
+            log.warning("a slaver[{}] abort due to handshake error or timeout".format(
+                fmt_addr(addr_slaver)))
+            return
+        else:
+            log.info("Success master handshake from: {} to {}".format(
+                fmt_addr(addr_master), fmt_addr(addr_slaver)))
+
+        # ----------- slaver activated! ------------
+        self.working_pool[addr_slaver] = self.spare_slaver_pool.pop(addr_slaver)
+        self.working_pool[addr_slaver]['conn_slaver'] = actual_conn
+        self._spare_left.set()
+
+        # ----------- connecting to target ----------
+        try:
+            conn_target = await self._connect_target()
+        except:
+            log.error("unable to connect target", exc_info=True)
+            try_close(actual_conn)
+
+            del self.working_pool[addr_slaver]
+            return
+        self.working_pool[addr_slaver]["conn_target"] = conn_target
+
+        try:
+            self.socket_bridge.add_conn_pair(
+                actual_conn, conn_target,
+                functools.partial(
+                    self._transfer_complete, addr_slaver
+                )
+            )
+        except:
+            log.error('error adding to socket_bridge', exc_info=True)
+            try_close(actual_conn)
+            try_close(conn_target)
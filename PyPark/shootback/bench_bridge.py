@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# coding=utf-8
+"""
+SocketBridge benchmark over loopback TCP
+
+    python -m PyPark.shootback.bench_bridge
+
+latency:    small ping-pong through the bridge, reports mean round trip
+            and process CPU time per round trip
+idle:       process CPU used while many idle pairs sit in the bridge
+throughput: one-way bulk transfer through the bridge
+parallel:   bulk transfer over several pairs at once, compare with --shards N
+
+    python -m PyPark.shootback.bench_bridge --compare-splice
+
+compares the userspace and the splice forwarding throughput
+"""
+import argparse
+import socket
+import threading
+import time
+
+from PyPark.shootback.common_func import SocketBridge, make_bridge, SPLICE_AVAILABLE
+
+
+def tcp_pair():
+    """two connected loopback TCP sockets"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    a = socket.create_connection(listener.getsockname())
+    b, _ = listener.accept()
+    listener.close()
+    for s in (a, b):
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return a, b
+
+
+def bridged_pair(bridge):
+    """client <-> a ==bridge== b <-> server, returns (client, server)"""
+    client, a = tcp_pair()
+    b, server = tcp_pair()
+    bridge.add_conn_pair(a, b)
+    return client, server
+
+
+def recv_exactly(sock, size):
+    buff = bytearray()
+    while len(buff) < size:
+        data = sock.recv(size - len(buff))
+        if not data:
+            raise RuntimeError("connection closed")
+        buff += data
+    return bytes(buff)
+
+
+def bench_latency(bridge, rounds=5000, size=64):
+    client, server = bridged_pair(bridge)
+
+    def echo():
+        try:
+            while True:
+                server.sendall(recv_exactly(server, size))
+        except Exception:
+            pass
+
+    threading.Thread(target=echo, daemon=True).start()
+    msg = b"x" * size
+    # warm up
+    for _ in range(100):
+        client.sendall(msg)
+        recv_exactly(client, size)
+    cpu, start = time.process_time(), time.perf_counter()
+    for _ in range(rounds):
+        client.sendall(msg)
+        recv_exactly(client, size)
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+    client.close()
+    server.close()
+    return elapsed / rounds * 1e6, cpu / rounds * 1e6
+
+
+def bench_idle(bridge, pairs=200, seconds=2.0):
+    socks = [bridged_pair(bridge) for _ in range(pairs)]
+    time.sleep(0.2)
+    cpu = time.process_time()
+    time.sleep(seconds)
+    cpu = time.process_time() - cpu
+    for client, server in socks:
+        client.close()
+        server.close()
+    return cpu / seconds * 100
+
+
+def bench_throughput(bridge, total=256 * 1024 ** 2, chunk=256 * 1024):
+    client, server = bridged_pair(bridge)
+    received = [0]
+
+    def sink():
+        while received[0] < total:
+            data = server.recv(chunk)
+            if not data:
+                break
+            received[0] += len(data)
+
+    t = threading.Thread(target=sink, daemon=True)
+    payload = b"x" * chunk
+    cpu, start = time.process_time(), time.perf_counter()
+    t.start()
+    sent = 0
+    while sent < total:
+        client.sendall(payload)
+        sent += chunk
+    t.join()
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+    client.close()
+    server.close()
+    return total / elapsed / 1024 ** 2, cpu / elapsed * 100
+
+
+def bench_parallel(bridge, pairs=4, total=256 * 1024 ** 2):
+    """total bytes split over several pairs, returns (MiB/s, %cpu)"""
+    cpu, start = time.process_time(), time.perf_counter()
+    threads = [threading.Thread(target=bench_throughput, args=(bridge, total // pairs)) for _ in range(pairs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+    return total / elapsed / 1024 ** 2, cpu / elapsed * 100
+
+
+def main(make_bridge=SocketBridge):
+    bridge = make_bridge()
+    bridge.start_as_daemon()
+    rtt, cpu = bench_latency(bridge)
+    print("latency:    {:8.1f} us/round trip, {:6.1f} us cpu/round trip".format(rtt, cpu))
+    print("idle:       {:8.1f} % cpu with 200 idle pairs".format(bench_idle(bridge)))
+    mbps, cpu = bench_throughput(bridge)
+    print("throughput: {:8.1f} MiB/s, {:6.1f} % cpu".format(mbps, cpu))
+    mbps, cpu = bench_parallel(bridge)
+    print("parallel:   {:8.1f} MiB/s, {:6.1f} % cpu over 4 pairs".format(mbps, cpu))
+
+
+def compare_splice(shards=1):
+    if not SPLICE_AVAILABLE:
+        print("splice is not available on this platform")
+        return
+    for splice in (False, True):
+        bridge = make_bridge(shards, splice=splice)
+        bridge.start_as_daemon()
+        name = "splice" if splice else "userspace"
+        mbps, cpu = bench_throughput(bridge)
+        print("{:9} throughput: {:8.1f} MiB/s, {:6.1f} % cpu".format(name, mbps, cpu))
+        mbps, cpu = bench_parallel(bridge)
+        print("{:9} parallel:   {:8.1f} MiB/s, {:6.1f} % cpu over 4 pairs".format(name, mbps, cpu))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="SocketBridge benchmark")
+    parser.add_argument("--shards", default=1, type=int, help="number of bridge threads")
+    parser.add_argument("--splice", action="store_true", help="forward with splice")
+    parser.add_argument("--compare-splice", action="store_true", dest="compare_splice",
+                        help="only compare userspace and splice throughput")
+    args = parser.parse_args()
+    if args.compare_splice:
+        compare_splice(args.shards)
+    else:
+        main(lambda: make_bridge(args.shards, splice=args.splice))
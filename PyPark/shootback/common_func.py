@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # coding=utf-8
 from __future__ import print_function, unicode_literals, division, absolute_import
+import os
 import sys
 import time
 import binascii
@@ -30,6 +31,15 @@ except ImportError:
     ssl = None
     warnings.warn('ssl module not available, ssl feature is disabled')
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# os.splice moves data socket -> pipe -> socket inside the kernel,
+#   only on linux with python 3.10+
+SPLICE_AVAILABLE = hasattr(os, "splice") and hasattr(os, "pipe2")
+
 try:
     # for pycharm type hinting
     from typing import Union, Callable
@@ -53,8 +63,12 @@ SPARE_SLAVER_TTL = 300
 # internal program version, appears in CtrlPkg
 INTERNAL_VERSION = 0x0013
 
-# # how many packet are buffed, before delaying recv
-# SOCKET_BRIDGE_SEND_BUFF_SIZE = 5
+# the most bytes SocketBridge buffers per direction, 64KiB
+#   reading from a socket pauses while the buffer to its peer is full
+#   a ring starts at RECV_BUFFER_SIZE, grows up to this while the receiver
+#   falls behind, and shrinks back once drained, so an idle pair holds
+#   at most 2 * RECV_BUFFER_SIZE
+SOCKET_BRIDGE_BUFFER_SIZE = 2 ** 16
 
 # version for human readable
 __version__ = (2, 6, 1, INTERNAL_VERSION)
@@ -108,6 +122,13 @@ def try_close(closable):
         pass
 
 
+def try_close_fd(fd):
+    try:
+        os.close(fd)
+    except OSError:
+        pass
+
+
 def select_recv(conn, buff_size, timeout=None):
     """add timeout for socket.recv()
     :type conn: socket.socket
@@ -139,26 +160,173 @@ def set_secretkey(key):
     CtrlPkg.recalc_crc32()
 
 
+class _RingBuffer(object):
+    """
+    ring of bytes, filled by recv_into and drained by send
+    without copying the data in between
+
+    it starts with `initial` bytes, doubles when full up to `size`,
+    and goes back to `initial` once everything is sent
+    """
+
+    def __init__(self, size, initial=RECV_BUFFER_SIZE):
+        self.size = size  # the most it may grow to
+        self.initial = min(initial, size)
+        self.capacity = self.initial
+        self.view = memoryview(bytearray(self.capacity))
+        self.start = 0  # where the data begins
+        self.length = 0  # how many bytes are buffered
+
+    def writable(self):
+        """the contiguous free space after the data"""
+        end = self.start + self.length
+        if end < self.capacity:
+            return self.view[end:]
+        end -= self.capacity
+        return self.view[end:self.start]
+
+    def readable(self):
+        """the contiguous data from the beginning"""
+        return self.view[self.start:min(self.start + self.length, self.capacity)]
+
+    def produced(self, n):
+        self.length += n
+
+    def consumed(self, n):
+        self.length -= n
+        if self.length:
+            self.start = (self.start + n) % self.capacity
+        else:
+            # keep the free space contiguous
+            self.start = 0
+            if self.capacity > self.initial:
+                # release the memory grown for a burst
+                self.capacity = self.initial
+                self.view = memoryview(bytearray(self.capacity))
+
+    def _grow(self):
+        """double the capacity, the data is moved to the beginning"""
+        capacity = min(self.capacity * 2, self.size)
+        data = bytearray(capacity)
+        head = self.readable()
+        n = len(head)
+        data[:n] = head
+        data[n:self.length] = self.view[:self.length - n]
+        self.view = memoryview(data)
+        self.capacity = capacity
+        self.start = 0
+
+    def fill(self, sock):
+        """receive into the free space
+        :return: (bytes received, whether it was less than asked)
+        """
+        if self.length == self.capacity and self.capacity < self.size:
+            self._grow()
+        view = self.writable()
+        received = sock.recv_into(view)
+        self.produced(received)
+        return received, received < len(view)
+
+    def drain(self, sock):
+        """send the buffered data
+        :return: (bytes sent, whether it was less than asked)
+        """
+        view = self.readable()
+        sent = sock.send(view)
+        self.consumed(sent)
+        return sent, sent < len(view)
+
+    def close(self):
+        pass
+
+
+class _PipeBuffer(object):
+    """
+    a pipe used as the buffer, data is spliced into and out of it
+    and never copied to userspace, not for ssl sockets
+    """
+
+    def __init__(self, size):
+        self.r, self.w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.size = 2 ** 16  # linux default pipe capacity
+        if fcntl is not None and hasattr(fcntl, "F_SETPIPE_SZ"):
+            try:
+                self.size = fcntl.fcntl(self.w, fcntl.F_SETPIPE_SZ, size)
+            except OSError:
+                # larger than pipe-max-size or over the user's pipe quota
+                pass
+        self.length = 0
+
+    def fill(self, sock):
+        ask = self.size - self.length
+        received = os.splice(sock.fileno(), self.w, ask, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        self.length += received
+        return received, received < ask
+
+    def drain(self, sock):
+        sent = os.splice(self.r, sock.fileno(), self.length, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        self.length -= sent
+        return sent, self.length > 0
+
+    def close(self):
+        try_close_fd(self.r)
+        try_close_fd(self.w)
+
+
 class SocketBridge(object):
     """
     transfer data between sockets
+
+    Event driven: each direction has a ring buffer, data is received into
+    it with recv_into and sent from it, a partial send just leaves the rest
+    in the buffer. A socket waits for WRITE only while its buffer has data.
+    Reading pauses once the buffer to the peer reaches high_water and
+    resumes when it drains to low_water, so a slow receiver pushes back
+    on the fast sender instead of growing the buffer.
+    The bridge thread blocks only inside the selector, pairs added from
+    other threads are handed over through a wakeup socket.
+    With splice, a pipe replaces the ring buffer of plain TCP pairs and the
+    data stays in the kernel, ssl pairs still use the ring buffer.
+
+    :param buffer_size: the most bytes buffered per direction, default is
+        SOCKET_BRIDGE_BUFFER_SIZE. A ring buffer is allocated on first data
+        with RECV_BUFFER_SIZE bytes, grows up to buffer_size only while the
+        receiver is slower than the sender and shrinks once drained
+    :param high_water: stop reading when this many bytes are buffered,
+        default is buffer_size
+    :param low_water: resume reading when buffered bytes drop to this,
+        default is half of high_water
+    :param splice: forward plain TCP pairs with os.splice, ignored if not SPLICE_AVAILABLE
     """
 
-    def __init__(self):
-        self.conn_rd = set()  # record readable-sockets
-        self.conn_wr = set()  # record writeable-sockets
+    def __init__(self, buffer_size=None, high_water=None, low_water=None, splice=False):
+        self.buffer_size = buffer_size or SOCKET_BRIDGE_BUFFER_SIZE
+        self.high_water = min(high_water or self.buffer_size, self.buffer_size)
+        self.low_water = low_water if low_water is not None else self.high_water // 2
+        if not 0 <= self.low_water < self.high_water:
+            raise ValueError("low_water should be less than high_water")
+        self.splice = splice and SPLICE_AVAILABLE
+
         self.map = {}  # record sockets pairs
         self.callbacks = {}  # record callbacks
-        self.send_buff = {}  # buff one packet for those sending too-fast socket
-
-        if selectors:
-            self.sel = selectors.DefaultSelector()
-        else:
-            self.sel = None
+        self.buffers = {}  # data received from the peer, to be sent to this socket
+        self.paused = set()  # sockets not reading because the buffer to the peer is above high water
+        self.rd_closed = set()  # sockets whose remote side has finished sending
+        self.events = {}  # events currently registered in the selector
+        self.sel = selectors.DefaultSelector()
+        # only updated by the bridge thread
+        self.stats = {"pairs": 0, "total_pairs": 0, "bytes": 0}
+
+        # pairs added by other threads, registered by the bridge thread
+        self._new_pairs = collections.deque()
+        self._waker_r, self._waker_w = socket.socketpair()
+        self._waker_r.setblocking(False)
+        self._waker_w.setblocking(False)
+        self.sel.register(self._waker_r, EVENT_READ)
 
     def add_conn_pair(self, conn1, conn2, callback=None):
         """
-        transfer anything between two sockets
+        transfer anything between two sockets, thread-safe
 
         :type conn1: socket.socket
         :type conn2: socket.socket
@@ -169,27 +337,41 @@ class SocketBridge(object):
         #   we use select or epoll to notice when data is ready
         conn1.setblocking(False)
         conn2.setblocking(False)
+        self._new_pairs.append((conn1, conn2, callback))
+        self._wakeup()
 
-        # mark as readable+writable
-        self.conn_rd.add(conn1)
-        self.conn_wr.add(conn1)
-        self.conn_rd.add(conn2)
-        self.conn_wr.add(conn2)
-
-        # record sockets pairs
-        self.map[conn1] = conn2
-        self.map[conn2] = conn1
-
-        # record callback
-        if callback is not None:
-            self.callbacks[conn1] = callback
-
-        if self.sel:
-            self.sel.register(conn1, EVENT_READ_WRITE)
-            self.sel.register(conn2, EVENT_READ_WRITE)
+    def _wakeup(self):
+        try:
+            self._waker_w.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            # the bridge is already going to wake up
+            pass
 
-    def start_as_daemon(self):
-        t = threading.Thread(target=self.start)
+    def _register_new_pairs(self):
+        try:
+            while self._waker_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self._new_pairs:
+            conn1, conn2, callback = self._new_pairs.popleft()
+            # record sockets pairs
+            self.map[conn1] = conn2
+            self.map[conn2] = conn1
+            # record callback
+            if callback is not None:
+                self.callbacks[conn1] = callback
+            self.stats["pairs"] += 1
+            self.stats["total_pairs"] += 1
+            self._update_events(conn1)
+            self._update_events(conn2)
+
+    def load(self):
+        """active pairs, including those not registered yet"""
+        return self.stats["pairs"] + len(self._new_pairs)
+
+    def start_as_daemon(self, name=None):
+        t = threading.Thread(target=self.start, name=name)
         t.daemon = True
         t.start()
         log.info("SocketBridge daemon started")
@@ -205,162 +387,199 @@ class SocketBridge(object):
                 ))
 
     def _start(self):
-
         while True:
-            if not self.conn_rd and not self.conn_wr:
-                # sleep if there is no connections
-                time.sleep(0.01)
-                continue
-
-            # blocks until there is socket(s) ready for .recv
+            # blocks until some socket is ready, or a new pair is added
             # notice: sockets which were closed by remote,
-            #   are also regarded as read-ready by select()
-            if self.sel:
-                events = self.sel.select(0.5)
-                socks_rd = tuple(key.fileobj for key, mask in events if mask & EVENT_READ)
-                socks_wr = tuple(key.fileobj for key, mask in events if mask & EVENT_WRITE)
-            else:
-                r, w, _ = select.select(self.conn_rd, self.conn_wr, [], 0.5)
-                socks_rd = tuple(r)
-                socks_wr = tuple(w)
-                # log.debug('socks_rd: %s, socks_wr:%s', len(socks_rd), len(socks_wr))
-
-            if not socks_rd and not self.send_buff:  # reduce CPU in low traffic
-                time.sleep(0.005)
-            # log.debug('got rd:%s wr:%s', socks_rd, socks_wr)
-
-            # ----------------- RECEIVING ----------------
-            # For prevent high CPU at slow network environment, we record if there is any
-            #   success network operation, if we did nothing in single loop, we'll sleep a while.
-            _stuck_network = True
-
-            for s in socks_rd:  # type: socket.socket
-                # if this socket has non-sent data, stop recving more, to prevent buff blowing up.
-                if self.map[s] in self.send_buff:
-                    # log.debug('delay recv because another too slow %s', self.map.get(s))
+            #   are also regarded as read-ready
+            for key, mask in self.sel.select():
+                s = key.fileobj
+                if s is self._waker_r:
+                    self._register_new_pairs()
                     continue
-                _stuck_network = False
-
+                if mask & EVENT_WRITE and s in self.map:
+                    self._on_writable(s)
+                if mask & EVENT_READ and s in self.map:
+                    self._on_readable(s)
+
+    def _pending(self, conn):
+        """bytes buffered to be sent to conn"""
+        buff = self.buffers.get(conn)
+        return buff.length if buff is not None else 0
+
+    def _update_events(self, conn):
+        """register the events this socket is waiting for"""
+        events = 0
+        if conn not in self.rd_closed and conn not in self.paused:
+            events |= EVENT_READ
+        if self._pending(conn):
+            events |= EVENT_WRITE
+        current = self.events.get(conn, 0)
+        if events == current:
+            return
+        if current == 0:
+            self.sel.register(conn, events)
+        elif events == 0:
+            self.sel.unregister(conn)
+        else:
+            self.sel.modify(conn, events)
+        self.events[conn] = events
+
+    def _on_readable(self, s):
+        peer = self.map[s]
+        buff = self.buffers.get(peer)
+        if buff is None:
+            buff = self.buffers[peer] = self._new_buffer(s, peer)
+        while True:
+            while buff.length < buff.high:
                 try:
-                    received = s.recv(RECV_BUFFER_SIZE)
-                    # log.debug('recved %s from %s', len(received), s)
+                    received, short = buff.fill(s)
                 except Exception as e:
                     # ssl may raise SSLWantReadError or SSLWantWriteError
                     #   just continue and wait it complete
-                    if ssl and isinstance(e, (ssl.SSLWantReadError, ssl.SSLWantWriteError)):
-                        # log.warning('got %s, wait to read then', repr(e))
-                        continue
-
+                    if isinstance(e, (BlockingIOError, InterruptedError)) or \
+                            ssl and isinstance(e, (ssl.SSLWantReadError, ssl.SSLWantWriteError)):
+                        break
                     # unable to read, in most cases, it's due to socket close
                     log.warning('error reading socket %s, %s closing', repr(e), s)
-                    self._rd_shutdown(s)
-                    continue
+                    received = 0
 
                 if not received:
-                    self._rd_shutdown(s)
-                    continue
-                else:
-                    self.send_buff[self.map[s]] = received
-
-            # ----------------- SENDING ----------------
-            for s in socks_wr:
-                if s not in self.send_buff:
-                    if self.map.get(s) not in self.conn_rd:
-                        self._wr_shutdown(s)
-                    continue
-                _stuck_network = False
-
-                data = self.send_buff.pop(s)
-                try:
-                    s.send(data)
-                    # log.debug('sent %s to %s', len(data), s)
-                except Exception as e:
-                    if ssl and isinstance(e, (ssl.SSLWantReadError, ssl.SSLWantWriteError)):
-                        # log.warning('got %s, wait to write then', repr(e))
-                        self.send_buff[s] = data  # write back for next write
-                        continue
-                    # unable to send, close connection
-                    log.warning('error sending socket %s, %s closing', repr(e), s)
-                    self._wr_shutdown(s)
-                    continue
-
-            if _stuck_network:  # slower at bad network
-                time.sleep(0.001)
-
-    def _sel_disable_event(self, conn, ev):
-        try:
-            _key = self.sel.get_key(conn)  # type:selectors.SelectorKey
-        except KeyError:
-            pass
-        else:
-            if _key.events == EVENT_READ_WRITE:
-                self.sel.modify(conn, EVENT_READ_WRITE ^ ev)
-            else:
-                self.sel.unregister(conn)
-
-    def _rd_shutdown(self, conn, once=False):
-        """action when connection should be read-shutdown
+                    if self._flush(peer):
+                        self._rd_shutdown(s)
+                    return
+                # a short read means the kernel buffer is drained
+                if short and not _ssl_pending(s):
+                    break
+
+            if buff.length >= buff.high:
+                self.paused.add(s)
+            if not self._flush(peer):
+                return
+            self._update_events(s)
+            # ssl may keep decrypted data which the selector can not see
+            if s in self.paused or not _ssl_pending(s):
+                return
+
+    def _on_writable(self, s):
+        if not self._flush(s):
+            return
+        peer = self.map[s]
+        if peer in self.rd_closed and not self._pending(s):
+            # all sent, pass the EOF on
+            self._wr_shutdown(s)
+        elif peer not in self.paused and peer not in self.rd_closed and _ssl_pending(peer):
+            self._on_readable(peer)
+
+    def _flush(self, s):
+        """
+        send as much buffered data as possible, keep the rest until s is writable
+        :return: False if s failed and the pair has been shut down
+        """
+        buff = self.buffers.get(s)
+        while buff is not None and buff.length:
+            try:
+                sent, short = buff.drain(s)
+            except Exception as e:
+                if isinstance(e, (BlockingIOError, InterruptedError)) or \
+                        ssl and isinstance(e, (ssl.SSLWantReadError, ssl.SSLWantWriteError)):
+                    break
+                # unable to send, close connection
+                log.warning('error sending socket %s, %s closing', repr(e), s)
+                self._send_failed(s)
+                return False
+            self.stats["bytes"] += sent
+            if short:
+                break
+
+        peer = self.map[s]
+        if peer in self.paused and buff.length <= buff.low:
+            self.paused.discard(peer)
+            self._update_events(peer)
+        self._update_events(s)
+        return True
+
+    def _new_buffer(self, src, dst):
+        """buffer for data from src to dst, with its watermarks"""
+        buff = None
+        if self.splice and not (ssl and isinstance(src, ssl.SSLSocket) or ssl and isinstance(dst, ssl.SSLSocket)):
+            try:
+                buff = _PipeBuffer(self.buffer_size)
+            except OSError as e:
+                # most likely out of file descriptors
+                log.warning("unable to create pipe for splice, %s", repr(e))
+        if buff is None:
+            buff = _RingBuffer(self.buffer_size)
+        # a pipe may be smaller than asked for
+        buff.high = min(self.high_water, buff.size)
+        buff.low = self.low_water if self.low_water < buff.high else buff.high // 2
+        return buff
+
+    def _drop_buffer(self, conn):
+        buff = self.buffers.pop(conn, None)
+        if buff is not None:
+            buff.close()
+
+    def _rd_shutdown(self, conn):
+        """the remote side of conn has finished sending
+        :type conn: socket.socket
+        """
+        self.rd_closed.add(conn)
+        self.paused.discard(conn)
+        peer = self.map[conn]
+        self._update_events(conn)
+        if not self._pending(peer):
+            # pass the EOF on, or after the pending data is sent
+            self._wr_shutdown(peer)
+
+    def _wr_shutdown(self, conn):
+        """nothing more will be sent to conn
         :type conn: socket.socket
         """
-        if conn in self.conn_rd:
-            self.conn_rd.remove(conn)
-            if self.sel:
-                self._sel_disable_event(conn, EVENT_READ)
-
-        # if conn in self.send_buff:
-        #     del self.send_buff[conn]
-
         try:
-            conn.shutdown(socket.SHUT_RD)
+            conn.shutdown(socket.SHUT_WR)
         except:
             pass
-
-        if not once and conn in self.map:  # use the `once` param to avoid infinite loop
-            # if a socket is rd_shutdowned, then it's
-            #   pair should be wr_shutdown.
-            self._wr_shutdown(self.map[conn], True)
-
-        if self.map.get(conn) not in self.conn_rd:
-            # if both two connection pair was rd-shutdowned,
+        peer = self.map[conn]
+        if conn in self.rd_closed and peer in self.rd_closed \
+                and not self._pending(conn) and not self._pending(peer):
+            # if both directions were finished,
             #   this pair sockets are regarded to be completed
             #   so we gonna close them
             self._terminate(conn)
 
-    def _wr_shutdown(self, conn, once=False):
-        """action when connection should be write-shutdown
-        :type conn: socket.socket
-        """
+    def _send_failed(self, conn):
+        """conn can not receive any more, so stop reading its peer"""
+        self._drop_buffer(conn)
+        peer = self.map[conn]
+        self.rd_closed.add(peer)
+        self.paused.discard(peer)
         try:
-            conn.shutdown(socket.SHUT_WR)
+            peer.shutdown(socket.SHUT_RD)
         except:
             pass
-
-        if conn in self.conn_wr:
-            self.conn_wr.remove(conn)
-            if self.sel:
-                self._sel_disable_event(conn, EVENT_WRITE)
-
-        if not once and conn in self.map:  # use the `once` param to avoid infinite loop
-            #   pair should be rd_shutdown.
-            # if a socket is wr_shutdowned, then it's
-            self._rd_shutdown(self.map[conn], True)
+        self._update_events(conn)
+        self._update_events(peer)
+        self._wr_shutdown(conn)
 
     def _terminate(self, conn, once=False):
         """terminate a sockets pair (two socket)
         :type conn: socket.socket
         :param conn: any one of the sockets pair
         """
-        try_close(conn)  # close the first socket
-
         # ------ close and clean the mapped socket, if exist ------
         _another_conn = self.map.pop(conn, None)
+        if not once:
+            self.stats["pairs"] -= 1
 
-        self.send_buff.pop(conn, None)
-        if self.sel:
+        self._drop_buffer(conn)
+        self.paused.discard(conn)
+        self.rd_closed.discard(conn)
+        if self.events.pop(conn, 0):
             try:
                 self.sel.unregister(conn)
             except:
                 pass
+        try_close(conn)  # close the first socket
 
         # ------ callback --------
         # because we are not sure which socket are assigned to callback,
@@ -375,7 +594,63 @@ class SocketBridge(object):
 
         # terminate another
         if not once and _another_conn in self.map:
-            self._terminate(_another_conn)
+            self._terminate(_another_conn, True)
+
+
+class ShardedSocketBridge(object):
+    """
+    spread socket pairs over several SocketBridge event loops, one thread each
+
+    the bridges spend most time in send/recv which release the GIL,
+    so several loops keep more than one core busy under many connections
+
+    :param shards: number of SocketBridge
+    :param balance: "least" gives a new pair to the bridge with the fewest pairs,
+        "hash" picks a bridge by the peer address of conn1
+    :param kwargs: passed to every SocketBridge
+    """
+
+    def __init__(self, shards=2, balance="least", **kwargs):
+        if balance not in ("least", "hash"):
+            raise ValueError("balance should be least or hash, not {}".format(balance))
+        self.shards = [SocketBridge(**kwargs) for _ in range(shards)]
+        self.balance = balance
+
+    def add_conn_pair(self, conn1, conn2, callback=None):
+        self._choose(conn1).add_conn_pair(conn1, conn2, callback)
+
+    def _choose(self, conn):
+        if self.balance == "hash":
+            try:
+                key = conn.getpeername()
+            except OSError:
+                key = conn.fileno()
+            return self.shards[hash(key) % len(self.shards)]
+        return min(self.shards, key=SocketBridge.load)
+
+    @property
+    def stats(self):
+        """counters of every shard"""
+        return [shard.stats for shard in self.shards]
+
+    def start_as_daemon(self, name="SocketBridge"):
+        return [shard.start_as_daemon("{}-{}".format(name, i)) for i, shard in enumerate(self.shards)]
+
+    def start(self):
+        for t in self.start_as_daemon():
+            t.join()
+
+
+def make_bridge(shards=1, balance="least", **kwargs):
+    """a single SocketBridge, or a ShardedSocketBridge if shards > 1"""
+    if shards and shards > 1:
+        return ShardedSocketBridge(shards, balance, **kwargs)
+    return SocketBridge(**kwargs)
+
+
+def _ssl_pending(conn):
+    """bytes already decrypted and buffered inside a ssl socket"""
+    return ssl is not None and isinstance(conn, ssl.SSLSocket) and conn.pending() > 0
 
 
 class CtrlPkg(object):
@@ -73,12 +73,15 @@ def try_bind_port(sock, addr):
 class Master(object):
     def __init__(self, customer_listen_addr, communicate_addr=None,
                  slaver_pool=None, working_pool=None,
-                 ssl=False
+                 ssl=False, bridge_shards=1, bridge_buffer_size=None, bridge_splice=False
                  ):
         """
 
         :param customer_listen_addr: equals to the -c/--customer param
         :param communicate_addr: equals to the -m/--master param
+        :param bridge_shards: equals to the --bridge-shards param
+        :param bridge_buffer_size: bytes, equals to the --bridge-buffer param
+        :param bridge_splice: equals to the --splice param
         """
         self.thread_pool = {}
         self.thread_pool["spare_slaver"] = {}
@@ -86,7 +89,7 @@ class Master(object):
 
         self.working_pool = working_pool or {}
 
-        self.socket_bridge = SocketBridge()
+        self.socket_bridge = make_bridge(bridge_shards, buffer_size=bridge_buffer_size, splice=bridge_splice)
 
         # a queue for customers who have connected to us,
         #   but not assigned a slaver yet
@@ -279,6 +282,7 @@ class Master(object):
                 log.debug("heartbeat success: {}, time: {}ms".format(
                     fmt_addr(addr_slaver), time_used))
                 self.slaver_pool.append(slaver)
+                log.debug("socket bridge: {}".format(self.socket_bridge.stats))
 
     def _handshake(self, conn_slaver):
         """
@@ -429,13 +433,26 @@ class Master(object):
             self.pending_customers.put((conn_customer, addr_customer))
 
 
-def run_master(communicate_addr, customer_listen_addr, secretkey, ssl=False):
-    log.info("shootback {} running as master".format(version_info()))
+def run_master(communicate_addr, customer_listen_addr, secretkey, ssl=False, bridge_shards=1,
+               bridge_buffer_size=None, bridge_splice=False, mode="thread"):
+    """
+    :param mode: "thread" or "asyncio", equals to the --mode param
+    """
+    log.info("shootback {} running as master, mode: {}".format(version_info(), mode))
     log.info("author: {}  site: {}".format(__author__, __website__))
     log.info("slaver from: {} customer from: {}".format(
         fmt_addr(communicate_addr), fmt_addr(customer_listen_addr)))
     set_secretkey(secretkey)
-    Master(customer_listen_addr, communicate_addr, ssl=ssl).serve_forever()
+    kwargs = dict(ssl=ssl, bridge_shards=bridge_shards,
+                  bridge_buffer_size=bridge_buffer_size, bridge_splice=bridge_splice)
+    if mode == "asyncio":
+        from PyPark.shootback.aio import AsyncMaster
+        master = AsyncMaster(customer_listen_addr, communicate_addr, spare_ttl=SPARE_SLAVER_TTL, **kwargs)
+    elif mode == "thread":
+        master = Master(customer_listen_addr, communicate_addr, **kwargs)
+    else:
+        raise ValueError("mode should be thread or asyncio, not {}".format(mode))
+    master.serve_forever()
 
 
 def argparse_master():
@@ -482,6 +499,15 @@ Tips: ANY service using TCP is shootback-able.  HTTP/FTP/Proxy/SSH/VNC/...
                              "Default value is optimized for most cases")
     parser.add_argument('--ssl', action='store_true', help='[experimental] try using ssl for data encryption. '
                                                            'It may be enabled by default in future version')
+    parser.add_argument("--bridge-shards", default=1, type=int, dest="bridge_shards",
+                        help="number of threads moving tunnelled data, default is 1")
+    parser.add_argument("--bridge-buffer", default=None, type=int, dest="bridge_buffer",
+                        help="most KiB buffered per direction of a tunnelled connection, default is 64")
+    parser.add_argument("--splice", action="store_true",
+                        help="forward data inside the kernel with splice, linux only, not used with --ssl")
+    parser.add_argument("--mode", default="thread", choices=("thread", "asyncio"),
+                        help="thread: a thread per job, asyncio: handshakes and heartbeats in one event loop. "
+                             "default is thread, both speak the same protocol")
 
     return parser.parse_args()
 
@@ -510,7 +536,9 @@ def main_master():
             level = logging.INFO
         configure_logging(level)
 
-    run_master(communicate_addr, customer_listen_addr, ssl=args.ssl)
+    run_master(communicate_addr, customer_listen_addr, ssl=args.ssl, bridge_shards=args.bridge_shards,
+               bridge_buffer_size=args.bridge_buffer and args.bridge_buffer * 1024,
+               bridge_splice=args.splice, mode=args.mode)
 
 
 if __name__ == '__main__':
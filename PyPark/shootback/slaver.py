@@ -14,14 +14,15 @@ class Slaver(object):
         连接master->等待->心跳(重复)--->握手-->正式传输数据->退出
     """
 
-    def __init__(self, communicate_addr, target_addr, max_spare_count=5, ssl=False):
+    def __init__(self, communicate_addr, target_addr, max_spare_count=5, ssl=False, bridge_shards=1,
+                 bridge_buffer_size=None, bridge_splice=False):
         self.communicate_addr = communicate_addr
         self.target_addr = target_addr
         self.max_spare_count = max_spare_count
 
         self.spare_slaver_pool = {}
         self.working_pool = {}
-        self.socket_bridge = SocketBridge()
+        self.socket_bridge = make_bridge(bridge_shards, buffer_size=bridge_buffer_size, splice=bridge_splice)
 
         if ssl:
             self.ssl_context = self._make_ssl_context()
@@ -293,15 +294,29 @@ class Slaver(object):
             err_delay = 0
 
 
-def run_slaver(communicate_addr, target_addr, secret_key, max_spare_count=5, ssl=False):
-    log.info("running as slaver, master addr: {} target: {}".format(
-        fmt_addr(communicate_addr), fmt_addr(target_addr)
+def run_slaver(communicate_addr, target_addr, secret_key, max_spare_count=5, ssl=False, bridge_shards=1,
+               bridge_buffer_size=None, bridge_splice=False, mode="thread"):
+    """
+    :param mode: "thread" or "asyncio", equals to the --mode param
+    """
+    log.info("running as slaver, master addr: {} target: {} mode: {}".format(
+        fmt_addr(communicate_addr), fmt_addr(target_addr), mode
     ))
     set_secretkey(secret_key)
-    Slaver(communicate_addr, target_addr,
-           max_spare_count=max_spare_count,
-           ssl=ssl,
-           ).serve_forever()
+    kwargs = dict(max_spare_count=max_spare_count,
+                  ssl=ssl,
+                  bridge_shards=bridge_shards,
+                  bridge_buffer_size=bridge_buffer_size,
+                  bridge_splice=bridge_splice,
+                  )
+    if mode == "asyncio":
+        from PyPark.shootback.aio import AsyncSlaver
+        slaver = AsyncSlaver(communicate_addr, target_addr, spare_ttl=SPARE_SLAVER_TTL, **kwargs)
+    elif mode == "thread":
+        slaver = Slaver(communicate_addr, target_addr, **kwargs)
+    else:
+        raise ValueError("mode should be thread or asyncio, not {}".format(mode))
+    slaver.serve_forever()
 
 
 def argparse_slaver():
@@ -351,6 +366,15 @@ Tips: ANY service using TCP is shootback-able.  HTTP/FTP/Proxy/SSH/VNC/...
                              "while working connections are always unlimited")
     parser.add_argument('--ssl', action='store_true', help='[experimental] try using ssl for data encryption. '
                                                            'It may be enabled by default in future version')
+    parser.add_argument("--bridge-shards", default=1, type=int, dest="bridge_shards",
+                        help="number of threads moving tunnelled data, default is 1")
+    parser.add_argument("--bridge-buffer", default=None, type=int, dest="bridge_buffer",
+                        help="most KiB buffered per direction of a tunnelled connection, default is 64")
+    parser.add_argument("--splice", action="store_true",
+                        help="forward data inside the kernel with splice, linux only, not used with --ssl")
+    parser.add_argument("--mode", default="thread", choices=("thread", "asyncio"),
+                        help="thread: a thread per job, asyncio: handshakes and heartbeats in one event loop. "
+                             "default is thread, both speak the same protocol")
 
     return parser.parse_args()
 
@@ -391,6 +415,10 @@ def main_slaver():
     run_slaver(communicate_addr, target_addr,
                max_spare_count=max_spare_count,
                ssl=args.ssl,
+               bridge_shards=args.bridge_shards,
+               bridge_buffer_size=args.bridge_buffer and args.bridge_buffer * 1024,
+               bridge_splice=args.splice,
+               mode=args.mode,
                )
 
 
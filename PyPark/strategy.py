@@ -1,32 +1,107 @@
-import hashlib
-import json
+import itertools
+import math
 import random
-import re
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from PyPark.breaker import health_table
+from PyPark.codec import get_codec, codec_for_content_type
 from PyPark.cons import Strategy, CONTENT_TYPE
-from PyPark.my_thread import MyThread
 from PyPark.park_exception import NoServiceException, ServiceException
 from PyPark.result import Result, StatusCode
-from PyPark.util.json_to import JsonTo
+from PyPark.util.hash_ring import HashRing
+from PyPark.util.zk_util import compile_pattern
 
-# key:url value:index
 from PyPark.util.util import cut_list_num
 
+# 多主机调用线程池大小
+SCATTER_POOL_SIZE = 64
+_scatter_executor = None
+# 只保护线程池的创建与替换, 不与主机负载统计争用
+_scatter_lock = threading.Lock()
+# key:url value:RoundCursor
 _round_index_map = {}
-round_lock = threading.RLock()
+# key:url value:HashRing
+_hash_ring_map = {}
+# key:host value:HostLoad
+_host_load_map = {}
+host_load_lock = threading.Lock()
+# 未测得响应时间的主机有进行中请求时使用的惩罚响应时间(秒)
+UNMEASURED_RTT_PENALTY = 1.0
 
 
-def __getStrAsMD5(parmStr):
-    if isinstance(parmStr, str):
-        # 如果是unicode先转utf-8
-        parmStr = parmStr.encode("utf-8")
-    m = hashlib.md5()
-    m.update(parmStr)
-    return m.hexdigest()
+class RoundCursor:
+    """
+    轮询游标, itertools.count的next()在GIL下是原子的, 调用路径上不需要加锁
+    按调用时的主机数取模, 主机数变化后依然均匀
+    """
+
+    def __init__(self):
+        # 随机起点, 避免多个客户端同时从第一个主机开始
+        self.counter = itertools.count(random.randrange(1 << 16))
+
+    def next_index(self, size):
+        return next(self.counter) % size
+
+
+class HostLoad:
+    """
+    主机负载统计, 由get()在每次请求前后更新
+    outstanding: 进行中的请求数
+    ewma: 峰值EWMA响应时间(秒), 响应变慢时立即上升, 空闲时按decay秒向0衰减, 读取时才计算衰减
+    """
+
+    def __init__(self, host, decay=10.0):
+        self.host = host
+        self.decay = decay
+        self.outstanding = 0
+        self.ewma = 0.0
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            self.outstanding += 1
+
+    def finish(self, rtt):
+        with self.lock:
+            self.outstanding -= 1
+            now = time.monotonic()
+            w = math.exp(-(now - self.stamp) / self.decay)
+            self.stamp = now
+            if rtt > self.ewma * w:
+                self.ewma = rtt
+            else:
+                self.ewma = self.ewma * w + rtt * (1 - w)
+
+    def current_ewma(self, now=None):
+        """按上次更新后经过的时间衰减后的EWMA, 失败过一次的主机不会因不再被选中而一直保持高值"""
+        if now is None:
+            now = time.monotonic()
+        return self.ewma * math.exp(-max(now - self.stamp, 0.0) / self.decay)
+
+    def cost(self):
+        """
+        衰减后的峰值EWMA × (进行中请求数 + 1)
+        未测得响应时间但有进行中请求的主机按UNMEASURED_RTT_PENALTY计算, 避免新主机被请求挤满
+        """
+        ewma = self.current_ewma()
+        if ewma == 0.0 and self.outstanding > 0:
+            ewma = UNMEASURED_RTT_PENALTY
+        return ewma * (self.outstanding + 1)
+
+
+def host_load(host) -> HostLoad:
+    load = _host_load_map.get(host, None)
+    if load is None:
+        with host_load_lock:
+            load = _host_load_map.setdefault(host, HostLoad(host))
+    return load
 
 
 def strategy_choice(hosts, url, data, s_request, **kwargs) -> Result:
     strategy = kwargs["strategy"]
+    hosts = health_table.filter(hosts)
     if strategy == Strategy.ROUND:
         return strategy_round(hosts, url, data, s_request, **kwargs)
     elif strategy == Strategy.RANDOM:
@@ -37,18 +112,27 @@ def strategy_choice(hosts, url, data, s_request, **kwargs) -> Result:
         return strategy_host(hosts, url, data, s_request, **kwargs)
     elif strategy == Strategy.DIY:
         return strategy_diy(hosts, url, data, s_request, **kwargs)
+    elif strategy == Strategy.LEAST:
+        return strategy_least(hosts, url, data, s_request, **kwargs)
+    elif strategy == Strategy.P2C:
+        return strategy_p2c(hosts, url, data, s_request, **kwargs)
+    elif strategy == Strategy.EWMA:
+        return strategy_ewma(hosts, url, data, s_request, **kwargs)
     else:
         Exception(f"不支持的策略-{strategy}")
 
 
 def many_strategy_choice(hosts, url, data, cut_list, s_request, **kwargs) -> Result:
     strategy = kwargs["strategy"]
+    hosts = health_table.filter(hosts)
     if strategy == Strategy.ROUND:
         return many_strategy_round(hosts, url, data, cut_list, s_request, **kwargs)
     elif strategy == Strategy.HOST:
         return many_strategy_host(hosts, url, data, cut_list, s_request, **kwargs)
     elif strategy == Strategy.DIY:
         return many_strategy_diy(hosts, url, data, cut_list, s_request, **kwargs)
+    elif strategy in (Strategy.LEAST, Strategy.P2C, Strategy.EWMA):
+        return many_strategy_load(hosts, url, data, cut_list, s_request, **kwargs)
     else:
         Exception(f"不支持的策略-{strategy}")
 
@@ -74,7 +158,7 @@ def many_strategy_diy(hosts, url, data, cut_list, s_request, **kwargs):
     if callback is None:
         raise ServiceException("回调策略回调函数为空")
     hosts = callback(hosts, url, data)
-    if isinstance(hosts, list):
+    if isinstance(hosts, (list, tuple)):
         return get_many_results(data, cut_list, hosts, s_request, url, **kwargs)
     else:
         raise ServiceException("多调必须返回hosts,列表形式")
@@ -82,10 +166,10 @@ def many_strategy_diy(hosts, url, data, cut_list, s_request, **kwargs):
 
 def strategy_host(hosts, url, data, s_request, **kwargs) -> Result:
     """主机策略"""
-    re_host = kwargs.get("host", "")
+    host_match = compile_pattern(kwargs.get("host", ""))
     host = None
     for h in hosts:
-        if re.match(re_host, h):
+        if host_match(h):
             host = h
             break
     if host is None:
@@ -95,10 +179,10 @@ def strategy_host(hosts, url, data, s_request, **kwargs) -> Result:
 
 def many_strategy_host(hosts, url, data, cut_list, s_request, **kwargs):
     """主机策略"""
-    re_host = kwargs.get("host", "")
+    host_match = compile_pattern(kwargs.get("host", ""))
     filter_hosts = []
     for h in hosts:
-        if re.match(re_host, h):
+        if host_match(h):
             filter_hosts.append(h)
     if len(filter_hosts) == 0:
         raise NoServiceException("找不到匹配的主机")
@@ -109,42 +193,76 @@ def get_result(host, url, data, s_request, **kwargs) -> Result:
     return get(host=host, url=url, data=data, s_request=s_request, kwargs=kwargs)
 
 
-def get_many_results(data, cut_list, filter_hosts, s_request, url, **kwargs):
-    tasks = []
-    # 数据的份数
+def scatter_executor() -> ThreadPoolExecutor:
+    """多主机调用共享的线程池, 首次使用时按SCATTER_POOL_SIZE创建"""
+    global _scatter_executor
+    executor = _scatter_executor
+    if executor is None:
+        with _scatter_lock:
+            executor = _scatter_executor
+            if executor is None:
+                executor = _scatter_executor = ThreadPoolExecutor(max_workers=SCATTER_POOL_SIZE,
+                                                                  thread_name_prefix="scatter")
+    return executor
+
+
+def set_scatter_pool_size(size):
+    """设置多主机调用线程池大小, 已创建的线程池在当前任务完成后关闭"""
+    global SCATTER_POOL_SIZE, _scatter_executor
+    with _scatter_lock:
+        SCATTER_POOL_SIZE = size
+        executor, _scatter_executor = _scatter_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+def iter_many_results(data, cut_list, filter_hosts, s_request, url, **kwargs):
+    """
+    向多个主机发送请求, 按完成顺序返回(host, Result)
+    :param kwargs: deadline 整个调用的截止秒数, 到期未完成的主机返回超时错误并取消未开始的请求
+    """
+    for _, host, result in _scatter(data, cut_list, filter_hosts, s_request, url, **kwargs):
+        yield host, result
+
+
+def _scatter(data, cut_list, filter_hosts, s_request, url, **kwargs):
     if cut_list is not None:
-        aa = cut_list_num(data_list=cut_list, cut_num=len(filter_hosts))
-        host_index = 0
-        for a in aa:
-            task = MyThread(target=get,
-                            args=(filter_hosts[host_index], url, data, f"{a[0]}-{a[1]}", s_request, kwargs,),
-                            daemon=True)
-            task.name = filter_hosts[host_index]
-            task.start()
-            tasks.append(task)
-            host_index += 1
+        cuts = [f"{a[0]}-{a[1]}" for a in cut_list_num(data_list=cut_list, cut_num=len(filter_hosts))]
     else:
-        aa = filter_hosts
-        host_index = 0
-        for a in aa:
-            task = MyThread(target=get,
-                            args=(filter_hosts[host_index], url, data, f"0-0", s_request, kwargs,),
-                            daemon=True)
-            task.name = filter_hosts[host_index]
-            task.start()
-            tasks.append(task)
-            host_index += 1
-    results = []
+        cuts = ["0-0"] * len(filter_hosts)
+    executor = scatter_executor()
+    futures = {}
+    for index, (host, cut) in enumerate(zip(filter_hosts, cuts)):
+        futures[executor.submit(get, host, url, data, cut, s_request, kwargs)] = index
+    yielded = set()
+    try:
+        for f in as_completed(futures, timeout=kwargs.get("deadline", None)):
+            index = futures[f]
+            yielded.add(f)
+            yield index, filter_hosts[index], f.result()
+    except FuturesTimeoutError:
+        for f, index in futures.items():
+            if f in yielded:
+                continue
+            host = filter_hosts[index]
+            if f.done():
+                # 超时前已完成但还没被as_completed取出的结果仍然有效
+                yield index, host, f.result()
+            else:
+                f.cancel()
+                yield index, host, Result.error(code=StatusCode.SYSTEM_ERROR, msg=f"{host} deadline exceeded")
+
+
+def get_many_results(data, cut_list, filter_hosts, s_request, url, **kwargs):
+    results = [None] * len(filter_hosts)
     all_success = True
     msg = ""
-    for task in tasks:
-        task.join()
-    for task in tasks:
+    for index, _, result in _scatter(data, cut_list, filter_hosts, s_request, url, **kwargs):
         # 检查返回服务是否都返回了,且是否都成功了
-        if task.result() is not None and not task.result().is_success:
+        if result is not None and not result.is_success:
             all_success = False
-            msg += task.result().msg + " | "
-        results.append(task.result())
+            msg += result.msg + " | "
+        results[index] = result
     if not all_success:
         Result.error(results)
     return Result.success(results)
@@ -152,16 +270,11 @@ def get_many_results(data, cut_list, filter_hosts, s_request, url, **kwargs):
 
 def strategy_round(hosts, url, data, s_request, **kwargs) -> Result:
     """轮询策略"""
-    try:
-        round_lock.acquire()
-        index = _round_index_map.get(url, random.choice(range(len(hosts))))
-        index += 1
-        if index > len(hosts) - 1:
-            index = 0
-        host = hosts[index]
-        _round_index_map[url] = index
-    finally:
-        round_lock.release()
+    cursor = _round_index_map.get(url, None)
+    if cursor is None:
+        # setdefault是原子操作, 并发创建时只保留一个
+        cursor = _round_index_map.setdefault(url, RoundCursor())
+    host = hosts[cursor.next_index(len(hosts))]
     return get_result(host, url, data, s_request, **kwargs)
 
 
@@ -171,47 +284,92 @@ def many_strategy_round(hosts, url, data, cut_list, s_request, **kwargs):
 
 
 def strategy_hash(hosts, url, data, s_request, **kwargs) -> Result:
-    """Hash策略"""
+    """Hash策略, 一致性Hash环按方法缓存, 主机变化时才重建"""
     s_hash = kwargs.get("hash", None)
     if s_hash is None:
         s_hash = data
-    if len(s_hash) < 9:
-        s_hash = str(s_hash) * 9
-    s_hash = __getStrAsMD5(str(s_hash))
-    hosts_hash = {}
-    host = hosts[-1]
-    for h in hosts:
-        hosts_hash[__getStrAsMD5(h)] = h
-    hs = list(hosts_hash.keys())
-    hs.sort()
-    for h in hs:
-        if h > s_hash:
-            host = hosts_hash[h]
+    virtual_nodes = kwargs.get("virtual_nodes", 160)
+    ring = _hash_ring_map.get(url, None)
+    if ring is None or not ring.match(hosts, virtual_nodes):
+        ring = HashRing(hosts, virtual_nodes)
+        _hash_ring_map[url] = ring
+    host = ring.get(s_hash)
+    return get_result(host, url, data, s_request, **kwargs)
+
+
+def strategy_least(hosts, url, data, s_request, **kwargs) -> Result:
+    """最少进行中请求策略, 相同时随机"""
+    host = min(hosts, key=lambda h: (host_load(h).outstanding, random.random()))
+    return get_result(host, url, data, s_request, **kwargs)
+
+
+def strategy_p2c(hosts, url, data, s_request, **kwargs) -> Result:
+    """随机选两个主机, 取进行中请求少的"""
+    if len(hosts) < 2:
+        host = hosts[0]
+    else:
+        a, b = random.sample(hosts, 2)
+        host = a if host_load(a).outstanding <= host_load(b).outstanding else b
     return get_result(host, url, data, s_request, **kwargs)
 
 
+def strategy_ewma(hosts, url, data, s_request, **kwargs) -> Result:
+    """峰值EWMA策略, 选响应时间×负载最小的主机, 未调用过的主机优先"""
+    host = min(hosts, key=lambda h: (host_load(h).cost(), random.random()))
+    return get_result(host, url, data, s_request, **kwargs)
+
+
+def many_strategy_load(hosts, url, data, cut_list, s_request, **kwargs):
+    """按负载排序取host_num个主机, 默认全部"""
+    if kwargs["strategy"] == Strategy.EWMA:
+        hosts = sorted(hosts, key=lambda h: host_load(h).cost())
+    else:
+        hosts = sorted(hosts, key=lambda h: host_load(h).outstanding)
+    host_num = kwargs.get("host_num", None)
+    if host_num:
+        hosts = hosts[:host_num]
+    return get_many_results(data, cut_list, hosts, s_request, url, **kwargs)
+
+
 def get(host, url, data, cut_start_end="0-0", s_request=None, kwargs=None) -> Result:
     if kwargs is None:
         kwargs = {}
+    load = host_load(host)
+    load.start()
+    health_table.on_request(host)
+    start_time = time.monotonic()
     try:
-        if not url.startswith("/"):
-            url = "/" + url
-        headers = kwargs.get("headers", {})
-        timeout = kwargs.get("timeout", 30)
-        headers["Content-Type"] = CONTENT_TYPE.TEXT
-        if isinstance(data, int):
-            data = str(data)
-        if isinstance(data, str):
-            data = data.encode("utf-8")
-        else:
-            headers["Content-Type"] = CONTENT_TYPE.JSON
-            data = json.dumps(data, cls=JsonTo)
-        if cut_start_end is not None:
-            headers["__CUT_DATA_START_END"] = cut_start_end
-        r = s_request.get("http://" + host + url, data=data, timeout=timeout, headers=headers)
-        if headers["Content-Type"] in CONTENT_TYPE.JSON:
-            if r.status_code == 200:
-                return Result(**r.json())
-        return Result.error(code=str(r.status_code), msg=r.text, data=r.text)
+        result = _get(host, url, data, cut_start_end, s_request, kwargs)
+        load.finish(time.monotonic() - start_time)
+        return result
     except Exception as e:
+        # 失败按超时计入, 避免快速失败的主机被优先选中
+        load.finish(max(time.monotonic() - start_time, kwargs.get("timeout", 30)))
+        health_table.on_failure(host)
         return Result.error(code=StatusCode.SYSTEM_ERROR, msg=str(e))
+
+
+def _get(host, url, data, cut_start_end, s_request, kwargs) -> Result:
+    if not url.startswith("/"):
+        url = "/" + url
+    headers = dict(kwargs.get("headers", {}))
+    timeout = kwargs.get("timeout", 30)
+    codec = get_codec(kwargs.get("codec", None))
+    headers["Content-Type"] = CONTENT_TYPE.TEXT
+    if isinstance(data, int):
+        data = str(data)
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    else:
+        headers["Content-Type"] = codec.content_type
+        headers["Accept"] = codec.content_type
+        data = codec.dumps(data)
+    if cut_start_end is not None:
+        headers["__CUT_DATA_START_END"] = cut_start_end
+    r = s_request.get("http://" + host + url, data=data, timeout=timeout, headers=headers)
+    health_table.on_response(host, r.status_code, r.headers)
+    response_codec = codec_for_content_type(r.headers.get("Content-Type", ""))
+    if response_codec is not None:
+        if r.status_code == 200:
+            return Result(**response_codec.loads(r.content))
+    return Result.error(code=str(r.status_code), msg=r.text, data=r.text)
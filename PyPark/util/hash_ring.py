@@ -0,0 +1,74 @@
+import bisect
+import hashlib
+
+
+def hash_key(key) -> int:
+    """取MD5前8字节作为环上的位置"""
+    if not isinstance(key, bytes):
+        key = str(key).encode("utf-8")
+    return int.from_bytes(hashlib.md5(key).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    带虚拟节点的一致性Hash环
+    :param hosts: 主机列表
+    :param virtual_nodes: 每个主机的虚拟节点数
+    """
+
+    def __init__(self, hosts, virtual_nodes=160):
+        self.hosts = frozenset(hosts)
+        # 构建时的主机列表, get_rest_nodes返回的是节点变化前不变的共享tuple, 同一对象直接复用
+        self.source = hosts
+        self.virtual_nodes = virtual_nodes
+        ring = []
+        for h in self.hosts:
+            for i in range(virtual_nodes):
+                ring.append((hash_key(f"{h}#{i}"), h))
+        ring.sort()
+        self.points = [p for p, _ in ring]
+        self.nodes = [h for _, h in ring]
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def match(self, hosts, virtual_nodes):
+        """主机集合与虚拟节点数都未变化时可复用, 同一主机列表对象时O(1)判断"""
+        if self.virtual_nodes != virtual_nodes:
+            return False
+        if hosts is self.source:
+            return True
+        if self.hosts != frozenset(hosts):
+            return False
+        # 内容相同的新列表, 记下以便后续调用走快速路径
+        self.source = hosts
+        return True
+
+    def get(self, key):
+        """返回key在环上顺时针方向的第一个主机"""
+        if not self.points:
+            return None
+        index = bisect.bisect_right(self.points, hash_key(key))
+        if index == len(self.points):
+            index = 0
+        return self.nodes[index]
+
+
+if __name__ == '__main__':
+    import timeit
+
+    keys = [f"key-{i}" for i in range(100000)]
+    print("------------选择耗时(O(log n))------------")
+    for n in (4, 64, 1024):
+        ring = HashRing([f"10.0.{i // 256}.{i % 256}:5253" for i in range(n)])
+        t = timeit.timeit(lambda: ring.get("key-1"), number=100000)
+        print(f"主机数:{n:5d} 虚拟节点:{len(ring.points):7d} 单次选择:{t * 10:.3f}us")
+
+    print("------------节点增减时key的迁移比例------------")
+    hosts = [f"10.0.0.{i}:5253" for i in range(10)]
+    ring = HashRing(hosts)
+    before = [ring.get(k) for k in keys]
+    for name, changed in (("增加1个节点", hosts + ["10.0.0.100:5253"]), ("减少1个节点", hosts[:-1])):
+        new_ring = HashRing(changed)
+        moved = sum(1 for k, b in zip(keys, before) if new_ring.get(k) != b)
+        print(f"{name}: 迁移 {moved / len(keys):.2%} (理想值约 {1 / len(changed):.2%})")
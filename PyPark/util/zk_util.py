@@ -1,3 +1,8 @@
+import functools
+import re
+from collections import namedtuple
+
+
 def path_join(*aa: str):
     path = []
     for a in aa:
@@ -6,3 +11,19 @@ def path_join(*aa: str):
         if a != "":
             path.append(a)
     return "/".join(path)
+
+
+# 服务节点 [group]ip:port 解析后的记录
+RestNode = namedtuple("RestNode", ["name", "group", "host"])
+
+
+def parse_rest_node(name) -> RestNode:
+    """[group]ip:port --> RestNode(name, group, ip:port)"""
+    end = name.find("]")
+    return RestNode(name, name[1:end], name[end + 1:])
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_pattern(pattern):
+    """分组/主机过滤的正则, 每个不同的表达式只编译一次, 返回match函数"""
+    return re.compile(pattern).match
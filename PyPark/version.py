@@ -10,5 +10,7 @@ def print_infos(pk):
         logging.info(f"Started By [{pk.group}] http://{pk.ip}:{pk.port}")
     if pk.nat_port:
         logging.info(f"Started By [NAT] http://{pk.nat_ip}:{pk.nat_port}")
+    if pk.rpc_port:
+        logging.info(f"Started By [RPC] {pk.ip}:{pk.rpc_port}")
     if pk.debug:
         logging.warning(f"Debug Enable Address:{pk.debug_host}")
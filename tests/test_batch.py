@@ -0,0 +1,57 @@
+import threading
+import time
+
+import pytest
+
+from PyPark.batch import Batcher
+from PyPark.park_exception import ServiceException
+from PyPark.result import Result
+
+
+def test_calls_are_merged_and_results_dispatched_in_order():
+    batches = []
+
+    def send(items):
+        batches.append(list(items))
+        return [Result.success(i * 2).__dict__ for i in items]
+
+    batcher = Batcher(send, max_items=4, max_wait=0.05)
+    futures = [batcher.submit(i) for i in range(6)]
+    assert [f.result(5)["data"] for f in futures] == [0, 2, 4, 6, 8, 10]
+    assert batches == [[0, 1, 2, 3], [4, 5]]
+    batcher.close()
+
+
+def test_failed_send_returns_error_dicts_like_success():
+    def send(items):
+        raise ConnectionError("down")
+
+    batcher = Batcher(send, max_wait=0.01)
+    futures = [batcher.submit(i) for i in range(3)]
+    results = [f.result(5) for f in futures]
+    assert all(isinstance(r, dict) and r["is_success"] is False and "down" in r["msg"] for r in results)
+    # 每个调用方得到各自的结果
+    assert results[0] is not results[1]
+    batcher.close()
+
+
+def test_close_flushes_pending_items_and_stops_thread():
+    sent = []
+    batcher = Batcher(lambda items: sent.extend(items) or [Result.success(i).__dict__ for i in items],
+                      max_items=100, max_wait=60)
+    future = batcher.submit("x")
+    start = time.monotonic()
+    batcher.close(timeout=5)
+    assert time.monotonic() - start < 5
+    assert not batcher.th.is_alive()
+    assert future.result(0)["data"] == "x"
+    assert sent == ["x"]
+    with pytest.raises(ServiceException):
+        batcher.submit("y")
+
+
+def test_idle_batcher_closes():
+    batcher = Batcher(lambda items: [], max_wait=0.01)
+    batcher.close(timeout=5)
+    assert not batcher.th.is_alive()
+    assert not any(t is batcher.th for t in threading.enumerate())
@@ -0,0 +1,90 @@
+import pytest
+from requests.structures import CaseInsensitiveDict
+from tornado.httputil import HTTPHeaders
+
+from PyPark import breaker
+from PyPark.breaker import BreakerState, HealthTable, LIMITED_HEADER, is_host_failure
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(breaker.time, "monotonic", clock.monotonic)
+    return clock
+
+
+@pytest.fixture
+def table():
+    return HealthTable(max_failures=3, error_rate=0.5, window_size=10, min_requests=4, backoff=1.0, max_backoff=4.0)
+
+
+def test_consecutive_failures_open_then_probe_closes(table, clock):
+    for _ in range(2):
+        table.on_failure("a")
+    assert table.filter(["a", "b"]) == ["a", "b"]
+    table.on_failure("a")
+    assert table.hosts["a"].state == BreakerState.OPEN
+    assert table.filter(["a", "b"]) == ["b"]
+
+    clock.now += 1.0
+    assert table.filter(["a", "b"]) == ["a", "b"]
+    table.on_request("a")
+    assert table.hosts["a"].state == BreakerState.HALF_OPEN
+    # 半开时只放行一个探测请求
+    assert table.filter(["a", "b"]) == ["b"]
+    table.on_success("a")
+    assert table.hosts["a"].state == BreakerState.CLOSED
+    assert table.filter(["a", "b"]) == ["a", "b"]
+
+
+def test_failed_probe_doubles_backoff_up_to_max(table, clock):
+    for _ in range(3):
+        table.on_failure("a")
+    for expected in (2.0, 4.0, 4.0):
+        clock.now = table.hosts["a"].open_until
+        table.on_request("a")
+        table.on_failure("a")
+        assert table.hosts["a"].backoff == expected
+        assert table.hosts["a"].state == BreakerState.OPEN
+
+
+def test_error_rate_opens(table, clock):
+    for status in (500, 200, 500, 200):
+        table.on_response("a", status, {})
+    assert table.hosts["a"].state == BreakerState.CLOSED
+    table.on_response("a", 500, {})
+    assert table.hosts["a"].consecutive_failures == 1
+    assert table.hosts["a"].state == BreakerState.OPEN
+
+
+def test_all_open_returns_original_hosts(table, clock):
+    hosts = ["a", "b"]
+    for h in hosts:
+        for _ in range(3):
+            table.on_failure(h)
+    assert table.filter(hosts) is hosts
+
+
+@pytest.mark.parametrize("headers", [{LIMITED_HEADER: "1"}, HTTPHeaders({LIMITED_HEADER: "1"}),
+                                     CaseInsensitiveDict({LIMITED_HEADER.lower(): "1"})])
+def test_limited_503_is_not_a_host_failure(table, clock, headers):
+    assert not is_host_failure(503, headers)
+    for _ in range(5):
+        table.on_response("a", 503, headers)
+    assert "a" not in table.hosts or table.hosts["a"].state == BreakerState.CLOSED
+    assert table.filter(["a"]) == ["a"]
+
+
+def test_other_5xx_are_host_failures(table, clock):
+    assert is_host_failure(503) and is_host_failure(500, {}) and not is_host_failure(404)
+    for _ in range(3):
+        table.on_response("a", 502, {})
+    assert table.hosts["a"].state == BreakerState.OPEN
@@ -0,0 +1,46 @@
+import datetime
+import math
+from decimal import Decimal
+
+import pytest
+
+from PyPark.codec import JsonCodec, codec_for_accept, codec_for_content_type, get_codec, orjson, msgpack
+from PyPark.cons import CONTENT_TYPE
+
+
+def test_json_is_the_default_json_decoder():
+    assert codec_for_content_type("application/json;charset=utf-8").name == "json"
+    assert codec_for_content_type("") is None
+    assert codec_for_accept("text/html, application/json").name == "json"
+
+
+def test_json_round_trip_keeps_nan_and_big_integers():
+    codec = codec_for_content_type(CONTENT_TYPE.JSON)
+    data = codec.loads(JsonCodec().dumps({"nan": float("nan"), "inf": float("inf"), "big": 2 ** 70}))
+    assert math.isnan(data["nan"])
+    assert data["inf"] == float("inf")
+    assert data["big"] == 2 ** 70
+    assert codec.loads(b"") is None
+
+
+def test_json_converts_dates_and_decimals():
+    codec = get_codec(None)
+    data = codec.loads(codec.dumps({"d": datetime.date(2020, 1, 2), "n": Decimal("1.5")}))
+    assert data == {"d": "2020-01-02", "n": 1.5}
+
+
+@pytest.mark.skipif(orjson is None, reason="orjson未安装")
+def test_orjson_is_opt_in_and_falls_back_to_json():
+    codec = get_codec("orjson")
+    assert codec_for_content_type(CONTENT_TYPE.JSON) is not codec
+    assert math.isnan(codec.loads(JsonCodec().dumps([float("nan")]))[0])
+    assert codec.loads(codec.dumps([2 ** 70])) == [2 ** 70]
+    assert codec.loads(codec.dumps({"d": datetime.datetime(2020, 1, 2, 3, 4, 5)})) == {"d": "2020-01-02 03:04:05"}
+
+
+@pytest.mark.skipif(msgpack is None, reason="msgpack未安装")
+def test_msgpack_round_trip():
+    codec = get_codec("msgpack")
+    assert codec_for_content_type(codec.content_type) is codec
+    assert codec.loads(codec.dumps({"a": [1, "x", b"\x00"], "d": datetime.date(2020, 1, 2)})) == \
+        {"a": [1, "x", b"\x00"], "d": "2020-01-02"}
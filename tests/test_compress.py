@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from PyPark.compress import COMPRESSORS, CompressStats, accept_encoding, choose_encoding, compress, decompress
+
+DATA = b'{"key": "value"}' * 1000
+
+
+@pytest.mark.parametrize("encoding", list(COMPRESSORS))
+def test_round_trip(encoding):
+    data, used = compress(DATA, encoding, min_size=0)
+    assert used == encoding
+    assert len(data) < len(DATA)
+    assert decompress(data, encoding) == DATA
+    # 不可压缩的数据也能还原
+    noise = os.urandom(4096)
+    assert decompress(compress(noise, encoding, min_size=0)[0], f" {encoding.upper()} ") == noise
+
+
+def test_small_or_disabled_bodies_are_not_compressed():
+    assert compress(b"small", "gzip") == (b"small", None)
+    assert compress(DATA, "gzip", min_size=None) == (DATA, None)
+    assert compress(DATA, "gzip", min_size=-1) == (DATA, None)
+    assert compress(DATA, None) == (DATA, None)
+    assert decompress(b"raw", None) == b"raw"
+    assert decompress(b"raw", "identity") == b"raw"
+    with pytest.raises(ValueError):
+        decompress(b"raw", "br")
+
+
+def test_choose_encoding_follows_local_priority():
+    assert "gzip" in accept_encoding()
+    assert choose_encoding(None) is None
+    assert choose_encoding("br") is None
+    assert choose_encoding("br, GZIP") == "gzip"
+    assert choose_encoding("gzip;q=0") is None
+    assert choose_encoding(accept_encoding()) == next(iter(COMPRESSORS))
+
+
+def test_compress_stats():
+    stats = CompressStats()
+    stats.add("/m", 1000, 100, "gzip")
+    stats.add("/m", 10, 10)
+    snapshot = stats.snapshot()
+    assert snapshot == {"/m": {"raw_bytes": 1010, "wire_bytes": 110, "compressed": 1}}
+    snapshot["/m"]["raw_bytes"] = 0
+    assert stats.snapshot()["/m"]["raw_bytes"] == 1010
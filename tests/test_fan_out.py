@@ -0,0 +1,125 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from PyPark.cons import FanOut
+from PyPark.park_exception import ServiceException
+from PyPark.rest import AsyncRest, FanOutCollector, Rest
+from PyPark.result import Result
+
+HOSTS = ("a", "b", "c")
+
+
+def ok(host):
+    return {"is_success": True, "data": host}
+
+
+def fail(host):
+    return Result.error(msg=f"{host} failed")
+
+
+def test_collector_all_keeps_host_order():
+    collector = FanOutCollector(HOSTS)
+    assert not collector.add(2, ok("c"))
+    assert not collector.add(0, ok("a"))
+    assert collector.add(1, fail("b"))
+    assert [r["data"] if isinstance(r, dict) else r.msg for r in collector.result()] == ["a", "b failed", "c"]
+    with pytest.raises(ValueError):
+        FanOutCollector(HOSTS).add(0, ValueError("x"))
+
+
+def test_collector_first_skips_errors():
+    collector = FanOutCollector(HOSTS, FanOut.FIRST)
+    assert not collector.add(0, fail("a"))
+    assert collector.add(1, ok("b"))
+    assert collector.result()["data"] == "b"
+
+    collector = FanOutCollector(HOSTS, FanOut.FIRST)
+    for i, h in enumerate(HOSTS):
+        collector.add(i, fail(h))
+    assert collector.result().msg == "c failed"
+
+
+def test_collector_quorum_stops_when_unreachable():
+    collector = FanOutCollector(HOSTS, FanOut.QUORUM)
+    assert collector.n == 2
+    assert not collector.add(0, ok("a"))
+    assert collector.add(1, ok("b"))
+    assert [r["data"] for r in collector.result()] == ["a", "b"]
+
+    collector = FanOutCollector(HOSTS, FanOut.QUORUM)
+    assert not collector.add(0, fail("a"))
+    # 剩余一台全部成功也凑不够2个
+    assert collector.add(1, ConnectionError("refused"))
+    result = collector.result()
+    assert not result.is_success and "quorum 0/2" in result.msg
+
+
+def test_collector_any_and_invalid_mode():
+    collector = FanOutCollector(HOSTS, FanOut.ANY, n=2)
+    assert not collector.add(1, fail("b"))
+    assert collector.add(0, ok("a"))
+    assert len(collector.result()) == 2
+    assert FanOutCollector(HOSTS, FanOut.ANY, n=10).n == 3
+    with pytest.raises(ServiceException):
+        FanOutCollector(HOSTS, "most")
+
+
+class SlowHosts:
+    """按主机延迟返回结果, 记录被执行的请求"""
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.started = []
+        self.lock = threading.Lock()
+
+    def __call__(self, host, method, data, codec=None):
+        with self.lock:
+            self.started.append(host)
+        time.sleep(self.delays.get(host, 0))
+        return ok(host)
+
+    async def acall(self, host, method, data, codec=None):
+        await asyncio.sleep(self.delays.get(host, 0))
+        return ok(host)
+
+
+@pytest.fixture
+def rest():
+    rest = Rest(None, "/", max_pool_num=1, timeout=2)
+    yield rest
+    rest.close()
+
+
+def test_rest_first_returns_before_slow_hosts(rest):
+    hosts = SlowHosts({"a": 0.05, "b": 1, "c": 1})
+    rest._Rest__requests = hosts
+    start = time.monotonic()
+    assert rest.call("m", None, list(HOSTS), mode=FanOut.FIRST)["data"] == "a"
+    assert time.monotonic() - start < 0.5
+    # 一个线程的池中未开始的请求被取消
+    assert "c" not in hosts.started
+
+
+def test_rest_timeout_returns_completed_results():
+    rest = Rest(None, "/", max_pool_num=3, timeout=2)
+    rest._Rest__requests = SlowHosts({"c": 1})
+    results = rest.call("m", None, HOSTS, mode=FanOut.ALL, timeout=0.3)
+    assert [r["data"] if r else None for r in results] == ["a", "b", None]
+    rest.close()
+
+
+def test_async_rest_quorum():
+    async_rest = AsyncRest()
+    async_rest._AsyncRest__requests = SlowHosts({"c": 1}).acall
+
+    async def call():
+        start = asyncio.get_running_loop().time()
+        results = await async_rest.call("m", None, HOSTS, mode=FanOut.QUORUM)
+        return results, asyncio.get_running_loop().time() - start
+
+    results, elapsed = asyncio.run(call())
+    assert sorted(r["data"] for r in results) == ["a", "b"]
+    assert elapsed < 0.5
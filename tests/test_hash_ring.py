@@ -0,0 +1,65 @@
+import pytest
+
+from PyPark import strategy
+from PyPark.util.hash_ring import HashRing
+
+HOSTS = [f"10.0.0.{i}:5253" for i in range(10)]
+KEYS = [f"key-{i}" for i in range(20000)]
+
+
+def test_same_hosts_in_any_order_map_keys_the_same():
+    ring = HashRing(HOSTS)
+    other = HashRing(list(reversed(HOSTS)))
+    assert all(ring.get(k) == other.get(k) for k in KEYS[:2000])
+    assert HashRing([]).get("k") is None
+
+
+def test_keys_spread_over_all_hosts():
+    ring = HashRing(HOSTS)
+    counts = {}
+    for k in KEYS:
+        h = ring.get(k)
+        counts[h] = counts.get(h, 0) + 1
+    assert set(counts) == set(HOSTS)
+    # 160个虚拟节点时每个主机的份额在均值的一半到两倍之间
+    mean = len(KEYS) / len(HOSTS)
+    assert all(mean / 2 < c < mean * 2 for c in counts.values())
+
+
+@pytest.mark.parametrize("changed", [HOSTS + ["10.0.0.100:5253"], HOSTS[:-1]])
+def test_host_change_moves_about_one_nth_of_keys(changed):
+    ring = HashRing(HOSTS)
+    new_ring = HashRing(changed)
+    moved = [k for k in KEYS if ring.get(k) != new_ring.get(k)]
+    assert len(moved) / len(KEYS) < 2 / len(changed)
+    # 只有新增主机得到key, 或只有被删除主机的key迁移
+    added = set(changed) - set(HOSTS)
+    removed = set(HOSTS) - set(changed)
+    assert all(new_ring.get(k) in added or ring.get(k) in removed for k in moved)
+
+
+def test_match_takes_identity_fast_path():
+    hosts = tuple(HOSTS)
+    ring = HashRing(hosts)
+    assert ring.match(hosts, 160)
+    assert not ring.match(hosts, 80)
+    assert not ring.match(HOSTS[:-1], 160)
+    # 内容相同的新对象复用, 并记下以走快速路径
+    same = list(reversed(HOSTS))
+    assert ring.match(same, 160)
+    assert ring.source is same
+
+
+def test_strategy_hash_rebuilds_ring_only_when_hosts_change(monkeypatch):
+    monkeypatch.setattr(strategy, "get_result", lambda host, url, data, s_request, **kwargs: host)
+    monkeypatch.setattr(strategy, "_hash_ring_map", {})
+    hosts = tuple(HOSTS)
+    first = strategy.strategy_hash(hosts, "/m", "key-1", None)
+    ring = strategy._hash_ring_map["/m"]
+    assert strategy.strategy_hash(hosts, "/m", "key-1", None) == first
+    assert strategy._hash_ring_map["/m"] is ring
+    # hash参数优先于data
+    assert strategy.strategy_hash(hosts, "/m", "other", None, hash="key-1") == first
+
+    strategy.strategy_hash(HOSTS[:-1], "/m", "key-1", None)
+    assert strategy._hash_ring_map["/m"] is not ring
@@ -0,0 +1,118 @@
+import time
+
+import pytest
+
+from PyPark.hedge import Hedger, LatencyWindow, RetryBudget
+from PyPark.result import Result
+
+
+class FakeRest:
+    """按主机返回结果, delays为耗时, errors中的主机返回失败或抛出异常"""
+
+    def __init__(self, delays=None, errors=None):
+        self.delays = delays or {}
+        self.errors = errors or {}
+        self.calls = []
+
+    def call(self, method, data, hosts, codec=None):
+        self.calls.append(hosts)
+        time.sleep(self.delays.get(hosts, 0))
+        error = self.errors.get(hosts, None)
+        if isinstance(error, Exception):
+            raise error
+        if error is not None:
+            return Result.error(msg=error)
+        return {"is_success": True, "data": hosts}
+
+
+def warm(hedger, method, latency=0.01, count=20):
+    window, _, _ = hedger._Hedger__method(method)
+    for _ in range(count):
+        window.add(latency)
+
+
+@pytest.fixture
+def make_hedger():
+    hedgers = []
+
+    def make(rest, **kwargs):
+        hedger = Hedger(rest, pool_num=4, **kwargs)
+        hedgers.append(hedger)
+        return hedger
+
+    yield make
+    for hedger in hedgers:
+        hedger.close()
+
+
+def test_latency_window_percentile():
+    window = LatencyWindow()
+    for i in range(19):
+        window.add(i / 100)
+    assert window.percentile(95) is None
+    window.add(0.19)
+    assert window.percentile(95) == 0.19
+    assert window.percentile(50) == 0.1
+
+
+def test_retry_budget_limits_backups():
+    budget = RetryBudget(ratio=0.5, initial=1, max_tokens=2)
+    assert budget.withdraw()
+    assert not budget.withdraw()
+    for _ in range(10):
+        budget.deposit()
+    assert budget.tokens == 2
+
+
+def test_no_hedge_without_samples(make_hedger):
+    rest = FakeRest()
+    hedger = make_hedger(rest)
+    assert hedger.call("m", None, ("a", "b"))["is_success"]
+    assert len(rest.calls) == 1
+    assert hedger.stats["m"]["hedged"] == 0
+
+
+def test_slow_primary_is_hedged(make_hedger):
+    rest = FakeRest()
+    hedger = make_hedger(rest)
+    warm(hedger, "m")
+    # 主请求的主机随机, 两个都设为慢, 由备份请求的主机改为快
+    rest.delays = {"a": 1, "b": 1}
+    call = rest.call
+
+    def backup_fast(method, data, hosts, codec=None):
+        if rest.calls:
+            rest.delays[hosts] = 0
+        return call(method, data, hosts, codec)
+
+    rest.call = backup_fast
+    start = time.monotonic()
+    result = hedger.call("m", None, ("a", "b"))
+    assert time.monotonic() - start < 0.5
+    assert result["data"] == rest.calls[1]
+    assert hedger.stats["m"]["hedged"] == 1
+    assert hedger.stats["m"]["won"] == 1
+
+
+def test_failed_primary_waits_for_backup(make_hedger):
+    rest = FakeRest(delays={"a": 0.2, "b": 0.2}, errors={"a": "down", "b": "down"})
+    hedger = make_hedger(rest)
+    warm(hedger, "m")
+    result = hedger.call("m", None, ("a", "b"))
+    # 都失败时返回错误结果
+    assert not result.is_success and result.msg == "down"
+    assert sorted(rest.calls) == ["a", "b"]
+
+    rest.errors = {"a": ConnectionError("a"), "b": ConnectionError("b")}
+    with pytest.raises(ConnectionError):
+        hedger.call("m", None, ("a", "b"))
+
+
+def test_budget_denies_backup(make_hedger):
+    rest = FakeRest(delays={"a": 0.1, "b": 0.1})
+    hedger = make_hedger(rest, budget_ratio=0)
+    warm(hedger, "m")
+    hedger.budgets["m"].tokens = 0
+    assert hedger.call("m", None, ("a", "b"))["is_success"]
+    assert len(rest.calls) == 1
+    assert hedger.stats["m"]["denied"] == 1
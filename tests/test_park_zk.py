@@ -0,0 +1,157 @@
+import yaml
+import pytest
+from kazoo.exceptions import NoNodeError
+from kazoo.protocol.states import EventType, WatchedEvent
+
+from PyPark import park_zk
+from PyPark.park_zk import ParkZK
+
+
+class FakeResult:
+    """已完成的IAsyncResult"""
+
+    def __init__(self, value=None, exception=None):
+        self.value = value
+        self.exception = exception
+
+    def successful(self):
+        return self.exception is None
+
+    def get(self, timeout=None):
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+    def rawlink(self, callback):
+        callback(self)
+
+
+class FakeKazoo:
+    """节点数据与数据watch, 统计读取次数"""
+
+    def __init__(self):
+        self.nodes = {}
+        self.watches = {}
+        self.reads = 0
+
+    def exists(self, path):
+        return any(p == path or p.startswith(path + "/") for p in self.nodes)
+
+    def get_async(self, path, watch=None):
+        self.reads += 1
+        if path not in self.nodes:
+            return FakeResult(exception=NoNodeError())
+        if watch is not None:
+            self.watches[path] = watch
+        return FakeResult((self.nodes[path], None))
+
+    def set_data(self, path, data):
+        self.nodes[path] = data
+        watch = self.watches.pop(path, None)
+        if watch is not None:
+            watch(WatchedEvent(EventType.CHANGED, None, path))
+
+
+class FakeChildrenWatch:
+    """记录回调, 由测试触发子节点变化"""
+    watches = {}
+
+    def __init__(self, client, path, func, allow_session_lost=True):
+        self.watches[path] = func
+        func(sorted(p.rsplit("/", 1)[1] for p in client.nodes if p.rsplit("/", 1)[0] == path))
+
+
+@pytest.fixture
+def zk(monkeypatch):
+    monkeypatch.setattr(park_zk, "ChildrenWatch", FakeChildrenWatch)
+    FakeChildrenWatch.watches = {}
+    zk = ParkZK("127.0.0.1:2181", "/park", "g", None, "/", "10.0.0.1", 5253, None)
+    zk.zk = FakeKazoo()
+    return zk
+
+
+def add_node(zk, method, host, **info):
+    path = f"park/RestServices/{method}/[g]{host}"
+    zk.zk.nodes[path] = yaml.dump(info).encode("utf-8")
+    return path
+
+
+def children_changed(zk, method):
+    path = f"park/RestServices/{method}"
+    children = sorted(p.rsplit("/", 1)[1] for p in zk.zk.nodes if p.rsplit("/", 1)[0] == path)
+    FakeChildrenWatch.watches[path](children)
+
+
+def test_node_info_is_loaded_with_children(zk):
+    add_node(zk, "m", "10.0.0.2:1", Idempotent=True, **{"RPC Port": 7000})
+    add_node(zk, "m", "10.0.0.3:1", Batch=True)
+    assert zk.get_rest_nodes("m") == ("10.0.0.2:1", "10.0.0.3:1")
+    reads = zk.zk.reads
+
+    assert zk.get_rpc_port("m", "10.0.0.2:1") == 7000
+    assert zk.get_capable_hosts("m", ["10.0.0.2:1", "10.0.0.3:1"], "Idempotent") == ["10.0.0.2:1"]
+    assert zk.get_capable_hosts("m", ["10.0.0.2:1", "10.0.0.3:1"], "Batch") == ["10.0.0.3:1"]
+    assert zk.get_node_info("m", "10.0.0.9:1") == {}
+    # 查询不访问ZK
+    assert zk.zk.reads == reads
+
+
+def test_children_change_only_reads_new_nodes_of_that_method(zk):
+    add_node(zk, "m", "10.0.0.2:1", Idempotent=True)
+    add_node(zk, "n", "10.0.0.2:1", Batch=True)
+    zk.get_rest_nodes("m")
+    zk.get_rest_nodes("n")
+    reads = zk.zk.reads
+
+    add_node(zk, "m", "10.0.0.3:1", Idempotent=True)
+    children_changed(zk, "m")
+    assert zk.zk.reads == reads + 1
+    assert zk.is_idempotent("m", "10.0.0.3:1")
+    assert zk.is_batch("n", "10.0.0.2:1")
+    assert zk.zk.reads == reads + 1
+
+
+def test_node_data_change_updates_info(zk):
+    path = add_node(zk, "m", "10.0.0.2:1")
+    zk.get_rest_nodes("m")
+    assert not zk.is_batch("m", "10.0.0.2:1")
+
+    zk.zk.set_data(path, yaml.dump({"Batch": True}).encode("utf-8"))
+    assert zk.is_batch("m", "10.0.0.2:1")
+
+
+def test_get_rest_nodes_cannot_be_mutated_by_callers(zk):
+    add_node(zk, "m", "10.0.0.2:1")
+    add_node(zk, "m", "10.0.0.3:1")
+    nodes = zk.get_rest_nodes("m")
+    assert nodes == ("10.0.0.2:1", "10.0.0.3:1")
+    with pytest.raises(AttributeError):
+        nodes.remove("10.0.0.2:1")
+    # 节点未变化时返回同一对象, HashRing可走快速路径
+    assert zk.get_rest_nodes("m") is nodes
+    assert zk.get_rest_nodes("m", host="10.0.0.2") == ("10.0.0.2:1",)
+
+    add_node(zk, "m", "10.0.0.4:1")
+    children_changed(zk, "m")
+    assert zk.get_rest_nodes("m") == ("10.0.0.2:1", "10.0.0.3:1", "10.0.0.4:1")
+
+
+def test_children_are_cached_until_session_lost(zk):
+    assert zk.get_rest_children("m") == []
+    # 未注册的服务不缓存
+    assert "m" not in zk.rest_nodes
+    add_node(zk, "m", "10.0.0.2:1")
+    assert zk.get_rest_children("m") == ["[g]10.0.0.2:1"]
+    assert zk.get_rest_children("m") == ["[g]10.0.0.2:1"]
+    assert zk.rest_nodes_stats["refreshes"] == 1
+    assert zk.rest_nodes_stats["hits"] == 1
+
+    old_watch = FakeChildrenWatch.watches["park/RestServices/m"]
+    zk.invalidate_rest_nodes()
+    assert zk.rest_nodes == {} and zk.rest_node_info == {}
+    assert zk.rest_nodes_stats["invalidations"] == 1
+    # 旧的watch停止, 不再写入缓存
+    assert old_watch(["[g]10.0.0.9:1"]) is False
+    add_node(zk, "m", "10.0.0.3:1")
+    assert zk.get_rest_nodes("m") == ("10.0.0.2:1", "10.0.0.3:1")
+    assert FakeChildrenWatch.watches["park/RestServices/m"] is not old_watch
@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+from tornado.httputil import HTTPHeaders
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+
+from PyPark import rest
+from PyPark.codec import CONTENT_TYPE_CODECS
+from PyPark.park_exception import ServiceException
+from PyPark.rest import AsyncRest, ServiceLimiter, ServiceRoute, decode_body, serve_route
+from PyPark.util.json_to import JsonTo
+
+
+class Request:
+    def __init__(self, body, content_type=None):
+        self.body = body
+        self.headers = HTTPHeaders({"Content-Type": content_type} if content_type is not None else {})
+
+
+def test_body_without_content_type_is_json():
+    assert decode_body(Request(b"")) is None
+    assert decode_body(Request(b'{"a": 1}')) == {"a": 1}
+    assert decode_body(Request(b'[1, 2]', "")) == [1, 2]
+
+
+def test_body_by_content_type():
+    assert decode_body(Request(b"", "application/json")) is None
+    assert decode_body(Request(b'{"a": 1}', "application/json; charset=UTF-8")) == {"a": 1}
+    assert decode_body(Request("文本".encode("utf-8"), "text/plain")) == "文本"
+
+
+def test_limiter_rejects_when_running_and_queue_are_full():
+    limiter = ServiceLimiter(max_concurrency=1, queue_size=1)
+    release = asyncio.Event()
+
+    async def slow(body):
+        await release.wait()
+        return body
+
+    route = ServiceRoute("/slow", slow, limiter=limiter)
+
+    async def run():
+        request = Request(b'"x"')
+        request.path = "/slow"
+        running = asyncio.ensure_future(serve_route(route, request, None))
+        queued = asyncio.ensure_future(serve_route(route, request, None))
+        await asyncio.sleep(0)
+        assert (limiter.running, limiter.waiting) == (1, 1)
+        status, result = await serve_route(route, request, None)
+        assert status == 503 and not result.is_success
+        release.set()
+        assert await running == (200, "x")
+        assert await queued == (200, "x")
+
+    asyncio.run(run())
+    assert limiter.rejected == 1 and limiter.running == 0
+
+
+def test_async_rest_uses_simple_client_without_pycurl(monkeypatch):
+    monkeypatch.setattr(rest, "pycurl", None)
+    async_rest = AsyncRest()
+
+    async def client():
+        return async_rest.client
+
+    try:
+        assert isinstance(asyncio.run(client()), SimpleAsyncHTTPClient)
+    finally:
+        async_rest.close()
+
+
+def test_route_args_follow_signature():
+    request = Request(b'{"a": 1}')
+    request.headers["__CUT_DATA_START_END"] = "2-5"
+    assert ServiceRoute("/m", lambda: None).args(request) == ()
+    assert ServiceRoute("/m", lambda body: None).args(request) == ({"a": 1},)
+    assert ServiceRoute("/m", lambda body, cut: None).args(request) == ({"a": 1}, (2, 5))
+    body, cut, headers = ServiceRoute("/m", lambda body, cut, headers: None).args(request, "given")
+    assert (body, cut, headers) == ("given", (2, 5), request.headers)
+    with pytest.raises(ServiceException):
+        ServiceRoute("/m", lambda a, b, c, d: None)
+
+
+def test_route_detects_async_services():
+    async def service(body):
+        return body
+
+    async def batch(items):
+        return items
+
+    assert ServiceRoute("/m", service).is_async
+    assert not ServiceRoute("/m", lambda body: body).is_async
+    assert ServiceRoute("/m", service, batch=batch).is_async_batch
+    assert not ServiceRoute("/m", service, batch=True).is_async_batch
+
+
+class TextCodec:
+    name = "text"
+    content_type = "text/x-test"
+
+    def dumps(self, obj):
+        return str(obj).encode("utf-8")
+
+    def loads(self, data):
+        return data.decode("utf-8")
+
+
+def test_response_codec_follows_accept(monkeypatch):
+    codec = TextCodec()
+    monkeypatch.setitem(CONTENT_TYPE_CODECS, codec.content_type, codec)
+    route = ServiceRoute("/m", lambda body: body, json_cls=JsonTo)
+    assert route.response_codec("text/x-test, application/json") is codec
+    # 与默认同类型时保留服务的json_cls
+    default = route.response_codec("application/json")
+    assert default is not codec and default.content_type.startswith("application/json")
+    assert route.response_codec(None).name == default.name
+    assert ServiceRoute("/m", lambda body: body, codec="json").response_codec("text/x-test") is codec
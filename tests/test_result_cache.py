@@ -0,0 +1,127 @@
+import threading
+import time
+
+import pytest
+
+from PyPark import result_cache
+from PyPark.result_cache import ResultCache, make_key
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(result_cache.time, "monotonic", clock.monotonic)
+    return clock
+
+
+def test_make_key_ignores_dict_order():
+    assert make_key("m", {"a": 1, "b": [1, 2]}) == make_key("m", {"b": [1, 2], "a": 1})
+    assert make_key("m", 1) == make_key("m", "1")
+    assert make_key("m", "x", ("h",)) != make_key("m", "x")
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = ResultCache(ttl=10)
+    calls = []
+
+    def call():
+        calls.append(clock.now)
+        return len(calls)
+
+    assert cache.get_or_call("k", call) == 1
+    clock.now += 9
+    assert cache.get_or_call("k", call) == 1
+    clock.now += 1
+    assert cache.get_or_call("k", call) == 2
+    assert cache.stats["hits"] == 1 and cache.stats["misses"] == 2
+
+
+def test_lru_eviction_and_should_cache():
+    cache = ResultCache(max_size=2, should_cache=lambda r: r != "error")
+    cache.get_or_call("a", lambda: "a")
+    cache.get_or_call("b", lambda: "b")
+    # a最近使用, 淘汰b
+    cache.get_or_call("a", lambda: "new")
+    cache.get_or_call("c", lambda: "c")
+    assert list(cache.data) == ["a", "c"]
+    assert cache.stats["evictions"] == 1
+
+    assert cache.get_or_call("e", lambda: "error") == "error"
+    assert "e" not in cache.data
+
+
+def test_concurrent_misses_call_once():
+    cache = ResultCache()
+    calls = []
+
+    def slow():
+        calls.append(1)
+        time.sleep(0.2)
+        return "v"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_call("k", slow))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ["v"] * 8
+    assert calls == [1]
+    assert cache.stats["shared"] == 7
+
+
+def test_leader_error_is_shared_and_not_cached():
+    cache = ResultCache()
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise ConnectionError("down")
+
+    errors = []
+
+    def call():
+        try:
+            cache.get_or_call("k", fail)
+        except ConnectionError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    release.set()
+    for t in threads:
+        t.join()
+    assert len(errors) == 3
+    assert cache.flights == {} and cache.data == {}
+    assert cache.get_or_call("k", lambda: "ok") == "ok"
+
+
+def test_invalidate_drops_in_flight_result():
+    cache = ResultCache()
+    started = threading.Event()
+    release = threading.Event()
+
+    def stale():
+        started.set()
+        release.wait(5)
+        return "stale"
+
+    th = threading.Thread(target=cache.get_or_call, args=("k", stale))
+    th.start()
+    assert started.wait(5)
+    cache.invalidate()
+    # 失效后的调用不等待旧请求
+    assert cache.get_or_call("k", lambda: "fresh") == "fresh"
+    release.set()
+    th.join()
+    assert cache.get_or_call("k", lambda: "other") == "fresh"
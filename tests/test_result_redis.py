@@ -0,0 +1,291 @@
+import json
+import math
+import re
+import threading
+import time
+
+import pytest
+
+from PyPark import result_redis
+from PyPark.result_redis import ResultRedis
+
+
+class FakePipeline:
+    """记录命令, execute时一次执行, 算一次往返"""
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return command
+
+    def execute(self, raise_on_error=True):
+        self.client.round_trips += 1
+        results = []
+        for name, args, kwargs in self.commands:
+            try:
+                results.append(getattr(self.client, "_" + name)(*args, **kwargs))
+            except Exception as e:
+                if raise_on_error:
+                    raise
+                results.append(e)
+        return results
+
+
+def glob_match(pattern, key):
+    """Redis的glob匹配, 只支持*和转义"""
+    regex = ""
+    escaped = False
+    for c in pattern:
+        if escaped:
+            regex += re.escape(c)
+            escaped = False
+        elif c == "\\":
+            escaped = True
+        elif c == "*":
+            regex += ".*"
+        else:
+            regex += re.escape(c)
+    return re.fullmatch(regex, key) is not None
+
+
+class FakeRedis:
+    """ResultRedis用到的命令, 按time.time()过期; round_trips统计访问Redis的次数"""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.round_trips = 0
+        self.lock = threading.Lock()
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def __value(self, name, kind):
+        deadline = self.expires.get(name, None)
+        if deadline is not None and time.time() >= deadline:
+            self.data.pop(name, None)
+            self.expires.pop(name, None)
+        value = self.data.get(name, None)
+        if value is not None and not isinstance(value, kind):
+            raise TypeError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def _set(self, name, value, ex=None):
+        self.data[name] = value if isinstance(value, bytes) else str(value).encode("utf-8")
+        if ex is None:
+            self.expires.pop(name, None)
+        else:
+            self.expires[name] = time.time() + ex
+        return True
+
+    def _mget(self, names):
+        return [self.__value(n, bytes) for n in names]
+
+    def _hset(self, name, key=None, value=None, mapping=None):
+        fields = self.__value(name, dict)
+        if fields is None:
+            fields = self.data[name] = {}
+        for k, v in (mapping if mapping is not None else {key: value}).items():
+            fields[str(k)] = v if isinstance(v, bytes) else str(v).encode("utf-8")
+        return len(fields)
+
+    def _hmget(self, name, keys):
+        fields = self.__value(name, dict) or {}
+        return [fields.get(str(k)) for k in keys]
+
+    def _expire(self, name, seconds):
+        self.expires[name] = time.time() + seconds
+        return True
+
+    def ttl(self, name):
+        if self.__value(name, object) is None:
+            return -2
+        deadline = self.expires.get(name, None)
+        return -1 if deadline is None else int(math.ceil(deadline - time.time()))
+
+    def get(self, name):
+        return self.__value(name, bytes)
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        self.round_trips += 1
+        return self._hset(name, key, value, mapping)
+
+    def scan_iter(self, match="*", count=None):
+        self.round_trips += 1
+        return [k for k in list(self.data) if glob_match(match, k) and self.__value(k, object) is not None]
+
+    def delete(self, *names):
+        self.round_trips += 1
+        for name in names:
+            self.data.pop(name, None)
+            self.expires.pop(name, None)
+
+    def hdel(self, name, key):
+        self.round_trips += 1
+        (self.__value(name, dict) or {}).pop(str(key), None)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def client():
+    return FakeRedis()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(result_redis.time, "time", clock.time)
+    return clock
+
+
+def test_cache_many_reads_and_writes_in_one_round_trip_each(client):
+    cache = ResultRedis(client=client)
+    calls = []
+
+    @cache.cache_many(m_key="square", timeout=10)
+    def square(keys):
+        calls.append(list(keys))
+        return [int(k) ** 2 for k in keys]
+
+    assert square(["1", "2", "3"]) == [1, 4, 9]
+    # 一次读取, 一次写入
+    assert client.round_trips == 2
+    assert client.ttl("square:1") == 10
+
+    client.round_trips = 0
+    assert square(["2", "4", "4", "1"]) == [4, 16, 16, 1]
+    # 只计算未命中的key, 重复的key只算一次
+    assert calls == [["1", "2", "3"], ["4"]]
+    assert client.round_trips == 2
+
+
+def test_each_entry_expires_on_its_own(client, clock):
+    cache = ResultRedis(client=client, beta=0)
+    calls = []
+
+    def compute(value):
+        calls.append(value)
+        return value
+
+    cache.get_or_call("m", "short", lambda: compute("short"), timeout=5)
+    cache.get_or_call("m", "long", lambda: compute("long"), timeout=60)
+    clock.now += 10
+    cache.get_or_call("m", "short", lambda: compute("short"), timeout=5)
+    cache.get_or_call("m", "long", lambda: compute("long"), timeout=60)
+    assert calls == ["short", "long", "short"]
+    # 过期的结果由Redis删除
+    clock.now += 60
+    assert client.get("m:long") is None
+
+
+def test_short_write_does_not_cut_longer_entries(client, clock):
+    cache = ResultRedis(client=client, beta=0)
+    cache.get_or_call("m", "long", lambda: "long", timeout=60)
+    cache.get_or_call("m", "short", lambda: "short", timeout=5)
+    assert client.ttl("m:long") == 60
+    assert client.ttl("m:short") == 5
+    assert client.ttl("m") == -2
+
+    clock.now += 30
+    assert cache.get_many("m", ["long", "short"]) == [{"r": "long", "e": clock.now + 30, "d": 0.0}, None]
+
+
+def test_legacy_hash_is_read_and_cleared(client):
+    # 旧版本写入的服务hash与{"result": ...}格式
+    client._hset("legacy", "k", json.dumps({"result": {"a": 1}}))
+    client._expire("legacy", 10)
+    cache = ResultRedis(client=client)
+
+    @cache.cache(m_key="legacy")
+    def legacy(data):
+        return data
+
+    assert legacy("k") == {"a": 1}
+    assert cache.get_many("legacy", ["k", "missing"]) == [{"r": {"a": 1}}, None]
+    assert legacy("other") == "other"
+
+    legacy.clear_cache()
+    assert client.data == {}
+
+
+def test_clear_cache_only_removes_its_own_entries(client):
+    cache = ResultRedis(client=client)
+    cache.write("a*", {"1": cache.dumps(1, 0, 10), "2": cache.dumps(2, 0, 10)}, 10)
+    cache.write("ab", {"1": cache.dumps(1, 0, 10)}, 10)
+    cache.clear_cache("a*", "1")
+    assert sorted(client.data) == ["a*:2", "ab:1"]
+    cache.clear_cache("a*")
+    assert sorted(client.data) == ["ab:1"]
+
+
+def test_service_key_holding_a_result_is_not_read_as_hash(client):
+    cache = ResultRedis(client=client)
+    cache.write("user", {"1": cache.dumps("u1", 0, 10)}, 10)
+    assert cache.get_or_call("user:1", "k", lambda: "v") == "v"
+    assert cache.get_or_call("user:1", "k", lambda: "other") == "v"
+
+
+def test_xfetch_refreshes_slow_entries_before_expiry(client, clock, monkeypatch):
+    cache = ResultRedis(client=client, beta=1.0)
+    calls = []
+
+    def slow():
+        calls.append(clock.now)
+        clock.now += 2
+        return "v"
+
+    cache.get_or_call("m", "k", slow, timeout=10)
+    # 距过期还有3秒, 计算耗时2秒
+    clock.now += 7
+    monkeypatch.setattr(result_redis.random, "random", lambda: 0.0)
+    cache.get_or_call("m", "k", slow, timeout=10)
+    assert len(calls) == 1
+    monkeypatch.setattr(result_redis.random, "random", lambda: 0.9)
+    cache.get_or_call("m", "k", slow, timeout=10)
+    assert len(calls) == 2
+
+    # beta=0不提前刷新
+    cache.beta = 0
+    clock.now += 9
+    cache.get_or_call("m", "k", slow, timeout=10)
+    assert len(calls) == 2
+
+
+def test_l1_collapses_concurrent_misses(client):
+    cache = ResultRedis(client=client, l1_size=16, l1_ttl=10)
+    calls = []
+
+    @cache.cache(m_key="slow")
+    def slow(data):
+        calls.append(data)
+        time.sleep(0.2)
+        return data.upper()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(slow("k"))) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ["K"] * 8
+    assert calls == ["k"]
+    # 一次HGET, 一次写入
+    assert client.round_trips == 2
+
+    slow.clear_cache()
+    assert client.get("slow:k") is None
+    assert slow("k") == "K"
+    assert calls == ["k", "k"]
@@ -0,0 +1,180 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+from PyPark import rpc
+from PyPark.rpc import FRAME_FIXED_SIZE, FRAME_HEADER, FRAME_REQUEST, RpcClient, RpcConnectError, \
+    RpcServer, pack_frame, unpack_payload
+
+
+def test_frame_round_trip():
+    frame = pack_frame(7, FRAME_REQUEST, {":path": "/m", "Content-Type": "application/json"}, b"body")
+    length, request_id, kind, head_size = FRAME_HEADER.unpack(frame[:FRAME_HEADER.size])
+    assert (request_id, kind) == (7, FRAME_REQUEST)
+    assert length == len(frame) - 4
+    headers, body = unpack_payload(memoryview(frame)[FRAME_HEADER.size:], head_size)
+    assert headers == {":path": "/m", "Content-Type": "application/json"}
+    assert body == b"body"
+
+
+def test_unpack_rejects_non_object_header():
+    with pytest.raises(ValueError):
+        unpack_payload(b"[1]", 3)
+
+
+@pytest.fixture
+def server():
+    async def handle(request):
+        if request.path == "/slow":
+            await asyncio.sleep(0.2)
+        return 200, {"Content-Type": "text/plain"}, request.path.encode("utf-8") + request.body
+
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    holder = {}
+
+    def run():
+        asyncio.set_event_loop(loop)
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(16)
+        sock.setblocking(False)
+        rpc = RpcServer(handle)
+        rpc.add_sockets([sock])
+        holder["port"] = sock.getsockname()[1]
+        started.set()
+        loop.run_forever()
+        rpc.stop()
+
+    th = threading.Thread(target=run, daemon=True)
+    th.start()
+    started.wait(5)
+    yield f"127.0.0.1:{holder['port']}"
+    loop.call_soon_threadsafe(loop.stop)
+    th.join(5)
+
+
+def test_requests_share_one_connection_and_return_out_of_order(server):
+    client = RpcClient(timeout=5)
+    results = {}
+
+    def call(path):
+        results[path] = client.request(server, path, {}, b"!")
+
+    threads = [threading.Thread(target=call, args=(p,)) for p in ("/slow", "/a", "/b")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results["/a"][0] == 200
+    assert results["/slow"][2] == b"/slow!"
+    assert results["/b"][1]["Content-Type"] == "text/plain"
+    assert len(client.connections) == 1
+    client.close()
+
+
+@pytest.mark.parametrize("frame", [
+    # 帧长度小于固定部分
+    FRAME_HEADER.pack(2, 1, FRAME_REQUEST, 0),
+    # 头长度超过帧长度
+    FRAME_HEADER.pack(FRAME_FIXED_SIZE + 2, 1, FRAME_REQUEST, 10) + b"{}",
+    # 头不是JSON
+    FRAME_HEADER.pack(FRAME_FIXED_SIZE + 3, 1, FRAME_REQUEST, 3) + b"{{{",
+])
+def test_server_closes_connection_on_malformed_frame(server, frame):
+    ip, port = server.rsplit(":", 1)
+    with socket.create_connection((ip, int(port)), timeout=5) as sock:
+        sock.sendall(frame)
+        assert sock.recv(1024) == b""
+
+
+def test_connect_failure_does_not_block_other_hosts(server, monkeypatch):
+    connect = rpc.RpcConnection
+    attempts = []
+
+    def blackholed(host, timeout=30):
+        if host == "blackhole:9":
+            attempts.append(host)
+            # 连接一直等到超时
+            time.sleep(0.5)
+            raise socket.timeout("timed out")
+        return connect(host, timeout=timeout)
+
+    monkeypatch.setattr(rpc, "RpcConnection", blackholed)
+    client = RpcClient(timeout=1)
+    errors = []
+
+    def call():
+        try:
+            client.connection("blackhole:9")
+        except RpcConnectError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(3)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    start = time.monotonic()
+    assert client.request(server, "/a", {}, b"")[0] == 200
+    assert time.monotonic() - start < 0.3
+    for t in threads:
+        t.join()
+    # 并发请求等待同一次连接
+    assert len(errors) == 3 and attempts == ["blackhole:9"]
+    # 失败后一段时间内直接失败, 不再等待连接超时
+    with pytest.raises(RpcConnectError):
+        client.connection("blackhole:9")
+    assert attempts == ["blackhole:9"]
+    client.close()
+
+
+def test_refused_connection_raises_connect_error():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    with pytest.raises(RpcConnectError):
+        RpcClient(timeout=1).request(f"127.0.0.1:{port}", "/a", {}, b"")
+
+
+def test_rest_falls_back_to_http_when_rpc_port_is_unreachable():
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from PyPark.rest import Rest
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    http = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    closed_port = sock.getsockname()[1]
+    sock.close()
+
+    class ZK:
+        def get_rpc_port(self, method, host):
+            return closed_port
+
+        def get_accept_encoding(self, method, host):
+            return None
+
+        def get_compress_min_size(self, method, host):
+            return None
+
+    rest = Rest(ZK(), "/", max_pool_num=2, timeout=2)
+    try:
+        assert rest.call("m", {"a": 1}, hosts=f"127.0.0.1:{http.server_port}") == {"a": 1}
+    finally:
+        http.shutdown()
@@ -0,0 +1,99 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from PyPark.shootback.aio import AsyncMaster, AsyncSlaver
+from PyPark.shootback.common_func import set_secretkey
+from PyPark.shootback.master import Master
+from PyPark.shootback.slaver import Slaver
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def echo_server():
+    """目标服务, 原样返回收到的数据"""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(16)
+
+    def serve(conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                conn.sendall(data)
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return server.getsockname()
+
+
+def connect_retry(addr, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return socket.create_connection(addr, timeout=10)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def echo(addr, data):
+    with connect_retry(addr) as sock:
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        buff = bytearray()
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            buff += chunk
+    return bytes(buff)
+
+
+@pytest.mark.parametrize("master_cls, slaver_cls", [
+    (AsyncMaster, AsyncSlaver),
+    (AsyncMaster, Slaver),
+    (Master, AsyncSlaver),
+], ids=["asyncio", "asyncio-master", "asyncio-slaver"])
+def test_tunnel_round_trip(master_cls, slaver_cls):
+    set_secretkey("test-secret")
+    target = echo_server()
+    communicate = ("127.0.0.1", free_port())
+    customer = ("127.0.0.1", free_port())
+    master = master_cls(customer, communicate)
+    threading.Thread(target=master.serve_forever, daemon=True).start()
+    slaver = slaver_cls(communicate, target, max_spare_count=2)
+    threading.Thread(target=slaver.serve_forever, daemon=True).start()
+
+    payloads = [os.urandom(size) for size in (1, 1024, 1024 * 1024)]
+    for data in payloads:
+        assert echo(customer, data) == data
+
+    # 并发的多个客户
+    results = {}
+    threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, echo(customer, payloads[1])))
+               for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+    assert results == {i: payloads[1] for i in range(6)}
+
+
+def test_async_master_rejects_slaver_pool():
+    with pytest.raises(ValueError):
+        AsyncMaster(("127.0.0.1", free_port()), ("127.0.0.1", free_port()), [("127.0.0.1", 1)])
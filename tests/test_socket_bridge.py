@@ -0,0 +1,147 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from PyPark.shootback.bench_bridge import bridged_pair, tcp_pair
+from PyPark.shootback.common_func import SPLICE_AVAILABLE, ShardedSocketBridge, SocketBridge, _RingBuffer, \
+    make_bridge
+
+
+def exchange(client, server, c2s_size, s2c_size, slow=False):
+    """两个方向同时发送, 发完后半关闭, 返回两端收到的数据是否一致"""
+    sent = {"c2s": os.urandom(c2s_size), "s2c": os.urandom(s2c_size)}
+    received = {}
+
+    def send(sock, data):
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+
+    def recv(sock, key):
+        buff = bytearray()
+        while True:
+            data = sock.recv(4096 if slow else 65536)
+            if not data:
+                break
+            buff += data
+            if slow:
+                time.sleep(0.0005)
+        received[key] = bytes(buff)
+
+    threads = [threading.Thread(target=send, args=(client, sent["c2s"])),
+               threading.Thread(target=send, args=(server, sent["s2c"])),
+               threading.Thread(target=recv, args=(server, "c2s")),
+               threading.Thread(target=recv, args=(client, "s2c"))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(60)
+    return received.get("c2s") == sent["c2s"], received.get("s2c") == sent["s2c"]
+
+
+def wait_closed(bridge, timeout=5):
+    deadline = time.monotonic() + timeout
+    while bridge.map and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return not bridge.map
+
+
+def test_ring_buffer_grows_wraps_and_shrinks():
+    a, b = socket.socketpair()
+    b.setblocking(False)
+    ring = _RingBuffer(64, initial=8)
+    payload = os.urandom(1000)
+    out = bytearray()
+    sent = 0
+    grown = 0
+    while len(out) < len(payload):
+        if sent < len(payload):
+            a.send(payload[sent:sent + 13])
+            sent += 13
+        while ring.length < ring.size:
+            try:
+                received, short = ring.fill(b)
+            except BlockingIOError:
+                break
+            if short:
+                break
+        grown = max(grown, ring.capacity)
+        view = ring.readable()[:7]
+        out += view
+        ring.consumed(len(view))
+    assert bytes(out) == payload
+    assert grown == 64
+    while ring.length:
+        ring.consumed(len(ring.readable()))
+    assert ring.capacity == 8
+    a.close()
+    b.close()
+
+
+@pytest.mark.parametrize("kwargs", [
+    {},
+    # 小缓冲区, 频繁在高低水位间暂停和恢复
+    {"buffer_size": 5000, "high_water": 3000, "low_water": 100},
+    pytest.param({"splice": True}, marks=pytest.mark.skipif(not SPLICE_AVAILABLE, reason="不支持splice")),
+])
+def test_bridge_keeps_data_intact_and_closes_pair(kwargs):
+    bridge = SocketBridge(**kwargs)
+    bridge.start_as_daemon()
+    done = []
+    client, a = tcp_pair()
+    b, server = tcp_pair()
+    bridge.add_conn_pair(a, b, callback=lambda: done.append(1))
+    assert exchange(client, server, 4 * 1024 * 1024, 1024 * 1024, slow=bool(kwargs)) == (True, True)
+    client.close()
+    server.close()
+    assert wait_closed(bridge)
+    assert done == [1]
+    assert bridge.stats["pairs"] == 0
+    assert not bridge.buffers and not bridge.paused and not bridge.events
+
+
+def test_buffers_shrink_after_a_burst():
+    bridge = SocketBridge()
+    bridge.start_as_daemon()
+    client, a = tcp_pair()
+    b, server = tcp_pair()
+    bridge.add_conn_pair(a, b)
+    # 超过内核缓冲区, 接收端不读时数据堆积在桥的缓冲区中
+    size = 32 * 1024 * 1024
+    data = os.urandom(size)
+    sender = threading.Thread(target=client.sendall, args=(data,))
+    sender.start()
+    deadline = time.monotonic() + 5
+    while not any(buff.capacity == bridge.buffer_size for buff in list(bridge.buffers.values())):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    received = bytearray()
+    while len(received) < size:
+        received += server.recv(1 << 20)
+    sender.join()
+    assert bytes(received) == data
+    time.sleep(0.1)
+    # 发送完后空闲的连接只保留初始大小
+    assert bridge.buffers and all(buff.capacity == 2 ** 14 for buff in bridge.buffers.values())
+    client.close()
+    server.close()
+    assert wait_closed(bridge)
+
+
+def test_sharded_bridge_spreads_pairs():
+    bridge = make_bridge(3)
+    assert isinstance(bridge, ShardedSocketBridge)
+    bridge.start_as_daemon()
+    pairs = [bridged_pair(bridge) for _ in range(6)]
+    deadline = time.monotonic() + 5
+    while sum(s.stats["pairs"] for s in bridge.shards) < 6 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [s.stats["pairs"] for s in bridge.shards] == [2, 2, 2]
+    for client, server in pairs:
+        client.sendall(b"ping")
+        assert server.recv(4) == b"ping"
+        client.close()
+        server.close()
+    assert all(wait_closed(s) for s in bridge.shards)
@@ -0,0 +1,157 @@
+import math
+import threading
+import time
+
+import pytest
+
+from PyPark import strategy
+from PyPark.result import Result
+
+
+def test_scatter_pool_does_not_wait_for_host_load_lock():
+    size = strategy.SCATTER_POOL_SIZE
+    strategy.set_scatter_pool_size(4)
+    done = threading.Event()
+
+    def create():
+        strategy.scatter_executor()
+        done.set()
+
+    try:
+        with strategy.host_load_lock:
+            threading.Thread(target=create).start()
+            assert done.wait(5)
+        assert strategy.scatter_executor()._max_workers == 4
+    finally:
+        strategy.set_scatter_pool_size(size)
+
+
+def test_resized_scatter_pool_is_replaced():
+    old = strategy.scatter_executor()
+    size = strategy.SCATTER_POOL_SIZE
+    try:
+        strategy.set_scatter_pool_size(2)
+        new = strategy.scatter_executor()
+        assert new is not old
+        assert new._max_workers == 2
+        assert new.submit(lambda: 1).result(5) == 1
+    finally:
+        strategy.set_scatter_pool_size(size)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    """独立的主机负载表, get_result直接返回选中的主机"""
+    monkeypatch.setattr(strategy, "_host_load_map", {})
+    monkeypatch.setattr(strategy, "get_result", lambda host, url, data, s_request, **kwargs: host)
+    return strategy._host_load_map
+
+
+def test_peak_ewma_jumps_on_slow_response_and_decays(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(strategy.time, "monotonic", clock.monotonic)
+    load = strategy.HostLoad("h", decay=10.0)
+    load.start()
+    load.finish(0.1)
+    assert load.ewma == 0.1
+    load.start()
+    load.finish(2.0)
+    # 变慢立即上升
+    assert load.ewma == 2.0
+    clock.now += 10
+    assert load.current_ewma() == pytest.approx(2.0 / math.e)
+    load.start()
+    load.finish(0.1)
+    assert 0.1 < load.ewma < 1.0
+
+
+def test_cost_penalises_unmeasured_busy_hosts():
+    load = strategy.HostLoad("h")
+    assert load.cost() == 0.0
+    load.start()
+    assert load.cost() == strategy.UNMEASURED_RTT_PENALTY * 2
+
+
+def test_least_picks_host_with_fewest_outstanding(loads):
+    for _ in range(2):
+        strategy.host_load("a").start()
+    strategy.host_load("b").start()
+    assert strategy.strategy_least(["a", "b", "c"], "/m", None, None) == "c"
+    assert strategy.strategy_p2c(["a", "b"], "/m", None, None) == "b"
+    assert strategy.strategy_p2c(("a",), "/m", None, None) == "a"
+
+
+def test_ewma_prefers_fast_host(loads):
+    for host, rtt in (("slow", 1.0), ("fast", 0.01)):
+        load = strategy.host_load(host)
+        load.start()
+        load.finish(rtt)
+    assert {strategy.strategy_ewma(["slow", "fast"], "/m", None, None) for _ in range(20)} == {"fast"}
+
+
+def test_round_robin_cycles_evenly_across_threads(loads, monkeypatch):
+    monkeypatch.setattr(strategy, "_round_index_map", {})
+    hosts = ("a", "b", "c")
+    picked = []
+    lock = threading.Lock()
+
+    def call():
+        local = [strategy.strategy_round(hosts, "/m", None, None) for _ in range(300)]
+        with lock:
+            picked.extend(local)
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 并发下每个主机被选中的次数相同
+    assert [picked.count(h) for h in hosts] == [400, 400, 400]
+    # 每个url一个游标
+    strategy.strategy_round(hosts, "/n", None, None)
+    assert set(strategy._round_index_map) == {"/m", "/n"}
+
+
+def test_round_robin_survives_host_count_change(loads, monkeypatch):
+    monkeypatch.setattr(strategy, "_round_index_map", {})
+    strategy.strategy_round(["a", "b", "c"], "/m", None, None)
+    picked = [strategy.strategy_round(["a", "b"], "/m", None, None) for _ in range(10)]
+    assert picked.count("a") == picked.count("b") == 5
+
+
+def fake_get(delays):
+    def get(host, url, data, cut_start_end="0-0", s_request=None, kwargs=None):
+        time.sleep(delays.get(host, 0))
+        return Result.success(f"{host}:{cut_start_end}")
+
+    return get
+
+
+def test_many_results_keep_host_order_and_cuts(monkeypatch):
+    monkeypatch.setattr(strategy, "get", fake_get({"a": 0.1}))
+    result = strategy.get_many_results(None, [0, 1, 2, 3], ["a", "b"], None, "/m")
+    assert result.is_success
+    assert [r.data for r in result.data] == ["a:0-2", "b:2-4"]
+
+
+def test_iter_many_results_yields_in_completion_order(monkeypatch):
+    monkeypatch.setattr(strategy, "get", fake_get({"a": 0.2, "b": 0.1}))
+    assert [h for h, _ in strategy.iter_many_results(None, None, ["a", "b", "c"], None, "/m")] == ["c", "b", "a"]
+
+
+def test_deadline_returns_timeout_errors_for_slow_hosts(monkeypatch):
+    monkeypatch.setattr(strategy, "get", fake_get({"slow": 2}))
+    start = time.monotonic()
+    results = dict(strategy.iter_many_results(None, None, ["fast", "slow"], None, "/m", deadline=0.2))
+    assert time.monotonic() - start < 1
+    assert results["fast"].is_success
+    assert not results["slow"].is_success
+    assert "deadline" in results["slow"].msg
@@ -0,0 +1,86 @@
+import asyncio
+import socket
+import threading
+
+import pytest
+import tornado.httpserver
+
+from PyPark.cons import StreamMode
+from PyPark.rest import LineBuffer, Rest
+from PyPark.result import Result
+
+
+def test_line_buffer_splits_across_chunks():
+    lines = LineBuffer()
+    assert lines.feed(b'{"a": 1}\n{"a"') == [b'{"a": 1}']
+    assert lines.feed(b': 2}\n\n') == [b'{"a": 2}']
+    assert lines.feed(b'{"a": 3}') == []
+    assert lines.close() == [b'{"a": 3}']
+    assert lines.close() == []
+
+
+@pytest.fixture
+def host():
+    rest = Rest(None, "/", max_pool_num=4, timeout=5)
+
+    @rest.register(stream=StreamMode.NDJSON)
+    def double(body):
+        for record in body:
+            yield {"n": record["n"] * 2}
+
+    @rest.register(stream=StreamMode.CHUNK)
+    async def count(body):
+        size = 0
+        async for chunk in body:
+            size += len(chunk)
+        return Result.success(size)
+
+    @rest.register(stream=StreamMode.CHUNK)
+    def echo(body, cut):
+        yield f"{cut[0]}-{cut[1]}:"
+        for chunk in body:
+            yield chunk
+
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    holder = {}
+
+    def run():
+        asyncio.set_event_loop(loop)
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(16)
+        sock.setblocking(False)
+        server = tornado.httpserver.HTTPServer(rest._Rest__make([]))
+        server.add_sockets([sock])
+        holder["port"] = sock.getsockname()[1]
+        started.set()
+        loop.run_forever()
+        server.stop()
+
+    th = threading.Thread(target=run, daemon=True)
+    th.start()
+    assert started.wait(5)
+    yield rest, f"127.0.0.1:{holder['port']}"
+    loop.call_soon_threadsafe(loop.stop)
+    th.join(5)
+
+
+def test_ndjson_records_stream_both_ways(host):
+    rest, address = host
+    records = ({"n": i} for i in range(1000))
+    assert list(rest.call_stream("double", records, address)) == [{"n": i * 2} for i in range(1000)]
+
+
+def test_async_service_consumes_large_body(host):
+    rest, address = host
+    chunks = (b"x" * 65536 for _ in range(64))
+    [result] = rest.call_stream("count", chunks, address, stream=StreamMode.CHUNK)
+    assert result["is_success"] and result["data"] == 64 * 65536
+
+
+def test_chunks_echo_with_cut(host):
+    rest, address = host
+    data = [b"a" * 100000, "b", b"c"]
+    body = b"".join(rest.call_stream("echo", data, address, stream=StreamMode.CHUNK, cut_start_end="3-7"))
+    assert body == b"3-7:" + b"a" * 100000 + b"bc"